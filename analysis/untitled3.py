@@ -5,6 +5,14 @@ Created on Wed Mar 26 02:19:58 2025
 @author: Matth
 """
 
+import os
+import sys
+from collections import Counter
+
+# The tokenizer is shared with the backend (backend/tokenizer.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from tokenizer import iter_tokens
+
 #plot results
 def plot_results():
     global df
@@ -89,19 +97,17 @@ def generate_word_cloud():
         messagebox.showerror("Error", "No tracks found for the selected album.")
         return
 
-    all_lyrics = ""  # Variable to hold all the lyrics from the album
+    term_counts = Counter()  # Term frequencies across the album
 
     for track_name in tracks:
         # Fetch the lyrics for each track using Genius API
         lyrics, _ = genius(track_name, artist_name)
         if lyrics:
-            all_lyrics += lyrics + " "  # Concatenate the lyrics from each song
-
-    # Normalize the concatenated lyrics (remove special characters and convert to lowercase)
-    all_lyrics = re.sub(r'[^a-zA-Z\s]', '', all_lyrics).lower()
+            # Count the normalized tokens of each song with the backend's shared tokenizer
+            term_counts.update(iter_tokens(lyrics))
 
-    # Generate the word cloud from the combined lyrics
-    WordCloud = wordcloud(width=800, height=400, background_color='white').generate(all_lyrics)
+    # Generate the word cloud from the term frequencies
+    WordCloud = wordcloud(width=800, height=400, background_color='white').generate_from_frequencies(term_counts)
 
     # Display the word cloud in a new window
     plt.figure(figsize=(10, 5))
@@ -0,0 +1,174 @@
+# Corpus analytics over the token index. Every aggregation runs inside DuckDB and results come
+# back column-oriented (one list per column) or as an Arrow IPC stream, so charts never go
+# through row-by-row Python or pandas.
+from spotify_utils import get_spotify_artist_id, get_spotify_albums
+from tokenizer import normalize_text
+from duckdb_utils import get_cursor, store_album_release_dates
+from metrics import timed_stage
+
+try:
+    import pyarrow
+except ImportError:  # Arrow output is optional
+    pyarrow = None
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+# Largest N accepted for top-N queries
+MAX_TOP_N = 500
+
+# Common English function words plus lyric filler, left out of word clouds by default.
+# Normalized the same way as the index so contractions match their stored form.
+STOPWORDS = frozenset(normalize_text(word) for word in """
+a about above after again against all am an and any are as at be because been before being below
+between both but by can could did do does doing don't down during each few for from further had has
+have having he her here hers herself him himself his how i i'd i'll i'm i've if in into is isn't it
+it's its itself just let's me more most my myself no nor not now of off on once only or other our
+ours ourselves out over own same she should so some such than that that's the their theirs them
+themselves then there there's these they they're this those through to too under until up very was
+we we're were what what's when where which while who whom why will with won't would you you'd you'll
+you're you've your yours yourself yourselves ain't can't didn't doesn't gon gonna gotta got get wanna
+ya yeah yo oh ooh uh huh ay ayy hey la na da like ima 'em 'cause cause chorus verse intro outro
+hook bridge pre-chorus
+""".split())
+
+
+# Function to run an analytics query and return {"columns": [...], "data": {column: [values]}, "rows": n}
+def query_columns(sql, params):
+    con = get_cursor()
+    result = con.execute(sql, params)
+    columns = [column[0] for column in result.description]
+    rows = result.fetchall()
+    values = list(zip(*rows)) if rows else [() for _ in columns]
+    return {
+        "columns": columns,
+        "data": {column: list(column_values) for column, column_values in zip(columns, values)},
+        "rows": len(rows)
+    }
+
+
+# Function to run an analytics query and return the result as Arrow IPC stream bytes
+def query_arrow(sql, params):
+    if pyarrow is None:
+        raise RuntimeError("Arrow output needs the pyarrow package")
+    table = get_cursor().execute(sql, params).arrow()
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+@timed_stage("duckdb_read")
+def run_query(sql, params, as_arrow=False):
+    return query_arrow(sql, params) if as_arrow else query_columns(sql, params)
+
+
+# Function to turn requested words into index terms; phrases aren't in the term index and are dropped
+def words_to_terms(words):
+    terms = []
+    for word in words:
+        term = normalize_text(word)
+        if term and " " not in term and term not in terms:
+            terms.append(term)
+    return terms
+
+
+# Function to fill in missing release dates of an artist's indexed albums from the (cached) Spotify album list
+def backfill_release_dates(artist_name):
+    missing = get_cursor().execute(
+        "SELECT Album FROM indexed_albums WHERE Artist = ? AND Release_Date IS NULL",
+        [artist_name]
+    ).fetchall()
+    if not missing:
+        return
+    artist_id = get_spotify_artist_id(artist_name)
+    albums = get_spotify_albums(artist_id) if artist_id else None
+    if not albums:
+        return
+    release_dates = {}
+    for album in albums.get("items", []):
+        release_dates.setdefault(album["name"].strip().lower(), album.get("release_date"))
+    store_album_release_dates(artist_name, {
+        album_name: release_dates[album_name.strip().lower()]
+        for (album_name,) in missing if release_dates.get(album_name.strip().lower())
+    })
+
+
+# Top-N terms of each indexed album of an artist (optionally only some albums / terms of a minimum length)
+def top_words_per_album(artist_name, n=10, albums=None, min_length=1, as_arrow=False):
+    album_filter = f"AND Album IN ({', '.join('?' for _ in albums)})" if albums else ""
+    sql = f"""
+        SELECT Album, Term, Count,
+               ROW_NUMBER() OVER (PARTITION BY Album ORDER BY Count DESC, Term) AS Rank
+        FROM album_terms
+        WHERE Artist = ? AND length(Term) >= ? {album_filter}
+        QUALIFY Rank <= ?
+        ORDER BY Album, Rank
+    """
+    return run_query(sql, [artist_name, min_length, *(albums or []), min(n, MAX_TOP_N)], as_arrow)
+
+
+# Frequency of terms in each indexed album of an artist, ordered by release date.
+# Per_10k is occurrences per 10,000 tokens so albums of different lengths compare fairly.
+def word_frequency_over_time(artist_name, terms, as_arrow=False):
+    backfill_release_dates(artist_name)
+    sql = """
+        WITH album_tokens AS (
+            SELECT Album, SUM(Count) AS Tokens FROM album_terms WHERE Artist = ? GROUP BY Album
+        ),
+        requested AS (SELECT unnest(?::VARCHAR[]) AS Term)
+        SELECT a.Release_Date, a.Album, r.Term,
+               COALESCE(t.Count, 0) AS Count,
+               tok.Tokens,
+               COALESCE(t.Count, 0) * 10000.0 / NULLIF(tok.Tokens, 0) AS Per_10k
+        FROM indexed_albums a
+        JOIN album_tokens tok ON tok.Album = a.Album
+        CROSS JOIN requested r
+        LEFT JOIN album_terms t ON t.Artist = a.Artist AND t.Album = a.Album AND t.Term = r.Term
+        WHERE a.Artist = ?
+        ORDER BY a.Release_Date NULLS LAST, a.Album, r.Term
+    """
+    return run_query(sql, [artist_name, terms, artist_name], as_arrow)
+
+
+# Side-by-side totals of terms for several artists across everything indexed for them,
+# with each artist's token count and vocabulary size for normalizing
+def compare_artists(artist_names, terms, as_arrow=False):
+    sql = """
+        WITH artist_tokens AS (
+            SELECT Artist, SUM(Count) AS Tokens, COUNT(DISTINCT Term) AS Vocabulary, COUNT(DISTINCT Album) AS Albums
+            FROM album_terms
+            WHERE Artist IN (SELECT unnest(?::VARCHAR[]))
+            GROUP BY Artist
+        ),
+        requested AS (SELECT unnest(?::VARCHAR[]) AS Term)
+        SELECT a.Artist, r.Term,
+               COALESCE(SUM(t.Count), 0) AS Count,
+               a.Tokens, a.Vocabulary, a.Albums,
+               COALESCE(SUM(t.Count), 0) * 10000.0 / NULLIF(a.Tokens, 0) AS Per_10k
+        FROM artist_tokens a
+        CROSS JOIN requested r
+        LEFT JOIN album_terms t ON t.Artist = a.Artist AND t.Term = r.Term
+        GROUP BY a.Artist, r.Term, a.Tokens, a.Vocabulary, a.Albums
+        ORDER BY a.Artist, r.Term
+    """
+    return run_query(sql, [artist_names, terms], as_arrow)
+
+
+# Top-K terms of one album, or of everything indexed for an artist when album_name is None,
+# straight from the term index. Weight is each count relative to the top term (for sizing a cloud).
+def top_terms(artist_name, album_name=None, k=100, stopwords=STOPWORDS, min_length=2, as_arrow=False):
+    album_filter = "AND Album = ?" if album_name else ""
+    sql = f"""
+        SELECT Term, Count, Count / MAX(Count) OVER () AS Weight
+        FROM (
+            SELECT Term, SUM(Count) AS Count
+            FROM album_terms
+            WHERE Artist = ? {album_filter} AND length(Term) >= ?
+              AND Term NOT IN (SELECT unnest(?::VARCHAR[]))
+            GROUP BY Term
+            ORDER BY Count DESC, Term
+            LIMIT ?
+        )
+        ORDER BY Count DESC, Term
+    """
+    params = [artist_name, *([album_name] if album_name else []), min_length, sorted(stopwords), min(k, MAX_TOP_N)]
+    return run_query(sql, params, as_arrow)
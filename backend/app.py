@@ -1,10 +1,25 @@
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, g
 from flask_cors import CORS
-from spotify_utils import get_spotify_artist_id, get_spotify_albums
-from rap_genius_utils import get_song_info_from_genius, count_word_occurrences, genius
-from duckdb_utils import check_duckdb_cache, store_in_duckdb
+from spotify_utils import get_spotify_artist_id, get_spotify_albums, get_spotify_albums_tracks, DISCOGRAPHY_GROUPS
+from index_utils import get_track_lyrics, iter_album_ingest, get_album_word_counts, start_word_counts, finish_word_counts
+from index_utils import import_album_job, start_job_importer, count_words_in_album_sections
+from index_utils import throttled_result, incomplete_result, AlbumIncomplete, ALBUM_FETCH_WORKERS, SSE_HEARTBEAT_SECONDS
+from endpoint_utils import RequestError, parse_artist, parse_album_request, parse_sections_request, parse_artist_words_request
+from endpoint_utils import parse_lyrics_request, parse_job_request, parse_analytics_format, parse_top_words_request
+from endpoint_utils import parse_word_timeline_request, parse_compare_artists_request, parse_word_cloud_request
+from endpoint_utils import albums_result, unique_albums, count_result, sections_count_result, submit_job_result
+from endpoint_utils import require_indexed_album, sse, progress_event, count_stream_final_event, SSE_KEEP_ALIVE
+from endpoint_utils import ArtistCountStream, JobStream
+from jobs import get_job, start_workers, JOB_POLL_INTERVAL
+from cache_utils import cache_stats
+from metrics import render_metrics, PROMETHEUS_MIMETYPE, RequestTimings, use_timings, wants_timings, with_timings, propagate_timings
+from metrics import http_request_seconds, http_requests, http_requests_in_flight
+from rate_limiter import UpstreamThrottled
+from analytics_utils import top_words_per_album, word_frequency_over_time, compare_artists, top_terms, ARROW_MIMETYPE
 from dotenv import load_dotenv
-import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
+import time
 
 load_dotenv()
 
@@ -12,51 +27,76 @@ app = Flask(__name__)
 CORS(app)
 
 
+# Request metrics; ?timings=1 also collects a per-stage breakdown for the response
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    http_requests_in_flight.inc()
+    use_timings(RequestTimings() if wants_timings(request.args.get("timings")) else None)
+
+@app.after_request
+def finish_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    http_request_seconds.observe(time.perf_counter() - g.request_started, endpoint)
+    http_requests.inc(endpoint, str(response.status_code))
+    # Streams add the breakdown to their final event instead
+    if wants_timings(request.args.get("timings")) and response.is_json and not response.is_streamed:
+        data = response.get_json()
+        if isinstance(data, dict):
+            response.set_data(app.json.dumps(with_timings(data)))
+    return response
+
+@app.teardown_request
+def end_request_metrics(error=None):
+    http_requests_in_flight.dec()
+
+
+# An upstream rate limiting us is temporary: answer 503 with its Retry-After instead of a result
+@app.errorhandler(UpstreamThrottled)
+def upstream_throttled(error):
+    result = throttled_result(error)
+    return jsonify(result), 503, {"Retry-After": str(result["retryAfter"])}
+
+# Some of an album's tracks couldn't be looked up, so it wasn't indexed: answer 502 instead of a partial count
+@app.errorhandler(AlbumIncomplete)
+def album_incomplete(error):
+    return jsonify(incomplete_result(error)), 502
+
+# A request that can't be served as sent (see endpoint_utils.RequestError)
+@app.errorhandler(RequestError)
+def request_error(error):
+    return jsonify({"error": error.message}), error.status_code
+
+
 @app.route("/albums", methods=["POST"])
 def get_albums():
     #Endpoint that retrieves album art for various albums
-    data = request.get_json()
-    artist = data.get("artist", "").strip().lower()
+    artist = parse_artist(request.get_json())
 
     artist_id = get_spotify_artist_id(artist)
     if not artist_id:
         return jsonify({"error": "Artist not found"}), 404
+    return jsonify(albums_result(get_spotify_albums(artist_id)))
 
-    albums = get_spotify_albums(artist_id)
-    if not albums:
-        return jsonify({"error": "No albums found"}), 404
+@app.route("/cache-stats", methods=["GET"])
+def get_cache_stats():
+    """Endpoint reporting hit/miss stats for the in-memory caches"""
+    return jsonify(cache_stats())
 
-    # Convert to JSON-friendly format
-    try:
-        album_map =  existing_albums
-    except Exception as e:
-        existing_albums = None
-        album_map = []
-        pass
-        
-    for album in albums.get("items", []):
-        if album.get("images"):
-            album_map.append({
-                "id": album["id"],
-                "name": album["name"],
-                "images": album["images"]  # this is already an array of {url, height, width}
-            })
-    existing_albums = album_map
-    return jsonify({"albums": album_map})
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Endpoint exposing stage timings, upstream outcomes, cache and job metrics in the Prometheus text format"""
+    return Response(render_metrics(), content_type=PROMETHEUS_MIMETYPE)
 
 @app.route("/get-lyrics", methods=["POST"])
 def get_lyrics():
     """Endpoint to fetch lyrics for a specific track"""
-    data = request.get_json()
-    artist = data.get("artist", "").strip()
-    track = data.get("track", "").strip()
-    
-    if not artist or not track:
-        return jsonify({"error": "Missing artist or track"}), 400
-    
+    artist, track = parse_lyrics_request(request.get_json())
     try:
-        lyrics, _ = get_song_info_from_genius(track, artist)
+        lyrics, _ = get_track_lyrics(track, artist)
         return jsonify({"lyrics": lyrics})
+    except UpstreamThrottled as e:
+        return upstream_throttled(e)
     except Exception as e:
         print(f"Error fetching lyrics: {e}")
         return jsonify({"lyrics": ""})
@@ -64,131 +104,163 @@ def get_lyrics():
 @app.route("/count-word-stream", methods=["POST"])
 def count_word_stream():
     """Endpoint for counting album words with real-time progress updates"""
-    data = request.get_json()
-    artist = data.get("artist", "").strip().lower()
-    album_id = data.get("albumId")
-    album_name = data.get("albumName")
-    words = data.get("words", [])
-
-    if not isinstance(words, list):
-        return jsonify({"error": "`words` must be a list"}), 400
-    
-    if not all([artist, album_id, album_name]):
-        return jsonify({"error": "Missing required parameters"}), 400
-    
+    artist, album_id, album_name, words = parse_album_request(request.get_json(), require_words=False)
+
     def generate():
-        if words:
-            word = words[0].strip().lower()
-            
-            # Check DuckDB cache first
-            cached = check_duckdb_cache(artist, album_name, word)
-            if cached:
-                count, album_art = cached
-                result = {
-                    "artist": artist,
-                    "album": album_name,
-                    "word": word,
-                    "count": count,
-                    "albumArt": album_art,
-                    "completed": True
-                }
-                yield f"data: {json.dumps(result)}\n\n"
-            else:
-                # Get tracks first to show progress
-                from spotify_utils import get_spotify_album_tracks
-                tracks = get_spotify_album_tracks(album_id)
-                if not tracks:
-                    yield f"data: {json.dumps({'error': 'No tracks found'})}\n\n"
+        if not words:
+            return
+        word_counts, album_art, missing, indexed = start_word_counts(artist, album_name, words)
+        if missing and not indexed:
+            # Only fetch lyrics when the album has never been indexed
+            ingest = iter_album_ingest(artist, album_id, album_name)
+            while True:
+                try:
+                    progress = next(ingest)
+                except StopIteration as done:
+                    indexed = done.value
+                    break
+                except UpstreamThrottled as e:
+                    yield sse(throttled_result(e))
+                    return
+                except AlbumIncomplete as e:
+                    yield sse(incomplete_result(e))
                     return
-                
-                total_tracks = len(tracks)
-                word_count = 0
-                album_art = None
-                
-                for idx, track_name in enumerate(tracks, 1):
-                    # Send progress update
-                    progress_data = {
-                        "progress": {
-                            "currentSong": track_name,
-                            "songIndex": idx,
-                            "totalSongs": total_tracks
-                        }
-                    }
-                    yield f"data: {json.dumps(progress_data)}\n\n"
-                    
-                    # Get lyrics and count
-                    from rap_genius_utils import get_song_info_from_genius, normalize_text
-                    lyrics, track_album_art = get_song_info_from_genius(track_name, artist)
-                    if lyrics:
-                        normalized_lyrics = normalize_text(lyrics)
-                        normalized_word = normalize_text(word)
-                        lyrics_words = normalized_lyrics.split()
-                        track_count = lyrics_words.count(normalized_word)
-                        word_count += track_count
-                        print(f"Track: {track_name}, Word '{word}' found {track_count} times")
-                    
-                    if track_album_art and not album_art:
-                        album_art = track_album_art
-                
-                count = word_count
-                
-                store_in_duckdb(artist, album_name, word, count, album_art)
-                
-                # Send final result
-                result = {
-                    "artist": artist,
-                    "album": album_name,
-                    "word": word,
-                    "count": count,
-                    "albumArt": album_art,
-                    "completed": True
-                }
-                yield f"data: {json.dumps(result)}\n\n"
-    
+                yield progress_event(progress)
+        result = finish_word_counts(artist, album_name, words, word_counts, album_art, missing, indexed)
+        yield count_stream_final_event(artist, album_name, result)
+
+    # No Connection header: under WSGI, keep-alive is up to the server (werkzeug closes the connection)
     return Response(generate(), mimetype='text/event-stream',
-                   headers={'Cache-Control': 'no-cache',
-                           'Connection': 'keep-alive'})
+                   headers={'Cache-Control': 'no-cache'})
 
 @app.route("/count-word", methods=["POST"])
 def count_word():
     # endpoint for counting album words 
-    data = request.get_json()
-    artist = data.get("artist", "").strip().lower()
-    album_id = data.get("albumId")
-    album_name = data.get("albumName")
-    words = data.get("words", [])
-
-    if not isinstance(words, list):
-        return jsonify({"error": "`words` must be a list"}), 400
-    
-    if not all([artist, album_id, album_name]):
-        return jsonify({"error": "Missing required parameters"}), 400
-    
-    # Process only the first word for now (frontend sends one word at a time)
-    if words:
-        word = words[0].strip().lower()
-        print(f"Processing word '{word}' for album '{album_name}' by artist '{artist}'")
-        
-        # Check DuckDB cache
-        cached = check_duckdb_cache(artist, album_name, word)
-        if cached:
-            count, album_art = cached
-            print(f"Found cached result: {count}")
-        else:
-            print("No cache found, counting from lyrics...")
-            count, album_art = count_word_occurrences(album_id, artist, word)
-            store_in_duckdb(artist, album_name, word, count, album_art)
-            print(f"Stored new result: {count}")
-    
-        return jsonify({
-            "artist": artist,
-            "album": album_name,
-            "word": word,
-            "count": count,
-            "albumArt": album_art
-        })
-    else:
-        return jsonify({"error": "No words provided"}), 400
+    artist, album_id, album_name, words = parse_album_request(request.get_json())
+
+    print(f"Processing words {words} for album '{album_name}' by artist '{artist}'")
+    result = count_result(artist, album_name, get_album_word_counts(artist, album_id, album_name, words))
+    print(f"Counts: {result['counts']}")
+    return jsonify(result)
+
+@app.route("/count-word-sections", methods=["POST"])
+def count_word_sections():
+    """Endpoint for counting album words in some sections only (e.g. verses, or one performer's parts)"""
+    artist, album_id, album_name, words, section_types, performer = parse_sections_request(request.get_json())
+
+    result = count_words_in_album_sections(artist, album_id, album_name, words, section_types, performer)
+    return jsonify(sections_count_result(artist, album_name, result, section_types, performer))
+
+@app.route("/count-word-artist", methods=["POST"])
+def count_word_artist():
+    """Endpoint for counting words across an artist's whole discography, streaming each album's result"""
+    artist, words = parse_artist_words_request(request.get_json())
+
+    artist_id = get_spotify_artist_id(artist)
+    if not artist_id:
+        return jsonify({"error": "Artist not found"}), 404
+    stream = ArtistCountStream(artist, words, unique_albums(get_spotify_albums(artist_id, DISCOGRAPHY_GROUPS)))
+
+    def generate():
+        # Load every album's track list in a few batched Spotify calls before fanning out
+        try:
+            get_spotify_albums_tracks([album["id"] for album in stream.albums])
+        except UpstreamThrottled:
+            pass  # each album loads (or reports being throttled) on its own
+
+        executor = ThreadPoolExecutor(max_workers=ALBUM_FETCH_WORKERS)
+        try:
+            futures = {
+                executor.submit(propagate_timings(get_album_word_counts), artist, album["id"], album["name"], words): album
+                for album in stream.albums
+            }
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=SSE_HEARTBEAT_SECONDS, return_when=FIRST_COMPLETED)
+                if not done:
+                    # Keep the connection alive while long albums are still being scraped
+                    yield SSE_KEEP_ALIVE
+                    continue
+                for future in done:
+                    yield stream.album_event(futures[future], future)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # Send aggregate totals
+        yield stream.totals_event()
+
+    return Response(generate(), mimetype='text/event-stream',
+                   headers={'Cache-Control': 'no-cache'})
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Endpoint that queues an album ingestion for the job workers and returns its job ID"""
+    artist, album_id, album_name = parse_job_request(request.get_json())
+    body, status_code = submit_job_result(artist, album_id, album_name)
+    return jsonify(body), status_code
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job_status(job_id):
+    """Endpoint to poll a job's status and progress"""
+    job = import_album_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/stream", methods=["GET"])
+def stream_job(job_id):
+    """Endpoint that streams a job's progress until it is imported or fails"""
+    if not get_job(job_id):
+        return jsonify({"error": "Job not found"}), 404
+
+    def generate():
+        stream = JobStream()
+        while True:
+            event = stream.event(import_album_job(job_id))
+            if event:
+                yield event
+            if stream.done:
+                return
+            time.sleep(JOB_POLL_INTERVAL)
+
+    return Response(generate(), mimetype='text/event-stream',
+                   headers={'Cache-Control': 'no-cache'})
+
+# Function to send an analytics result as columnar JSON, or as an Arrow stream when ?format=arrow
+def analytics_response(query, *args):
+    as_arrow = parse_analytics_format(request.args)
+    result = query(*args, as_arrow=as_arrow)
+    if as_arrow:
+        return Response(result, mimetype=ARROW_MIMETYPE)
+    return jsonify(result)
+
+@app.route("/analytics/top-words", methods=["POST"])
+def analytics_top_words():
+    """Endpoint for the top-N words of each indexed album of an artist"""
+    return analytics_response(top_words_per_album, *parse_top_words_request(request.get_json()))
+
+@app.route("/analytics/word-timeline", methods=["POST"])
+def analytics_word_timeline():
+    """Endpoint for word frequency per album across an artist's releases, by release date"""
+    return analytics_response(word_frequency_over_time, *parse_word_timeline_request(request.get_json()))
+
+@app.route("/analytics/compare-artists", methods=["POST"])
+def analytics_compare_artists():
+    """Endpoint comparing word usage across artists"""
+    return analytics_response(compare_artists, *parse_compare_artists_request(request.get_json()))
+
+@app.route("/word-cloud", methods=["POST"])
+def word_cloud():
+    """Endpoint for the top-K terms of an album, or of an artist's whole indexed discography, from the term index"""
+    artist, album_name, k, stopwords, min_length = parse_word_cloud_request(request.get_json())
+    require_indexed_album(artist, album_name)
+    return analytics_response(top_terms, artist, album_name, k, stopwords, min_length)
 
 if __name__ == "__main__":
+    # The debug reloader runs this module in a watcher process and again in the serving process
+    # (which has WERKZEUG_RUN_MAIN set). Only the serving process may open lyrics_cache.db, so the
+    # job importer (and JOB_WORKERS > 0 workers) start there.
+    if os.getenv("WERKZEUG_RUN_MAIN"):
+        start_job_importer()
+        start_workers(int(os.getenv("JOB_WORKERS", "0")))
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,362 @@
+# Async (ASGI) serving mode: the same endpoints and JSON/SSE contract as app.py, but lyric
+# scrapes and Spotify calls are non-blocking, so one process can hold hundreds of streams.
+# Request parsing, counting and result building are shared with app.py (endpoint_utils.py,
+# index_utils.py); only the waiting differs. DuckDB calls and CPU work run in threads.
+# Run with:  hypercorn asgi_app:app   (or: python asgi_app.py)
+import os
+import time
+import asyncio
+from quart import Quart, request, jsonify, Response, g
+from quart_cors import cors
+from async_clients import spotify_async, genius_async
+from spotify_utils import artist_id_steps, albums_steps, album_track_items_steps, albums_tracks_steps, DISCOGRAPHY_GROUPS
+from index_utils import stored_track_lyrics, save_track_lyrics, record_lyrics_error, AlbumIngest
+from index_utils import start_word_counts, finish_word_counts, lookup_section_word_counts
+from index_utils import throttled_result, incomplete_result, AlbumIncomplete, import_album_job, start_job_importer
+from index_utils import LYRICS_FETCH_WORKERS, ALBUM_FETCH_WORKERS, SSE_HEARTBEAT_SECONDS
+from duckdb_utils import get_album_index
+from endpoint_utils import RequestError, parse_artist, parse_album_request, parse_sections_request, parse_artist_words_request
+from endpoint_utils import parse_lyrics_request, parse_job_request, parse_analytics_format, parse_top_words_request
+from endpoint_utils import parse_word_timeline_request, parse_compare_artists_request, parse_word_cloud_request
+from endpoint_utils import albums_result, unique_albums, count_result, sections_count_result, submit_job_result, require_indexed_album
+from endpoint_utils import sse, progress_event, count_stream_final_event, SSE_KEEP_ALIVE, ArtistCountStream, JobStream
+from jobs import get_job, start_workers, JOB_POLL_INTERVAL
+from cache_utils import cache_stats
+from metrics import render_metrics, PROMETHEUS_MIMETYPE, RequestTimings, use_timings, wants_timings, with_timings
+from metrics import http_request_seconds, http_requests, http_requests_in_flight
+from rate_limiter import UpstreamThrottled
+from analytics_utils import top_words_per_album, word_frequency_over_time, compare_artists, top_terms, ARROW_MIMETYPE
+from singleflight import AsyncSingleFlight
+from dotenv import load_dotenv
+
+load_dotenv()
+
+app = cors(Quart(__name__))
+# SSE responses for whole discographies can legitimately run for minutes
+app.config["RESPONSE_TIMEOUT"] = None
+
+# Identical concurrent album ingestions and track lookups share one running job
+album_flights_async = AsyncSingleFlight("async-album-ingest")
+track_flights_async = AsyncSingleFlight("async-track-lyrics")
+
+
+# Request metrics; ?timings=1 also collects a per-stage breakdown for the response
+@app.before_request
+async def start_request_metrics():
+    g.request_started = time.perf_counter()
+    http_requests_in_flight.inc()
+    use_timings(RequestTimings() if wants_timings(request.args.get("timings")) else None)
+
+@app.after_request
+async def finish_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    http_request_seconds.observe(time.perf_counter() - g.request_started, endpoint)
+    http_requests.inc(endpoint, str(response.status_code))
+    # Streams add the breakdown to their final event instead
+    if wants_timings(request.args.get("timings")) and response.is_json:
+        data = await response.get_json()
+        if isinstance(data, dict):
+            response.set_data(app.json.dumps(with_timings(data)))
+    return response
+
+@app.teardown_request
+async def end_request_metrics(error=None):
+    http_requests_in_flight.dec()
+
+
+# An upstream rate limiting us is temporary: answer 503 with its Retry-After instead of a result
+@app.errorhandler(UpstreamThrottled)
+async def upstream_throttled(error):
+    result = throttled_result(error)
+    return jsonify(result), 503, {"Retry-After": str(result["retryAfter"])}
+
+# Some of an album's tracks couldn't be looked up, so it wasn't indexed: answer 502 instead of a partial count
+@app.errorhandler(AlbumIncomplete)
+async def album_incomplete(error):
+    return jsonify(incomplete_result(error)), 502
+
+# A request that can't be served as sent (see endpoint_utils.RequestError)
+@app.errorhandler(RequestError)
+async def request_error(error):
+    return jsonify({"error": error.message}), error.status_code
+
+
+# Function to get a track's lyrics, only going to Genius when they aren't stored yet (index_utils.get_track_lyrics)
+async def get_track_lyrics_async(track_name, artist_name, track_id=None):
+    stored = await asyncio.to_thread(stored_track_lyrics, track_name, artist_name, track_id)
+    if stored:
+        return stored
+    return await track_flights_async.do((artist_name.strip().lower(), track_name), _fetch_track_lyrics_async, track_name, artist_name, track_id)
+
+
+async def _fetch_track_lyrics_async(flight, track_name, artist_name, track_id):
+    try:
+        lyrics, album_art = await genius_async.search_song(track_name, artist_name)
+    except Exception as e:
+        record_lyrics_error(track_name, artist_name, e)
+        raise
+    return await asyncio.to_thread(save_track_lyrics, track_name, artist_name, track_id, lyrics, album_art)
+
+
+# Builds an album's index like index_utils._ingest_album_tracks, fetching up to LYRICS_FETCH_WORKERS
+# tracks at once. Returns the album's index entry, or None when the album has no tracks.
+async def _ingest_album_tracks_async(flight, artist_name, album_id, album_name):
+    tracks = await spotify_async.run(album_track_items_steps(album_id))
+    if not tracks:
+        return None
+
+    ingest = AlbumIngest(flight, artist_name, album_id, album_name, tracks)
+    semaphore = asyncio.Semaphore(LYRICS_FETCH_WORKERS)
+
+    async def fetch(track):
+        async with semaphore:
+            return await get_track_lyrics_async(track["name"], artist_name, track["id"])
+
+    tasks = {asyncio.ensure_future(fetch(track)): position for position, track in enumerate(tracks)}
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                ingest.add(tasks[task], task)
+    finally:
+        for task in pending:
+            task.cancel()
+    # Parsing, tokenizing and storing the album is CPU and DuckDB work, keep it off the event loop
+    return await asyncio.to_thread(ingest.finish)
+
+
+# Async version of index_utils.get_album_word_counts; progress_callback gets each track's progress dict
+async def get_album_word_counts_async(artist_name, album_id, album_name, words, progress_callback=None):
+    word_counts, album_art, missing, indexed = await asyncio.to_thread(start_word_counts, artist_name, album_name, words)
+    if missing and not indexed:
+        flight = album_flights_async.run((artist_name, album_name), _ingest_album_tracks_async, artist_name, album_id, album_name)
+        async for progress in flight.subscribe():
+            if progress_callback:
+                await progress_callback(progress)
+        indexed = await flight.wait()
+    return await asyncio.to_thread(finish_word_counts, artist_name, album_name, words, word_counts, album_art, missing, indexed)
+
+
+# Async version of index_utils.count_words_in_album_sections
+async def count_words_in_album_sections_async(artist_name, album_id, album_name, words, section_types=None, performer=None):
+    indexed = await asyncio.to_thread(get_album_index, artist_name, album_name)
+    if not indexed:
+        indexed = await album_flights_async.do((artist_name, album_name), _ingest_album_tracks_async, artist_name, album_id, album_name)
+    if not indexed:
+        return None
+    word_counts = await asyncio.to_thread(lookup_section_word_counts, artist_name, album_name, words, section_types, performer)
+    return word_counts, indexed[0]
+
+
+# Same headers as app.py: Connection is hop-by-hop and the server manages keep-alive
+SSE_HEADERS = {'Cache-Control': 'no-cache'}
+
+
+@app.route("/albums", methods=["POST"])
+async def get_albums():
+    #Endpoint that retrieves album art for various albums
+    artist = parse_artist(await request.get_json())
+
+    artist_id = await spotify_async.run(artist_id_steps(artist))
+    if not artist_id:
+        return jsonify({"error": "Artist not found"}), 404
+    return jsonify(albums_result(await spotify_async.run(albums_steps(artist_id))))
+
+@app.route("/cache-stats", methods=["GET"])
+async def get_cache_stats():
+    """Endpoint reporting hit/miss stats for the in-memory caches"""
+    return jsonify(cache_stats())
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    """Endpoint exposing stage timings, upstream outcomes, cache and job metrics in the Prometheus text format"""
+    return Response(await asyncio.to_thread(render_metrics), content_type=PROMETHEUS_MIMETYPE)
+
+@app.route("/get-lyrics", methods=["POST"])
+async def get_lyrics():
+    """Endpoint to fetch lyrics for a specific track"""
+    artist, track = parse_lyrics_request(await request.get_json())
+    try:
+        lyrics, _ = await get_track_lyrics_async(track, artist)
+        return jsonify({"lyrics": lyrics})
+    except UpstreamThrottled as e:
+        return await upstream_throttled(e)
+    except Exception as e:
+        print(f"Error fetching lyrics: {e}")
+        return jsonify({"lyrics": ""})
+
+@app.route("/count-word-stream", methods=["POST"])
+async def count_word_stream():
+    """Endpoint for counting album words with real-time progress updates"""
+    artist, album_id, album_name, words = parse_album_request(await request.get_json(), require_words=False)
+
+    async def generate():
+        if not words:
+            return
+        events = asyncio.Queue()
+
+        async def on_progress(progress):
+            await events.put(progress_event(progress))
+
+        job = asyncio.ensure_future(get_album_word_counts_async(artist, album_id, album_name, words, on_progress))
+        # None marks the end of the events, so the final result goes out as soon as the job finishes
+        job.add_done_callback(lambda _: events.put_nowait(None))
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield SSE_KEEP_ALIVE
+                    continue
+                if event is None:
+                    break
+                yield event
+            try:
+                result = job.result()
+            except UpstreamThrottled as e:
+                yield sse(throttled_result(e))
+                return
+            except AlbumIncomplete as e:
+                yield sse(incomplete_result(e))
+                return
+        finally:
+            job.cancel()
+
+        yield count_stream_final_event(artist, album_name, result)
+
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route("/count-word", methods=["POST"])
+async def count_word():
+    # endpoint for counting album words
+    artist, album_id, album_name, words = parse_album_request(await request.get_json())
+
+    result = await get_album_word_counts_async(artist, album_id, album_name, words)
+    return jsonify(count_result(artist, album_name, result))
+
+@app.route("/count-word-sections", methods=["POST"])
+async def count_word_sections():
+    """Endpoint for counting album words in some sections only (e.g. verses, or one performer's parts)"""
+    artist, album_id, album_name, words, section_types, performer = parse_sections_request(await request.get_json())
+
+    result = await count_words_in_album_sections_async(artist, album_id, album_name, words, section_types, performer)
+    return jsonify(sections_count_result(artist, album_name, result, section_types, performer))
+
+@app.route("/count-word-artist", methods=["POST"])
+async def count_word_artist():
+    """Endpoint for counting words across an artist's whole discography, streaming each album's result"""
+    artist, words = parse_artist_words_request(await request.get_json())
+
+    artist_id = await spotify_async.run(artist_id_steps(artist))
+    if not artist_id:
+        return jsonify({"error": "Artist not found"}), 404
+    stream = ArtistCountStream(artist, words, unique_albums(await spotify_async.run(albums_steps(artist_id, DISCOGRAPHY_GROUPS))))
+
+    async def generate():
+        # Load every album's track list in a few batched Spotify calls before fanning out
+        try:
+            await spotify_async.run(albums_tracks_steps([album["id"] for album in stream.albums]))
+        except UpstreamThrottled:
+            pass  # each album loads (or reports being throttled) on its own
+
+        semaphore = asyncio.Semaphore(ALBUM_FETCH_WORKERS)
+
+        async def count_album(album):
+            async with semaphore:
+                return await get_album_word_counts_async(artist, album["id"], album["name"], words)
+
+        tasks = {asyncio.ensure_future(count_album(album)): album for album in stream.albums}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=SSE_HEARTBEAT_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    yield SSE_KEEP_ALIVE
+                    continue
+                for task in done:
+                    yield stream.album_event(tasks[task], task)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        yield stream.totals_event()
+
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route("/jobs", methods=["POST"])
+async def submit_job():
+    """Endpoint that queues an album ingestion for the job workers and returns its job ID"""
+    artist, album_id, album_name = parse_job_request(await request.get_json())
+    body, status_code = await asyncio.to_thread(submit_job_result, artist, album_id, album_name)
+    return jsonify(body), status_code
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+async def get_job_status(job_id):
+    """Endpoint to poll a job's status and progress"""
+    job = await asyncio.to_thread(import_album_job, job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route("/jobs/<job_id>/stream", methods=["GET"])
+async def stream_job(job_id):
+    """Endpoint that streams a job's progress until it is imported or fails"""
+    if not await asyncio.to_thread(get_job, job_id):
+        return jsonify({"error": "Job not found"}), 404
+
+    async def generate():
+        stream = JobStream()
+        while True:
+            event = stream.event(await asyncio.to_thread(import_album_job, job_id))
+            if event:
+                yield event
+            if stream.done:
+                return
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    return Response(generate(), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+# Function to send an analytics result as columnar JSON, or as an Arrow stream when ?format=arrow
+async def analytics_response(query, *args):
+    as_arrow = parse_analytics_format(request.args)
+    result = await asyncio.to_thread(query, *args, as_arrow=as_arrow)
+    if as_arrow:
+        return Response(result, mimetype=ARROW_MIMETYPE)
+    return jsonify(result)
+
+@app.route("/analytics/top-words", methods=["POST"])
+async def analytics_top_words():
+    """Endpoint for the top-N words of each indexed album of an artist"""
+    return await analytics_response(top_words_per_album, *parse_top_words_request(await request.get_json()))
+
+@app.route("/analytics/word-timeline", methods=["POST"])
+async def analytics_word_timeline():
+    """Endpoint for word frequency per album across an artist's releases, by release date"""
+    return await analytics_response(word_frequency_over_time, *parse_word_timeline_request(await request.get_json()))
+
+@app.route("/analytics/compare-artists", methods=["POST"])
+async def analytics_compare_artists():
+    """Endpoint comparing word usage across artists"""
+    return await analytics_response(compare_artists, *parse_compare_artists_request(await request.get_json()))
+
+@app.route("/word-cloud", methods=["POST"])
+async def word_cloud():
+    """Endpoint for the top-K terms of an album, or of an artist's whole indexed discography, from the term index"""
+    artist, album_name, k, stopwords, min_length = parse_word_cloud_request(await request.get_json())
+    await asyncio.to_thread(require_indexed_album, artist, album_name)
+    return await analytics_response(top_terms, artist, album_name, k, stopwords, min_length)
+
+# Like app.py's serving process, import finished jobs (and run JOB_WORKERS > 0 workers) alongside the app
+@app.before_serving
+async def start_jobs():
+    start_job_importer()
+    start_workers(int(os.getenv("JOB_WORKERS", "0")))
+
+@app.after_serving
+async def close_clients():
+    await spotify_async.close()
+    await genius_async.close()
+
+if __name__ == "__main__":
+    app.run(debug=True)
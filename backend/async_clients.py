@@ -0,0 +1,137 @@
+# Non-blocking Spotify and Genius clients for asgi_app.py. They only do the I/O: what to request
+# and how to read the answers are the steps generators shared with the blocking clients
+# (see upstream_steps.py, spotify_utils.py and rap_genius_utils.py).
+import os
+import time
+import base64
+import asyncio
+import httpx
+from spotify_utils import SPOTIFY_TOKEN_URL, SPOTIFY_API_URL, spotify_limiter
+from rap_genius_utils import GENIUS_TIMEOUT, genius_limiter, song_page_steps, read_song_page
+from upstream_steps import run_steps_async
+from metrics import timed, record_upstream
+from rate_limiter import UpstreamThrottled
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Max Genius requests in flight across the whole async server
+GENIUS_MAX_CONCURRENCY = int(os.getenv("GENIUS_MAX_CONCURRENCY", "32"))
+
+
+class AsyncSpotifyClient:
+    """Non-blocking counterpart of spotify_utils.SpotifyClient, built on httpx.AsyncClient.
+
+    Same token lifecycle (lazy, refreshed before expiry) and retry rules, and it runs the
+    same lookups (spotify_utils' steps generators), sharing their caches and the rate limiter.
+    """
+
+    def __init__(self, client_id, client_secret, max_retries=3, refresh_margin=60, timeout=10, pool_size=100, limiter=spotify_limiter):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.max_retries = max_retries
+        self.refresh_margin = refresh_margin
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            event_hooks=limiter.async_event_hooks()
+        )
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+
+    async def get_token(self, force_refresh=False):
+        async with self._token_lock:
+            if force_refresh or not self._token or time.monotonic() >= self._token_expires_at - self.refresh_margin:
+                auth_str = f"{self.client_id}:{self.client_secret}"
+                b64_auth_str = base64.b64encode(auth_str.encode()).decode()
+                response = await self.client.post(
+                    SPOTIFY_TOKEN_URL,
+                    headers={'Authorization': f'Basic {b64_auth_str}'},
+                    data={'grant_type': 'client_credentials'}
+                )
+                if response.status_code == 200:
+                    token_response = response.json()
+                    self._token = token_response['access_token']
+                    self._token_expires_at = time.monotonic() + token_response.get('expires_in', 3600)
+                else:
+                    print(f"Failed to get token. Status code: {response.status_code}")
+                    self._token = None
+                    self._token_expires_at = 0.0
+            return self._token
+
+    async def get(self, path, params=None):
+        url = path if path.startswith("http") else f"{SPOTIFY_API_URL}{path}"
+        response = None
+        for attempt in range(self.max_retries + 1):
+            token = await self.get_token(force_refresh=response is not None and response.status_code == 401)
+            try:
+                with timed("spotify"):
+                    response = await self.client.get(url, headers={'Authorization': f'Bearer {token}'}, params=params)
+            except UpstreamThrottled as e:
+                record_upstream("spotify", error=e)
+                if attempt == self.max_retries or e.response is None:
+                    raise
+                print(f"Spotify rate limited, retrying in {e.retry_after:.1f}s")
+                continue
+            except httpx.HTTPError as e:
+                record_upstream("spotify", error=e)
+                print(f"Spotify request failed: {e}")
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(2 ** attempt * 0.5)
+                continue
+
+            record_upstream("spotify", response.status_code)
+            if response.status_code >= 500:
+                await asyncio.sleep(2 ** attempt * 0.5)
+            elif response.status_code != 401:
+                return response
+        return response
+
+    # Function to run a steps generator (see upstream_steps.py) whose requests are (path or URL, params)
+    async def run(self, steps):
+        return await run_steps_async(steps, lambda request: self.get(*request))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class AsyncGeniusClient:
+    """Non-blocking Genius search + lyric scrape (rap_genius_utils.song_page_steps), returning the
+    same (lyrics, album_art) as get_song_info_from_genius."""
+
+    def __init__(self, timeout=GENIUS_TIMEOUT, max_concurrency=GENIUS_MAX_CONCURRENCY, pool_size=100, limiter=genius_limiter):
+        self.client = httpx.AsyncClient(
+            timeout=timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            event_hooks=limiter.async_event_hooks()
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _send(self, request):
+        url, params, headers = request
+        return await self.client.get(url, params=params, headers=headers)
+
+    # Returns ("", None) when Genius has no lyrics for the song and raises when the lookup fails
+    # (UpstreamThrottled when rate limited)
+    async def search_song(self, song_name, artist_name):
+        try:
+            with timed("genius"):
+                async with self._semaphore:
+                    page, album_art = await run_steps_async(song_page_steps(song_name, artist_name), self._send)
+                # HTML parsing is CPU work, keep it off the event loop
+                lyrics, album_art = await asyncio.to_thread(read_song_page, page, album_art)
+        except Exception as e:
+            record_upstream("genius", error=e)
+            raise
+        record_upstream("genius", 200 if lyrics else 404)
+        return lyrics, album_art
+
+    async def close(self):
+        await self.client.aclose()
+
+
+spotify_async = AsyncSpotifyClient(os.getenv("SPOTIFY_CLIENT_ID"), os.getenv("Spotify_Client_Secret"))
+genius_async = AsyncGeniusClient()
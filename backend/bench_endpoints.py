@@ -0,0 +1,300 @@
+# End-to-end benchmark of /albums, /count-word and /count-word-stream against the local Spotify
+# and Genius stand-ins in bench_stubs.py, so performance changes can be checked offline.
+#
+# Each endpoint runs in a fresh process with an empty working directory (so an empty DuckDB cache
+# and empty in-memory caches): a cold pass requests every target once, then a warm pass repeats
+# requests over the same targets, both at the given concurrency. Reported per pass: latency
+# percentiles (and time to first event for streams), throughput, errors, upstream requests and
+# 429s, where server time went (from the /metrics stage histogram) and the process's memory.
+#
+#   python bench_endpoints.py --concurrency 8 --genius-latency 80 --genius-429 0.02
+#   python bench_endpoints.py --app asgi --endpoints /count-word-stream --output results.json
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from bench_stubs import StubUpstreams, build_corpus
+
+ENDPOINTS = ("/albums", "/count-word", "/count-word-stream")
+# Requested words: single words, a contraction, an accented word and a phrase from the synthetic corpus
+WORD_POOL = ["love", "money", "night", "fire", "dream", "don't", "señor", "real love", "city light", "heart"]
+REQUEST_TIMEOUT = 600
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def latency_summary(seconds):
+    if not seconds:
+        return None
+    return {
+        "p50": round(percentile(seconds, 50) * 1000, 1),
+        "p95": round(percentile(seconds, 95) * 1000, 1),
+        "p99": round(percentile(seconds, 99) * 1000, 1),
+        "max": round(max(seconds) * 1000, 1),
+        "mean": round(sum(seconds) / len(seconds) * 1000, 1),
+    }
+
+
+# Function to read this process's current and peak resident memory in MB
+def memory_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open("/proc/self/statm") as statm:
+            current = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        current = None
+    return round(current, 1) if current is not None else None, round(peak, 1)
+
+
+# Function to pull the per-stage second totals out of the server's /metrics text
+def stage_seconds(base_url):
+    totals = {}
+    for line in requests.get(f"{base_url}/metrics", timeout=30).text.splitlines():
+        if line.startswith("lyrics_stage_seconds_sum{"):
+            labels, value = line.rsplit(" ", 1)
+            totals[labels.split('stage="', 1)[1].split('"', 1)[0]] = float(value)
+    return totals
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Function to start the Flask app (threaded werkzeug server) or the ASGI app (Hypercorn) in the
+# background; returns its base URL
+def start_server(app_kind):
+    port = free_port()
+    if app_kind == "flask":
+        from werkzeug.serving import make_server
+        from app import app
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", port, app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="bench-flask", daemon=True).start()
+    else:
+        from hypercorn.config import Config
+        from hypercorn.asyncio import serve
+        from asgi_app import app
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        config.accesslog = None
+        config.loglevel = "WARNING"
+
+        def run():
+            asyncio.run(serve(app, config, shutdown_trigger=asyncio.Event().wait))
+        threading.Thread(target=run, name="bench-asgi", daemon=True).start()
+
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(200):
+        try:
+            requests.get(f"{base_url}/metrics", timeout=1)
+            return base_url
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    raise RuntimeError(f"{app_kind} server did not start")
+
+
+_sessions = threading.local()
+
+
+def session():
+    if not hasattr(_sessions, "session"):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+# Function to send one request; returns (ok, seconds, seconds to first event or None)
+def send(base_url, endpoint, payload):
+    start = time.perf_counter()
+    if endpoint != "/count-word-stream":
+        response = session().post(f"{base_url}{endpoint}", json=payload, timeout=REQUEST_TIMEOUT)
+        return response.status_code == 200, time.perf_counter() - start, None
+    first_event = None
+    ok = False
+    with session().post(f"{base_url}{endpoint}", json=payload, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            if first_event is None:
+                first_event = time.perf_counter() - start
+            event = json.loads(line[5:])
+            if "error" in event:
+                break
+            if event.get("completed"):
+                ok = True
+    return ok, time.perf_counter() - start, first_event
+
+
+# Function to run one pass: every payload sent once, `concurrency` at a time
+def run_pass(name, base_url, endpoint, payloads, concurrency, stubs):
+    upstream_before = stubs.stats_snapshot()
+    stages_before = stage_seconds(base_url)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda payload: send(base_url, endpoint, payload), payloads))
+    elapsed = time.perf_counter() - start
+    stages_after = stage_seconds(base_url)
+    upstream_after = stubs.stats_snapshot()
+    rss, peak_rss = memory_mb()
+
+    latencies = [seconds for ok, seconds, _ in results if ok]
+    first_events = [first for ok, _, first in results if ok and first is not None]
+    return {
+        "endpoint": endpoint,
+        "pass": name,
+        "requests": len(results),
+        "errors": sum(not ok for ok, _, _ in results),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(results) / elapsed, 2) if elapsed else None,
+        "latencyMs": latency_summary(latencies),
+        "firstEventMs": latency_summary(first_events),
+        "upstream": {
+            upstream: {key: upstream_after[upstream][key] - upstream_before[upstream][key] for key in counts}
+            for upstream, counts in upstream_after.items()
+        },
+        "stageSeconds": {
+            stage: round(total - stages_before.get(stage, 0.0), 3) for stage, total in sorted(stages_after.items())
+            if total - stages_before.get(stage, 0.0) > 0
+        },
+        "rssMb": rss,
+        "peakRssMb": peak_rss,
+    }
+
+
+# Function to build the cold pass (each target once) and warm pass (repeated targets) payloads
+def build_payloads(endpoint, corpus, warm_requests, seed=7):
+    rng = random.Random(seed)
+    if endpoint == "/albums":
+        targets = [{"artist": artist["name"]} for artist in corpus]
+    else:
+        targets = [
+            {"artist": artist["name"], "albumId": album["id"], "albumName": album["name"]}
+            for artist in corpus for album in artist["albums"]
+        ]
+
+    def payload(target):
+        if endpoint == "/albums":
+            return dict(target)
+        return dict(target, words=rng.sample(WORD_POOL, 3))
+
+    cold = [payload(target) for target in targets]
+    warm = [payload(targets[idx % len(targets)]) for idx in range(warm_requests)]
+    rng.shuffle(warm)
+    return cold, warm
+
+
+# Runs in a fresh process and working directory: stubs, app server, cold and warm passes
+def run_endpoint(args):
+    corpus = build_corpus(args.artists, args.albums, args.tracks)
+    stubs = StubUpstreams(
+        corpus, spotify_latency=args.spotify_latency / 1000, genius_latency=args.genius_latency / 1000,
+        spotify_throttle_rate=args.spotify_429, genius_throttle_rate=args.genius_429, retry_after=args.retry_after
+    ).start()
+    os.environ.update(stubs.env())
+    # The stand-ins don't need protecting, so upstream pacing is off unless asked for
+    os.environ.update(GENIUS_RATE_LIMIT=str(args.genius_rate), SPOTIFY_RATE_LIMIT=str(args.spotify_rate))
+    baseline_rss, _ = memory_mb()
+
+    base_url = start_server(args.app)
+    cold, warm = build_payloads(args.child, corpus, args.requests)
+    results = [
+        run_pass("cold", base_url, args.child, cold, args.concurrency, stubs),
+        run_pass("warm", base_url, args.child, warm, args.concurrency, stubs),
+    ]
+    for result in results:
+        result["baselineRssMb"] = baseline_rss
+    stubs.stop()
+    return results
+
+
+def format_row(result):
+    latency = result["latencyMs"] or {}
+    first = result["firstEventMs"] or {}
+    upstream = result["upstream"]
+    return (
+        f"{result['endpoint']:<19} {result['pass']:<5} {result['requests']:>5} {result['errors']:>4} "
+        f"{result['throughput'] or 0:>8.1f} {latency.get('p50', 0):>8.1f} {latency.get('p95', 0):>8.1f} "
+        f"{latency.get('p99', 0):>8.1f} {first.get('p50', 0) if first else '-':>8} "
+        f"{upstream['spotify']['requests']:>5}/{upstream['spotify']['throttled']:<4} "
+        f"{upstream['genius']['requests']:>5}/{upstream['genius']['throttled']:<4} "
+        f"{result['rssMb'] or 0:>7.1f} {result['peakRssMb']:>7.1f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark against local Spotify/Genius stand-ins")
+    parser.add_argument("--app", choices=("flask", "asgi"), default="flask")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--requests", type=int, default=200, help="requests in the warm pass")
+    parser.add_argument("--artists", type=int, default=3)
+    parser.add_argument("--albums", type=int, default=4, help="albums per artist")
+    parser.add_argument("--tracks", type=int, default=12, help="tracks per album")
+    parser.add_argument("--spotify-latency", type=float, default=30, help="ms per Spotify request")
+    parser.add_argument("--genius-latency", type=float, default=80, help="ms per Genius request")
+    parser.add_argument("--spotify-429", type=float, default=0.0, help="share of Spotify requests answered with 429")
+    parser.add_argument("--genius-429", type=float, default=0.0, help="share of Genius requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--genius-rate", type=float, default=0, help="app's Genius rate limit in req/s (0 = unpaced)")
+    parser.add_argument("--spotify-rate", type=float, default=0, help="app's Spotify rate limit in req/s (0 = unpaced)")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own output")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open("bench_result.json", "w") as result_file:
+            json.dump(run_endpoint(args), result_file)
+        return 0
+
+    results = []
+    for endpoint in args.endpoints:
+        with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--child", endpoint],
+                cwd=workdir, stdout=None if args.verbose else subprocess.DEVNULL
+            )
+            result_path = os.path.join(workdir, "bench_result.json")
+            if child.returncode != 0 or not os.path.exists(result_path):
+                print(f"{endpoint}: benchmark run failed (exit code {child.returncode})")
+                continue
+            with open(result_path) as result_file:
+                results.extend(json.load(result_file))
+
+    print(f"app={args.app} concurrency={args.concurrency} corpus={args.artists}x{args.albums}x{args.tracks} "
+          f"latency spotify={args.spotify_latency}ms genius={args.genius_latency}ms "
+          f"429 spotify={args.spotify_429} genius={args.genius_429}")
+    print(f"{'endpoint':<19} {'pass':<5} {'reqs':>5} {'err':>4} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'1st ev':>8} {'spotify/429':>10} {'genius/429':>10} {'rss MB':>7} {'peak':>7}")
+    for result in results:
+        print(format_row(result))
+    for result in results:
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in result["stageSeconds"].items())
+        print(f"  {result['endpoint']} {result['pass']}: {stages or 'no stage time'}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"config": {key: value for key, value in vars(args).items() if key not in ("child", "output")},
+                       "results": results}, output, indent=2)
+    return 0 if len(results) == 2 * len(args.endpoints) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
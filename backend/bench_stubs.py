@@ -0,0 +1,321 @@
+# Local stand-ins for the Spotify and Genius APIs, serving a synthetic multi-artist lyric corpus,
+# so the backend can be benchmarked offline. Both upstreams answer on one port under their own
+# prefix; point the app at them with stub_env(). Each upstream can add latency (with jitter) and
+# answer a share of requests with 429 + Retry-After.
+#
+#   python bench_stubs.py --port 8900 --genius-latency 80 --genius-429 0.05
+#
+# and run the app with the printed environment variables to try it by hand.
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from bench_tokenizer import synthetic_corpus
+
+SPOTIFY_PREFIX = "/spotify"
+GENIUS_API_PREFIX = "/genius-api"
+GENIUS_WEB_PREFIX = "/genius"
+
+ALBUM_WORDS = "Midnight Gold Electric Paper Neon Silent Velvet Broken Summer Northern Hollow Crystal".split()
+TRACK_WORDS = "Fire Rain Highway Ghost Heart River Echo Crown Shadow Signal Motion Letter Garden Static".split()
+
+
+def _slug(text):
+    return "-".join(text.lower().split())
+
+
+def _stable_id(prefix, *parts):
+    return prefix + hashlib.sha1("/".join(parts).encode()).hexdigest()[:16]
+
+
+# Function to build a deterministic corpus: artists -> albums -> tracks with lyrics. A share of the
+# tracks are instrumentals (Genius has no lyrics for them), to exercise the no-lyrics path.
+def build_corpus(artists=3, albums_per_artist=4, tracks_per_album=12, lines_per_song=60, instrumental_share=0.05, seed=7):
+    rng = random.Random(seed)
+    lyrics = iter(synthetic_corpus(artists * albums_per_artist * tracks_per_album, lines_per_song, seed))
+    corpus = []
+    for artist_idx in range(1, artists + 1):
+        artist_name = f"Bench Artist {artist_idx}"
+        artist = {"id": _stable_id("ar", artist_name), "name": artist_name, "albums": []}
+        for album_idx in range(1, albums_per_artist + 1):
+            album_name = f"{rng.choice(ALBUM_WORDS)} {rng.choice(ALBUM_WORDS)} {album_idx}"
+            album = {
+                "id": _stable_id("al", artist_name, album_name),
+                "name": album_name,
+                "release_date": f"{2000 + album_idx * 2 + artist_idx}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+                "images": [{"url": f"https://images.invalid/{_slug(album_name)}.jpg", "height": 640, "width": 640}],
+                "tracks": []
+            }
+            for track_idx in range(1, tracks_per_album + 1):
+                track_name = f"{rng.choice(TRACK_WORDS)} {rng.choice(TRACK_WORDS)} {album_idx}-{track_idx}"
+                album["tracks"].append({
+                    "id": _stable_id("tr", artist_name, album_name, track_name),
+                    "name": track_name,
+                    "lyrics": next(lyrics),
+                    "instrumental": rng.random() < instrumental_share
+                })
+            artist["albums"].append(album)
+        corpus.append(artist)
+    return corpus
+
+
+class UpstreamStats:
+    """Request, 429 and error counts of one stub upstream."""
+
+    def __init__(self):
+        self.requests = 0
+        self.throttled = 0
+        self.not_found = 0
+        self._lock = threading.Lock()
+
+    def record(self, status):
+        with self._lock:
+            self.requests += 1
+            self.throttled += status == 429
+            self.not_found += status == 404
+
+    def snapshot(self):
+        with self._lock:
+            return {"requests": self.requests, "throttled": self.throttled, "notFound": self.not_found}
+
+
+class StubUpstreams:
+    """Spotify and Genius stand-ins on one local HTTP server.
+
+    latency is in seconds per request (plus up to `jitter` of that again, at random) and
+    throttle_rate is the share of requests answered with 429 and a Retry-After of retry_after.
+    """
+
+    def __init__(self, corpus, host="127.0.0.1", port=0, spotify_latency=0.03, genius_latency=0.08, jitter=0.5,
+                 spotify_throttle_rate=0.0, genius_throttle_rate=0.0, retry_after=1, seed=7):
+        self.corpus = corpus
+        self.settings = {
+            "spotify": (spotify_latency, spotify_throttle_rate),
+            "genius": (genius_latency, genius_throttle_rate),
+        }
+        self.jitter = jitter
+        self.retry_after = retry_after
+        self.stats = {"spotify": UpstreamStats(), "genius": UpstreamStats()}
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+        self.artists_by_name = {artist["name"].lower(): artist for artist in corpus}
+        self.albums = {album["id"]: (artist, album) for artist in corpus for album in artist["albums"]}
+        self.songs = {}
+        self.songs_by_query = {}
+        self.songs_by_slug = {}
+        for artist in corpus:
+            for album in artist["albums"]:
+                for track in album["tracks"]:
+                    song = self._genius_song(artist, album, track)
+                    self.songs[song["id"]] = (song, track)
+                    self.songs_by_query[f"{track['name']} {artist['name']}".lower()] = song
+                    self.songs_by_slug[song["path"].lstrip("/")] = track
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address[:2]
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    # Environment variables that point the backend at these stubs
+    def env(self):
+        return {
+            "SPOTIFY_API_URL": f"{self.base_url}{SPOTIFY_PREFIX}/v1",
+            "SPOTIFY_TOKEN_URL": f"{self.base_url}{SPOTIFY_PREFIX}/api/token",
+            "SPOTIFY_CLIENT_ID": "bench",
+            "Spotify_Client_Secret": "bench",
+            "GENIUS_API_URL": f"{self.base_url}{GENIUS_API_PREFIX}",
+            "GENIUS_WEB_URL": f"{self.base_url}{GENIUS_WEB_PREFIX}",
+            "GENIUS_ACCESS_TOKEN": "bench",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="bench-stubs", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats_snapshot(self):
+        return {upstream: stats.snapshot() for upstream, stats in self.stats.items()}
+
+    def _genius_song(self, artist, album, track):
+        slug = f"{_slug(artist['name'])}-{_slug(track['name'])}-lyrics"
+        return {
+            "id": int(track["id"][2:10], 16),
+            "title": track["name"],
+            "full_title": f"{track['name']} by {artist['name']}",
+            "primary_artist": {"name": artist["name"]},
+            "url": f"https://genius.com/{slug}",
+            "path": f"/{slug}",
+            "lyrics_state": "complete",
+            "instrumental": track["instrumental"],
+            "song_art_image_url": album["images"][0]["url"],
+        }
+
+    # Function to decide how a request is answered: sleeps for the latency, returns True when it gets a 429
+    def _delay_and_throttle(self, upstream):
+        latency, throttle_rate = self.settings[upstream]
+        with self._rng_lock:
+            delay = latency * (1 + self.jitter * self._rng.random())
+            throttled = self._rng.random() < throttle_rate
+        if delay:
+            time.sleep(delay)
+        return throttled
+
+    def _spotify_album(self, album, with_tracks=False):
+        result = {key: album[key] for key in ("id", "name", "release_date", "images")}
+        if with_tracks:
+            result["tracks"] = self._page([self._spotify_track(track) for track in album["tracks"]], 0, 50, None)
+        return result
+
+    @staticmethod
+    def _spotify_track(track):
+        return {"id": track["id"], "name": track["name"]}
+
+    def _page(self, items, offset, limit, url):
+        page = items[offset:offset + limit]
+        has_next = url is not None and offset + limit < len(items)
+        return {
+            "items": page,
+            "total": len(items),
+            "next": f"{url}?offset={offset + limit}&limit={limit}" if has_next else None
+        }
+
+    def spotify(self, method, path, query):
+        if path == "/api/token":
+            return 200, {"access_token": "bench-token", "token_type": "Bearer", "expires_in": 3600}
+        if path == "/v1/search":
+            artist = self.artists_by_name.get(query.get("q", "").strip().lower())
+            return 200, {"artists": {"items": [{"id": artist["id"], "name": artist["name"]}] if artist else []}}
+        parts = path.strip("/").split("/")
+        offset, limit = int(query.get("offset", 0)), int(query.get("limit", 20))
+        if parts[:2] == ["v1", "artists"] and len(parts) == 4 and parts[3] == "albums":
+            artist = next((artist for artist in self.corpus if artist["id"] == parts[2]), None)
+            if artist is None:
+                return 404, {"error": {"status": 404, "message": "Not found"}}
+            albums = [self._spotify_album(album) for album in artist["albums"]]
+            return 200, self._page(albums, offset, limit, f"{self.base_url}{SPOTIFY_PREFIX}{path}")
+        if parts[:2] == ["v1", "albums"] and len(parts) == 4 and parts[3] == "tracks":
+            if parts[2] not in self.albums:
+                return 404, {"error": {"status": 404, "message": "Not found"}}
+            tracks = [self._spotify_track(track) for track in self.albums[parts[2]][1]["tracks"]]
+            return 200, self._page(tracks, offset, limit, f"{self.base_url}{SPOTIFY_PREFIX}{path}")
+        if parts == ["v1", "albums"]:
+            ids = [album_id for album_id in query.get("ids", "").split(",") if album_id]
+            return 200, {"albums": [
+                self._spotify_album(self.albums[album_id][1], with_tracks=True) if album_id in self.albums else None
+                for album_id in ids
+            ]}
+        return 404, {"error": {"status": 404, "message": "Not found"}}
+
+    def genius_api(self, method, path, query):
+        if path == "/search":
+            song = self.songs_by_query.get(query.get("q", "").strip().lower())
+            return 200, {"meta": {"status": 200}, "response": {"hits": [{"index": "song", "type": "song", "result": song}] if song else []}}
+        parts = path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "songs" and parts[1].isdigit() and int(parts[1]) in self.songs:
+            return 200, {"meta": {"status": 200}, "response": {"song": self.songs[int(parts[1])][0]}}
+        return 404, {"meta": {"status": 404}}
+
+    def genius_web(self, method, path, query):
+        if path == "/api/search/multi":
+            song = self.songs_by_query.get(query.get("q", "").strip().lower())
+            hits = [{"index": "song", "type": "song", "result": song}] if song else []
+            return 200, {"meta": {"status": 200}, "response": {"sections": [{"type": "song", "hits": hits}]}}
+        track = self.songs_by_slug.get(path.lstrip("/"))
+        if track is None:
+            return 404, "<html><body>Page not found</body></html>"
+        lines = "<br/>".join(line.replace("&", "&amp;").replace("<", "&lt;") for line in track["lyrics"].split("\n"))
+        return 200, f'<html><body><div data-lyrics-container="true">{lines}</div></body></html>'
+
+    def _handler_class(self):
+        stubs = self
+        routes = (
+            (SPOTIFY_PREFIX, "spotify", stubs.spotify),
+            (GENIUS_API_PREFIX, "genius", stubs.genius_api),
+            (GENIUS_WEB_PREFIX, "genius", stubs.genius_web),
+        )
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self):
+                url = urlsplit(self.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                if self.headers.get("Content-Length"):
+                    body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+                    query.update({key: values[-1] for key, values in parse_qs(body).items()})
+                for prefix, upstream, route in routes:
+                    if url.path.startswith(prefix + "/"):
+                        break
+                else:
+                    return self._send(404, {"error": "unknown upstream"})
+                if stubs._delay_and_throttle(upstream):
+                    stubs.stats[upstream].record(429)
+                    return self._send(429, {"error": "rate limited"}, {"Retry-After": str(stubs.retry_after)})
+                status, payload = route(self.command, url.path[len(prefix):], query)
+                stubs.stats[upstream].record(status)
+                self._send(status, payload)
+
+            def _send(self, status, payload, headers=None):
+                if isinstance(payload, str):
+                    body, content_type = payload.encode(), "text/html; charset=utf-8"
+                else:
+                    body, content_type = json.dumps(payload).encode(), "application/json"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = _respond
+            do_POST = _respond
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve local Spotify/Genius stand-ins with a synthetic corpus")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--artists", type=int, default=3)
+    parser.add_argument("--albums", type=int, default=4, help="albums per artist")
+    parser.add_argument("--tracks", type=int, default=12, help="tracks per album")
+    parser.add_argument("--spotify-latency", type=float, default=30, help="ms per Spotify request")
+    parser.add_argument("--genius-latency", type=float, default=80, help="ms per Genius request")
+    parser.add_argument("--spotify-429", type=float, default=0.0, help="share of Spotify requests answered with 429")
+    parser.add_argument("--genius-429", type=float, default=0.0, help="share of Genius requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429s")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.artists, args.albums, args.tracks)
+    stubs = StubUpstreams(
+        corpus, port=args.port, spotify_latency=args.spotify_latency / 1000, genius_latency=args.genius_latency / 1000,
+        spotify_throttle_rate=args.spotify_429, genius_throttle_rate=args.genius_429, retry_after=args.retry_after
+    )
+    for name, value in stubs.env().items():
+        print(f"export {name}='{value}'")
+    print("# artists: " + ", ".join(artist["name"] for artist in corpus))
+    try:
+        stubs.server.serve_forever()
+    except KeyboardInterrupt:
+        stubs.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# Micro-benchmark for the tokenizer: tokens/sec over a large lyric corpus, compared with the old
+# two-pass regex normalizer. Uses the stored lyrics in lyrics_cache.db with --db, otherwise a
+# synthetic corpus. The tokenizer is first checked against known cases (see CASES).
+#
+#   python bench_tokenizer.py --songs 5000
+#   python bench_tokenizer.py --db lyrics_cache.db
+import re
+import sys
+import time
+import random
+import argparse
+import unicodedata
+from collections import Counter
+from tokenizer import Tokenizer, tokenize
+
+WORDS = (
+    "yeah baby real love money night city light fire heart dream street game time life world "
+    "gold crown queen king shadow river highway echo señor café naïve déjà über mañana straße "
+    "don't can't I'm we're they'll y'all rock'n'roll well-known twenty-one ride-or-die "
+    "ДОБРО любовь 東京 夢 amor corazón नमस्ते दुनिया"
+).split() + [unicodedata.normalize("NFD", word) for word in ("señor", "corazón", "naïve")]
+
+# (text, expected tokens with the default join/join rules)
+CASES = [
+    ("Don't stop, well-known", ["dont", "stop", "wellknown"]),
+    ("Straße CAFÉ", ["strasse", "café"]),
+    # Combining marks (virama, vowel signs) stay inside the word
+    ("नमस्ते दुनिया", ["नमस्ते", "दुनिया"]),
+    # Decomposed accents tokenize like precomposed ones
+    (unicodedata.normalize("NFD", "señor naïve"), ["señor", "naïve"]),
+    ("東京 夢 ДОБРО", ["東京", "夢", "добро"]),
+    ("foo_bar", ["foo", "bar"]),
+]
+PUNCTUATION = ["", "", "", ",", ".", "!", "?", "..."]
+
+
+# Function to build a synthetic corpus of songs with a lyric-like mix of words, punctuation and section headers
+def synthetic_corpus(songs, lines_per_song=60, seed=7):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(songs):
+        lines = ["[Verse 1]"]
+        for idx in range(lines_per_song):
+            if idx and idx % 16 == 0:
+                lines.append(rng.choice(["[Chorus]", "[Verse 2]", "[Bridge]"]))
+            words = [rng.choice(WORDS).capitalize() if rng.random() < 0.1 else rng.choice(WORDS) for _ in range(rng.randint(5, 10))]
+            lines.append(" ".join(words) + rng.choice(PUNCTUATION))
+        corpus.append("\n".join(lines))
+    return corpus
+
+
+def db_corpus(db_path):
+    import duckdb
+    con = duckdb.connect(db_path, read_only=True)
+    try:
+        return [row[0] for row in con.execute("SELECT Lyrics FROM lyrics WHERE Lyrics <> ''").fetchall()]
+    finally:
+        con.close()
+
+
+# The normalizer this tokenizer replaced: two re.sub passes, then a split
+def legacy_tokens(text):
+    text = text.lower()
+    text = re.sub(r'[^a-z0-9\s]', '', text)
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.split()
+
+
+def bench(name, tokenize, corpus, repeat):
+    best = None
+    tokens = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        counts = Counter()
+        for text in corpus:
+            counts.update(tokenize(text))
+        elapsed = time.perf_counter() - start
+        tokens = sum(counts.values())
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<28} {tokens:>10} tokens  {best:7.3f}s  {tokens / best:>12,.0f} tokens/sec")
+
+
+# Function to check the tokenizer against CASES; returns the failures as (text, expected, got)
+def check_cases():
+    return [(text, expected, tokenize(text)) for text, expected in CASES if tokenize(text) != expected]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenizer throughput micro-benchmark")
+    parser.add_argument("--songs", type=int, default=2000, help="synthetic songs to generate")
+    parser.add_argument("--db", help="benchmark the lyrics stored in this DuckDB file instead")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per tokenizer (best is reported)")
+    args = parser.parse_args()
+
+    failures = check_cases()
+    for text, expected, got in failures:
+        print(f"Tokenizer mismatch for {text!r}: expected {expected}, got {got}")
+    if failures:
+        sys.exit(1)
+
+    corpus = db_corpus(args.db) if args.db else synthetic_corpus(args.songs)
+    print(f"Corpus: {len(corpus)} songs, {sum(len(text) for text in corpus) / 1e6:.1f}M characters")
+    bench("legacy re.sub x2 + split", legacy_tokens, corpus, args.repeat)
+    for contractions, hyphens in [("join", "join"), ("keep", "keep"), ("split", "split")]:
+        tokenizer = Tokenizer(contractions, hyphens)
+        bench(f"iter_tokens {contractions}/{hyphens}", tokenizer.iter_tokens, corpus, args.repeat)
+        bench(f"tokenize {contractions}/{hyphens}", tokenizer.tokenize, corpus, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from metrics import register_collector
+
+# Global memory budget (approximate) shared by all in-process caches
+MEMORY_CACHE_MAX_MB = float(os.getenv("MEMORY_CACHE_MAX_MB", "64"))
+
+# Every cache registers itself here so stats can be reported in one place
+CACHES = {}
+
+
+# Function to roughly estimate how much memory a cached value takes
+def approx_size(value):
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(approx_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class TTLCache:
+    """Bounded in-memory cache with per-entry TTL and LRU eviction.
+
+    Entries are evicted least-recently-used first once either max_entries or
+    max_bytes is exceeded. Expired entries count as misses.
+    """
+
+    def __init__(self, name, max_entries=1024, ttl=300, max_bytes=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        CACHES[name] = self
+
+    # Returns (True, value) on a hit and (False, None) on a miss
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            expires_at, size, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        size = approx_size(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, value)
+            self._bytes += size
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)
+            ):
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    # Remove every entry whose key matches predicate(key); returns how many were removed
+    def delete_where(self, predicate):
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._bytes -= self._entries.pop(key)[1]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "approxBytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "ttlSeconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRatio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+# Decorator that caches a function's result by its arguments; None results (failures) are not cached
+def cached(cache):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            found, value = cache.get(args)
+            if found:
+                return value
+            value = func(*args)
+            if value is not None:
+                cache.set(args, value)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+# Function to report hit/miss stats for every cache
+def cache_stats():
+    return {name: cache.stats() for name, cache in CACHES.items()}
+
+
+@register_collector
+def cache_metrics():
+    stats = cache_stats()
+    families = [
+        ("lyrics_cache_hits_total", "counter", "In-memory cache hits", "hits"),
+        ("lyrics_cache_misses_total", "counter", "In-memory cache misses (including expired entries)", "misses"),
+        ("lyrics_cache_evictions_total", "counter", "Entries evicted to stay within the cache's bounds", "evictions"),
+        ("lyrics_cache_entries", "gauge", "Entries currently cached", "entries"),
+        ("lyrics_cache_bytes", "gauge", "Approximate memory used by cached values", "approxBytes"),
+        ("lyrics_cache_hit_ratio", "gauge", "Hits / lookups since start", "hitRatio"),
+    ]
+    return [
+        (name, metric_type, documentation, [({"cache": cache}, cache_stats[field]) for cache, cache_stats in stats.items()])
+        for name, metric_type, documentation, field in families
+    ]
+
+
+# Split the memory budget between the caches (count results are small, track lists and albums bigger)
+_max_bytes = int(MEMORY_CACHE_MAX_MB * 1024 * 1024)
+
+artist_id_cache = TTLCache(
+    "artist_ids",
+    max_entries=int(os.getenv("ARTIST_CACHE_MAX_ENTRIES", "2048")),
+    ttl=float(os.getenv("ARTIST_CACHE_TTL", "86400")),
+    max_bytes=_max_bytes // 16
+)
+album_list_cache = TTLCache(
+    "album_lists",
+    max_entries=int(os.getenv("ALBUM_CACHE_MAX_ENTRIES", "512")),
+    ttl=float(os.getenv("ALBUM_CACHE_TTL", "3600")),
+    max_bytes=_max_bytes * 3 // 8
+)
+track_list_cache = TTLCache(
+    "track_lists",
+    max_entries=int(os.getenv("TRACK_CACHE_MAX_ENTRIES", "2048")),
+    ttl=float(os.getenv("TRACK_CACHE_TTL", "86400")),
+    max_bytes=_max_bytes * 3 // 8
+)
+# Tracks whose Genius lookup just failed (errors, not "no lyrics"); kept briefly so a flaky
+# track isn't retried by every request, but never persisted
+lyrics_error_cache = TTLCache(
+    "lyrics_errors",
+    max_entries=int(os.getenv("LYRICS_ERROR_CACHE_MAX_ENTRIES", "4096")),
+    ttl=float(os.getenv("LYRICS_ERROR_TTL", "300"))
+)
+count_cache = TTLCache(
+    "counts",
+    max_entries=int(os.getenv("COUNT_CACHE_MAX_ENTRIES", "50000")),
+    ttl=float(os.getenv("COUNT_CACHE_TTL", "3600")),
+    max_bytes=_max_bytes // 8
+)
@@ -0,0 +1,42 @@
+# Compaction CLI for lyrics_cache.db: deletes expired negative entries (tracks without lyrics),
+# cached counts of albums whose index has expired or is outdated, and dictionary rows nothing refers
+# to any more, then rewrites the file so the space they took is given back. Opening the database also migrates one written with the
+# original denormalized tables.
+#
+# Stop the app first; DuckDB lets only one process open the file for writing.
+#   python compact_db.py
+#   python compact_db.py --no-purge   # only rewrite the file
+import sys
+import argparse
+from duckdb_utils import DB_PATH, get_cursor, purge_expired, compact_database
+
+# Tables whose row counts are reported
+REPORTED_TABLES = (
+    "artists", "albums", "tracks", "terms", "word_counts", "lyrics", "album_index",
+    "album_term_counts", "track_term_counts", "sections", "section_term_counts",
+)
+
+
+# Function to count the rows of each reported table
+def table_rows():
+    con = get_cursor()
+    return {table: con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in REPORTED_TABLES}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Purge expired entries from lyrics_cache.db and compact the file")
+    parser.add_argument("--no-purge", action="store_true", help="keep expired entries; only rewrite the file")
+    args = parser.parse_args(argv)
+
+    if not args.no_purge:
+        for name, deleted in purge_expired().items():
+            print(f"Deleted {deleted} {name}")
+    size_before, size_after = compact_database()
+    for table, rows in table_rows().items():
+        print(f"{table:<22}{rows:>12,} rows")
+    print(f"{DB_PATH}: {size_before / 1024:,.0f} KB -> {size_after / 1024:,.0f} KB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,61 +1,960 @@
 import requests
-import pandas as pd
 from io import BytesIO
 import base64
 import duckdb 
 import os
-from datetime import datetime
+import atexit
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from cache_utils import count_cache
+from tokenizer import tokenizer_version
+from metrics import timed, timed_stage, register_collector
 
 
 
 
-# Initialize an empty DataFrame to store results
-df = pd.DataFrame(columns=['Datetime','Artist', 'Album', 'Word', 'Count', 'Album Art'])
+# Duck DB Database for faster retrieval
+DB_PATH = './lyrics_cache.db'
 
+# How long a track Genius has no lyrics for (stored as a row with empty lyrics) is trusted before it
+# is looked up again. An album indexed with such tracks expires after as long, so it is re-ingested
+# (only those tracks are fetched again) and its counts are rebuilt.
+NO_LYRICS_TTL = float(os.getenv("NO_LYRICS_TTL", str(7 * 86400)))
 
-# Duck DB Database for faster retrieval
-con = duckdb.connect(database=r'./lyrics_cache.db')  # Persistent DuckDB database
-con.execute('''
-    CREATE TABLE IF NOT EXISTS counts (
-    Datetime TIMESTAMP,        
+# Version of what an album's index holds, stored with it along with the tokenizer's version. Bump it
+# whenever that changes; albums indexed under another version (or another tokenizer) count as not
+# indexed, so they are re-ingested from their stored lyrics and their counts rebuilt.
+#   1 (or none): album and track term counts (section headers counted as words)
+#   2: section headers left out of the counts, parsed sections stored
+INDEX_VERSION = 2
+# Condition (on indexed_albums) for an album's index to be served, and its parameters
+CURRENT_INDEX = "Index_Version = ? AND Tokenizer_Version = ? AND (Expires_At IS NULL OR Expires_At > ?)"
+
+
+def _current_index_params():
+    return [INDEX_VERSION, tokenizer_version, datetime.now()]
+
+# One long-lived connection per process. Each thread reads through its own cursor
+# (DuckDB cursors are independent connections to the same database), and all writes
+# go through a single lock so only one writer runs at a time.
+#
+# The connection is opened on first use, not at import: DuckDB locks the file for the process
+# that opens it, so importing this module (e.g. in the watcher process of Flask's debug
+# reloader) must not take the lock away from the process that serves requests.
+_connection = None
+_connection_lock = threading.Lock()
+_write_lock = threading.Lock()
+_local = threading.local()
+
+
+# Function to get the shared DuckDB connection, opening it (and creating the schema) on first use
+def get_connection():
+    global _connection
+    if _connection is None:
+        with _connection_lock:
+            if _connection is None:
+                connection = duckdb.connect(database=DB_PATH)  # Persistent DuckDB database
+                init_schema(connection)
+                _connection = connection
+    return _connection
+
+
+# Function to get this thread's cursor on the shared connection. A cursor left over from a
+# connection that has since been closed (see close_connection) is replaced.
+def get_cursor():
+    connection = get_connection()
+    if getattr(_local, "connection", None) is not connection:
+        _local.cursor = connection.cursor()
+        _local.connection = connection
+    return _local.cursor
+
+
+# Context manager for the serialized writer; wraps the writes in one transaction.
+# Every DuckDB write goes through here, so this is where write time (lock wait included) is measured.
+@contextmanager
+def write_cursor():
+    with timed("duckdb_write"), _write_lock:
+        cursor = get_cursor()
+        cursor.execute("BEGIN TRANSACTION")
+        try:
+            yield cursor
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+
+
+# Function to close the shared connection (e.g. on shutdown or before compaction). Every
+# thread's cursor belongs to it, so each thread opens a new cursor on its next get_cursor().
+def close_connection():
+    global _connection
+    with _connection_lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+
+
+# Storage is normalized so it stays small and scan-fast at millions of rows: artist, album and track
+# names are stored once in dictionary tables and referenced by integer keys, and every count, term
+# and requested word is an integer Term_Id into `terms`. Album art lives on the album row instead of
+# being repeated per word. Tables have no indexes (an index costs a 256 KB block at minimum and
+# slows bulk inserts): keys are only assigned inside write_cursor(), which keeps them unique, and
+# rows are written one album at a time and re-sorted by compaction, so DuckDB's per-block min/max
+# pruning finds an album's rows or a term without an index.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS artists (
+    Artist_Key INTEGER NOT NULL,
+    Artist TEXT NOT NULL
+)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS albums (
+    Album_Key INTEGER NOT NULL,
+    Artist_Key INTEGER NOT NULL,
+    Album TEXT NOT NULL,
+    Album_Art TEXT
+)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tracks (
+    Track_Key INTEGER NOT NULL,
+    Album_Key INTEGER NOT NULL,
+    Track TEXT NOT NULL,
+    Track_Number INTEGER
+)
+    """,
+    # Tracks are keyed by their position on the album as well as their name, since an album can
+    # list two tracks with the same title. Tracks indexed before positions were stored have none.
+    "ALTER TABLE tracks ADD COLUMN IF NOT EXISTS Track_Number INTEGER",
+    """
+    CREATE TABLE IF NOT EXISTS terms (
+    Term_Id INTEGER NOT NULL,
+    Term TEXT NOT NULL
+)
+    """,
+    # Cached word counts per album, computed from the album's index and dropped whenever it is rebuilt
+    """
+    CREATE TABLE IF NOT EXISTS word_counts (
+    Album_Key INTEGER NOT NULL,
+    Term_Id INTEGER NOT NULL,
+    Count INTEGER
+)
+    """,
+    "ALTER TABLE word_counts DROP COLUMN IF EXISTS Datetime",
+    # Per-track lyrics store so an album is only scraped from Genius once
+    """
+    CREATE TABLE IF NOT EXISTS lyrics (
+    Datetime TIMESTAMP,
     Artist TEXT,
-    Album TEXT,
-    Word TEXT,
-    Count INTEGER,
+    Track TEXT,
+    Track_Id TEXT,
+    Lyrics TEXT,
     Album_Art TEXT,
-    PRIMARY KEY (Artist, Album, Word)
+    PRIMARY KEY (Artist, Track)
+)
+    """,
+    # Lyrics are tokenized when an album is indexed (the sections hold the tokens), so no normalized
+    # copy is kept; it would also go stale whenever the tokenizer changes
+    "ALTER TABLE lyrics DROP COLUMN IF EXISTS Normalized_Lyrics",
+    # One row per album whose token index is complete. Expires_At is set when some tracks had no
+    # lyrics (see NO_LYRICS_TTL); the album counts as not indexed after it, as it does when it was
+    # indexed under another INDEX_VERSION or tokenizer version.
+    """
+    CREATE TABLE IF NOT EXISTS album_index (
+    Album_Key INTEGER NOT NULL,
+    Datetime TIMESTAMP,
+    Album_Id TEXT,
+    Track_Count INTEGER,
+    Release_Date TEXT,
+    Expires_At TIMESTAMP,
+    Index_Version INTEGER,
+    Tokenizer_Version TEXT
+)
+    """,
+    "ALTER TABLE album_index ADD COLUMN IF NOT EXISTS Expires_At TIMESTAMP",
+    "ALTER TABLE album_index ADD COLUMN IF NOT EXISTS Index_Version INTEGER",
+    "ALTER TABLE album_index ADD COLUMN IF NOT EXISTS Tokenizer_Version TEXT",
+    # Inverted token index: term counts per album and per track, built once per album
+    """
+    CREATE TABLE IF NOT EXISTS album_term_counts (
+    Album_Key INTEGER NOT NULL,
+    Term_Id INTEGER NOT NULL,
+    Count INTEGER
+)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS track_term_counts (
+    Track_Key INTEGER NOT NULL,
+    Term_Id INTEGER NOT NULL,
+    Count INTEGER
+)
+    """,
+    # Parsed song sections (headers removed) and their term counts, so counts can be limited to
+    # section types or performers without reparsing lyrics
+    """
+    CREATE TABLE IF NOT EXISTS sections (
+    Track_Key INTEGER NOT NULL,
+    Section_Index INTEGER NOT NULL,
+    Section_Type TEXT,
+    Performers VARCHAR[],
+    Normalized_Text TEXT
 )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS section_term_counts (
+    Track_Key INTEGER NOT NULL,
+    Section_Index INTEGER NOT NULL,
+    Term_Id INTEGER NOT NULL,
+    Count INTEGER
+)
+    """,
+]
+
+# Views under the names (and columns) of the original denormalized tables, so lookups and
+# analytics queries read by artist/album/term name. DuckDB inlines views, so filters on the
+# names are pushed down to the small dictionary tables before the fact tables are joined.
+VIEWS = {
+    "counts": """
+        SELECT ar.Artist, al.Album, t.Term AS Word, w.Count, al.Album_Art
+        FROM word_counts w
+        JOIN albums al ON al.Album_Key = w.Album_Key
+        JOIN artists ar ON ar.Artist_Key = al.Artist_Key
+        JOIN terms t ON t.Term_Id = w.Term_Id
+    """,
+    "indexed_albums": """
+        SELECT i.Datetime, ar.Artist, al.Album, i.Album_Id, i.Track_Count, al.Album_Art, i.Release_Date, i.Expires_At, i.Index_Version, i.Tokenizer_Version
+        FROM album_index i
+        JOIN albums al ON al.Album_Key = i.Album_Key
+        JOIN artists ar ON ar.Artist_Key = al.Artist_Key
+    """,
+    "album_terms": """
+        SELECT ar.Artist, al.Album, t.Term, c.Count
+        FROM album_term_counts c
+        JOIN albums al ON al.Album_Key = c.Album_Key
+        JOIN artists ar ON ar.Artist_Key = al.Artist_Key
+        JOIN terms t ON t.Term_Id = c.Term_Id
+    """,
+    "track_terms": """
+        SELECT ar.Artist, al.Album, tr.Track, tr.Track_Number, t.Term, c.Count
+        FROM track_term_counts c
+        JOIN tracks tr ON tr.Track_Key = c.Track_Key
+        JOIN albums al ON al.Album_Key = tr.Album_Key
+        JOIN artists ar ON ar.Artist_Key = al.Artist_Key
+        JOIN terms t ON t.Term_Id = c.Term_Id
+    """,
+    "track_sections": """
+        SELECT ar.Artist, al.Album, tr.Track, tr.Track_Number, s.Section_Index, s.Section_Type, s.Performers, s.Normalized_Text
+        FROM sections s
+        JOIN tracks tr ON tr.Track_Key = s.Track_Key
+        JOIN albums al ON al.Album_Key = tr.Album_Key
+        JOIN artists ar ON ar.Artist_Key = al.Artist_Key
+    """,
+    "section_terms": """
+        SELECT ar.Artist, al.Album, tr.Track, tr.Track_Number, c.Section_Index, t.Term, c.Count
+        FROM section_term_counts c
+        JOIN tracks tr ON tr.Track_Key = c.Track_Key
+        JOIN albums al ON al.Album_Key = tr.Album_Key
+        JOIN artists ar ON ar.Artist_Key = al.Artist_Key
+        JOIN terms t ON t.Term_Id = c.Term_Id
+    """,
+}
+
+# Sort order of tables, restored by compaction so related rows share storage blocks
+SORTED_TABLES = {
+    "terms": "Term",
+    "word_counts": "Album_Key, Term_Id",
+    "album_term_counts": "Album_Key, Term_Id",
+    "track_term_counts": "Track_Key, Term_Id",
+    "sections": "Track_Key, Section_Index",
+    "section_term_counts": "Track_Key, Section_Index, Term_Id",
+}
+
+
+# Function to get or assign the integer keys of dictionary entries. rows are tuples of `columns`
+# values (scalars when there's one column); returns {row: key}. Must run inside write_cursor(),
+# which serializes key assignment.
+def _dictionary_keys(con, table, key_column, columns, rows):
+    rows = list(dict.fromkeys(rows))
+    if not rows:
+        return {}
+    names = [name for name, _ in columns]
+    values = [list(column) for column in zip(*rows)] if len(columns) > 1 else [rows]
+    new_rows = "SELECT " + ", ".join(f"unnest(?::{sql_type}[]) AS {name}" for name, sql_type in columns)
+    # NULL-safe, so rows with a NULL column (e.g. tracks without a Track_Number) keep their key
+    match = " AND ".join(f"d.{name} IS NOT DISTINCT FROM n.{name}" for name in names)
+    con.execute(
+        f"""
+        INSERT INTO {table} ({key_column}, {', '.join(names)})
+        SELECT (SELECT COALESCE(MAX({key_column}), 0) FROM {table}) + row_number() OVER (), {', '.join(f'n.{name}' for name in names)}
+        FROM ({new_rows}) n
+        WHERE NOT EXISTS (SELECT 1 FROM {table} d WHERE {match})
+        """,
+        values
+    )
+    found = con.execute(
+        f"SELECT {', '.join(f'd.{name}' for name in names)}, d.{key_column} FROM {table} d JOIN ({new_rows}) n ON {match}",
+        values
+    ).fetchall()
+    if len(columns) > 1:
+        return {tuple(row[:-1]): row[-1] for row in found}
+    return {row[0]: row[1] for row in found}
+
+
+# Function to get or assign album keys for (artist, album) pairs
+def _album_keys(con, albums):
+    albums = list(dict.fromkeys(albums))
+    artist_keys = _dictionary_keys(con, "artists", "Artist_Key", [("Artist", "VARCHAR")], [artist for artist, _ in albums])
+    album_keys = _dictionary_keys(
+        con, "albums", "Album_Key", [("Artist_Key", "INTEGER"), ("Album", "VARCHAR")],
+        [(artist_keys[artist], album) for artist, album in albums]
+    )
+    return {(artist, album): album_keys[(artist_keys[artist], album)] for artist, album in albums}
+
+
+# Function to get or assign track keys for (album_key, track_number, track) triples
+def _track_keys(con, tracks):
+    return _dictionary_keys(
+        con, "tracks", "Track_Key", [("Album_Key", "INTEGER"), ("Track_Number", "INTEGER"), ("Track", "VARCHAR")], tracks
+    )
+
+
+# Function to get or assign term IDs
+def _term_ids(con, terms):
+    return _dictionary_keys(con, "terms", "Term_Id", [("Term", "VARCHAR")], terms)
+
+
+# Function to record album art on album rows ({album_key: url}); a missing URL keeps the known one
+def _set_album_art(con, album_arts):
+    album_arts = {album_key: url for album_key, url in album_arts.items() if url}
+    if album_arts:
+        con.execute(
+            """
+            UPDATE albums SET Album_Art = n.Album_Art
+            FROM (SELECT unnest(?::INTEGER[]) AS Album_Key, unnest(?::VARCHAR[]) AS Album_Art) n
+            WHERE albums.Album_Key = n.Album_Key
+            """,
+            [list(album_arts), list(album_arts.values())]
+        )
+
+
+# Function to bulk insert rows into a table as parallel column lists (much faster than executemany)
+def _insert_columns(con, table, columns, rows):
+    if not rows:
+        return
+    con.execute(
+        f"INSERT INTO {table} ({', '.join(name for name, _ in columns)}) "
+        f"SELECT {', '.join(f'unnest(?::{sql_type}[])' for _, sql_type in columns)}",
+        [list(column) for column in zip(*rows)]
+    )
+
+
+# Tables of the original denormalized schema, migrated into the normalized one on startup
+LEGACY_TABLES = ("counts", "indexed_albums", "album_terms", "track_terms", "track_sections", "section_terms")
+
+
+# Function to move the rows of the original denormalized tables into the normalized schema and drop them.
+# Runs once, on the first start after upgrading; names are assigned keys and facts are copied with joins.
+# Cached counts are dropped rather than copied: they are only served for albums with a current index
+# (see check_duckdb_cache_words), which no migrated album has, so they are rebuilt once it's re-indexed.
+def _migrate_legacy_tables(con, legacy_tables):
+    if "indexed_albums" in legacy_tables:
+        con.execute("ALTER TABLE indexed_albums ADD COLUMN IF NOT EXISTS Release_Date TEXT")
+    name_columns = {
+        "indexed_albums": ("Artist", "Album", None, None),
+        "album_terms": ("Artist", "Album", None, "Term"),
+        "track_terms": ("Artist", "Album", "Track", "Term"),
+        "track_sections": ("Artist", "Album", "Track", None),
+        "section_terms": ("Artist", "Album", "Track", "Term"),
+    }
+    albums, tracks, terms = set(), set(), set()
+    for table in legacy_tables:
+        if table not in name_columns:
+            continue
+        artist, album, track, term = name_columns[table]
+        albums.update(con.execute(f"SELECT DISTINCT {artist}, {album} FROM {table}").fetchall())
+        if track:
+            tracks.update(con.execute(f"SELECT DISTINCT {artist}, {album}, {track} FROM {table}").fetchall())
+        if term:
+            terms.update(row[0] for row in con.execute(f"SELECT DISTINCT {term} FROM {table}").fetchall())
+    album_keys = _album_keys(con, sorted(albums))
+    # The original tables didn't record track positions
+    _track_keys(con, sorted((album_keys[(artist, album)], None, track) for artist, album, track in tracks))
+    _term_ids(con, sorted(terms))
+
+    album_key = """
+        JOIN artists ar ON ar.Artist = l.Artist
+        JOIN albums al ON al.Artist_Key = ar.Artist_Key AND al.Album = l.Album
+    """
+    track_key = album_key + " JOIN tracks tr ON tr.Album_Key = al.Album_Key AND tr.Track = l.Track"
+    if "indexed_albums" in legacy_tables:
+        con.execute(f"""
+            UPDATE albums SET Album_Art = a.Album_Art
+            FROM (SELECT al.Album_Key, l.Album_Art FROM indexed_albums l {album_key} WHERE l.Album_Art LIKE 'http%') a
+            WHERE albums.Album_Key = a.Album_Key
+        """)
+        con.execute(f"""
+            INSERT INTO album_index (Album_Key, Datetime, Album_Id, Track_Count, Release_Date)
+            SELECT al.Album_Key, l.Datetime, l.Album_Id, l.Track_Count, l.Release_Date FROM indexed_albums l {album_key}
+        """)
+    if "album_terms" in legacy_tables:
+        con.execute(f"""
+            INSERT INTO album_term_counts (Album_Key, Term_Id, Count)
+            SELECT al.Album_Key, t.Term_Id, l.Count FROM album_terms l {album_key} JOIN terms t ON t.Term = l.Term
+            ORDER BY al.Album_Key, t.Term_Id
+        """)
+    if "track_terms" in legacy_tables:
+        con.execute(f"""
+            INSERT INTO track_term_counts (Track_Key, Term_Id, Count)
+            SELECT tr.Track_Key, t.Term_Id, l.Count FROM track_terms l {track_key} JOIN terms t ON t.Term = l.Term
+            ORDER BY tr.Track_Key, t.Term_Id
+        """)
+    if "track_sections" in legacy_tables:
+        con.execute(f"""
+            INSERT INTO sections (Track_Key, Section_Index, Section_Type, Performers, Normalized_Text)
+            SELECT tr.Track_Key, l.Section_Index, l.Section_Type, l.Performers, l.Normalized_Text FROM track_sections l {track_key}
+            ORDER BY tr.Track_Key, l.Section_Index
+        """)
+    if "section_terms" in legacy_tables:
+        con.execute(f"""
+            INSERT INTO section_term_counts (Track_Key, Section_Index, Term_Id, Count)
+            SELECT tr.Track_Key, l.Section_Index, t.Term_Id, l.Count FROM section_terms l {track_key} JOIN terms t ON t.Term = l.Term
+            ORDER BY tr.Track_Key, l.Section_Index, t.Term_Id
+        """)
+    for table in legacy_tables:
+        con.execute(f"DROP TABLE {table}")
+
+
+# Function to create the schema on a newly opened connection, migrating a database written with
+# the original denormalized tables. Runs before the connection is shared, so nothing else writes meanwhile.
+def init_schema(con):
+    legacy_tables = [
+        table for (table,) in con.execute(
+            "SELECT table_name FROM duckdb_tables() WHERE database_name = current_database() AND schema_name = 'main'"
+        ).fetchall() if table in LEGACY_TABLES
+    ]
+    con.execute("BEGIN TRANSACTION")
+    try:
+        for statement in SCHEMA:
+            con.execute(statement)
+        if legacy_tables:
+            print(f"Migrating {', '.join(legacy_tables)} to the normalized schema")
+            _migrate_legacy_tables(con, legacy_tables)
+        for view, query in VIEWS.items():
+            con.execute(f"CREATE OR REPLACE VIEW {view} AS {query}")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+    if legacy_tables:
+        # Write the migrated tables out and drop the old ones' blocks from the WAL
+        con.execute("CHECKPOINT")
+
+
+# Columns written by the write-behind queue, per table (the primary key columns come first)
+WRITE_BEHIND_TABLES = {
+    "counts": (["Artist", "Album", "Word"], ["Count", "Album_Art"]),
+    "lyrics": (["Artist", "Track"], ["Datetime", "Track_Id", "Lyrics", "Album_Art"]),
+}
+# Flush when this many rows are pending, or after this many seconds, whichever comes first
+WRITE_BATCH_SIZE = int(os.getenv("DUCKDB_WRITE_BATCH_SIZE", "500"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("DUCKDB_WRITE_FLUSH_INTERVAL", "2.0"))
+
+
+# Function to upsert queued count rows into word_counts, assigning album keys and term IDs as needed
+def _write_counts(con, rows):
+    album_keys = _album_keys(con, [(row["Artist"], row["Album"]) for row in rows])
+    term_ids = _term_ids(con, [row["Word"] for row in rows])
+    _set_album_art(con, {album_keys[(row["Artist"], row["Album"])]: row["Album_Art"] for row in rows})
+    keyed_rows = [(album_keys[(row["Artist"], row["Album"])], term_ids[row["Word"]], row["Count"]) for row in rows]
+    con.execute(
+        """
+        DELETE FROM word_counts USING (SELECT unnest(?::INTEGER[]) AS Album_Key, unnest(?::INTEGER[]) AS Term_Id) n
+        WHERE word_counts.Album_Key = n.Album_Key AND word_counts.Term_Id = n.Term_Id
+        """,
+        [[row[0] for row in keyed_rows], [row[1] for row in keyed_rows]]
+    )
+    _insert_columns(
+        con, "word_counts",
+        [("Album_Key", "INTEGER"), ("Term_Id", "INTEGER"), ("Count", "INTEGER")],
+        keyed_rows
+    )
+
+
+class WriteBehindQueue:
+    """Collects count and lyric rows and writes them to DuckDB in bulk upserts.
+
+    Rows are keyed by primary key, so a newer row for the same key replaces the
+    pending one. Readers can look up pending rows so a result is visible right away,
+    before it has been flushed; the batch being flushed stays visible until its
+    transaction has committed.
+    """
+
+    def __init__(self, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = {table: {} for table in WRITE_BEHIND_TABLES}
+        self._flushing = {table: {} for table in WRITE_BEHIND_TABLES}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="duckdb-write-behind", daemon=True)
+        self._thread.start()
+
+    # Queue a row (a dict of column -> value) for a table
+    def put(self, table, row):
+        key_columns, _ = WRITE_BEHIND_TABLES[table]
+        key = tuple(row[column] for column in key_columns)
+        with self._lock:
+            self._pending[table][key] = row
+            pending_count = sum(len(rows) for rows in self._pending.values())
+        if pending_count >= self.batch_size:
+            self._wake.set()
 
-''')
-con.execute("DELETE FROM counts WHERE Count = 0")
-df = con.execute("SELECT * FROM counts").df()
-con.close()
+    # Return the pending row for a primary key, or None if nothing is waiting to be written
+    def get(self, table, key):
+        key = tuple(key)
+        with self._lock:
+            return self._pending[table].get(key) or self._flushing[table].get(key)
+
+    # Return pending rows of a table that match the given column values
+    def find(self, table, **values):
+        with self._lock:
+            rows = {**self._flushing[table], **self._pending[table]}
+        return [row for row in rows.values() if all(row[column] == value for column, value in values.items())]
+
+    # Write everything pending in one transaction of bulk upserts
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                self._pending = {table: {} for table in WRITE_BEHIND_TABLES}
+                # Readers keep finding the batch here until it is on disk
+                self._flushing = batch
+            if not any(batch.values()):
+                return 0
+            try:
+                with write_cursor() as cursor:
+                    if batch["counts"]:
+                        _write_counts(cursor, list(batch["counts"].values()))
+                    if batch["lyrics"]:
+                        key_columns, value_columns = WRITE_BEHIND_TABLES["lyrics"]
+                        columns = key_columns + value_columns
+                        cursor.executemany(
+                            f"INSERT OR REPLACE INTO lyrics ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                            [[row[column] for column in columns] for row in batch["lyrics"].values()]
+                        )
+            except Exception as e:
+                print(f"Error flushing write-behind queue: {e}")
+                # Put the rows back unless a newer row for the same key arrived meanwhile
+                with self._lock:
+                    for table, rows in batch.items():
+                        for key, row in rows.items():
+                            self._pending[table].setdefault(key, row)
+                    self._flushing = {table: {} for table in WRITE_BEHIND_TABLES}
+                return 0
+            with self._lock:
+                self._flushing = {table: {} for table in WRITE_BEHIND_TABLES}
+            return sum(len(rows) for rows in batch.values())
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    # Stop the background thread and write whatever is still pending
+    def close(self):
+        self._stopped = True
+        self._wake.set()
+        self._thread.join(timeout=5)
+        self.flush()
+
+
+write_queue = WriteBehindQueue()
+
+
+@register_collector
+def write_queue_metrics():
+    return [("lyrics_write_queue_pending_rows", "gauge", "Rows waiting in the DuckDB write-behind queue",
+             [({"table": table}, len(write_queue.find(table))) for table in WRITE_BEHIND_TABLES])]
+
+
+# Function to flush pending writes and close the connection when the process exits
+def _shutdown():
+    write_queue.close()
+    close_connection()
+
+
+atexit.register(_shutdown)
 
 # Function to check if a result exists in DuckDB
 def check_duckdb_cache(artist_name, album_name, word):
-    con = duckdb.connect(database=r'./lyrics_cache.db') 
+    return check_duckdb_cache_words(artist_name, album_name, [word]).get(word)
+
+
+# Function to check cached results for several words at once; returns {word: (count, album_art)} for hits
+@timed_stage("duckdb_read")
+def check_duckdb_cache_words(artist_name, album_name, words):
+    # Hot results come straight from the in-memory cache
+    cached = {}
+    for word in words:
+        found, value = count_cache.get((artist_name, album_name, word))
+        if found:
+            cached[word] = value
+    missing = [word for word in words if word not in cached]
+    if not missing:
+        return cached
+
+    con = get_cursor()
+    placeholders = ", ".join("?" for _ in missing)
+    # Counts are only served while the album's index is current (see get_album_index); an expired or
+    # outdated album's counts are recomputed once it is re-ingested
+    rows = con.execute(
+        f"""
+        SELECT c.Word, c.Count, c.Album_Art FROM counts c
+        WHERE c.Artist = ? AND c.Album = ? AND c.Word IN ({placeholders})
+          AND EXISTS (SELECT 1 FROM indexed_albums i WHERE i.Artist = c.Artist AND i.Album = c.Album AND {CURRENT_INDEX})
+        """,
+        [artist_name, album_name, *missing, *_current_index_params()]
+    ).fetchall()
+    # Rows still waiting in the write-behind queue are newer than what's on disk
+    for word in missing:
+        pending = write_queue.get("counts", (artist_name, album_name, word))
+        if pending:
+            rows.append((word, pending["Count"], pending["Album_Art"]))
+    for word, count, album_art in rows:
+        album_art = album_art if album_art and album_art.startswith('http') else None
+        cached[word] = (count, album_art)
+        count_cache.set((artist_name, album_name, word), (count, album_art))
+    return cached
+
+
+# Function to store results in DuckDB including album art
+def store_in_duckdb(artist_name, album_name, word, count, album_art):
+    store_counts_in_duckdb(artist_name, album_name, {word: count}, album_art)
+
+
+# Function to queue counts for several words of one album; they are upserted in bulk by the write-behind queue
+def store_counts_in_duckdb(artist_name, album_name, word_counts, album_art):
+    # Ensure album_art is a valid URL, otherwise insert NULL
+    album_art_url = album_art if album_art and album_art.startswith('http') else None
+    for word, count in word_counts.items():
+        count_cache.set((artist_name, album_name, word), (count, album_art_url))
+        write_queue.put("counts", {
+            "Artist": artist_name,
+            "Album": album_name,
+            "Word": word,
+            "Count": count,
+            "Album_Art": album_art_url
+        })
+
+
+# Function to look up stored lyrics for a track (by Spotify track ID when we have one).
+# Returns (lyrics, album_art); a track known to have no lyrics returns ("", album_art) until its NO_LYRICS_TTL runs out.
+@timed_stage("duckdb_read")
+def get_cached_lyrics(artist_name, track_name, track_id=None):
+    pending = write_queue.get("lyrics", (artist_name, track_name))
+    if not pending and track_id:
+        pending = next(iter(write_queue.find("lyrics", Track_Id=track_id)), None)
+    if pending:
+        return pending["Lyrics"], pending["Album_Art"]
+
+    con = get_cursor()
+    result = None
+    if track_id:
+        result = con.execute(
+            "SELECT Lyrics, Album_Art, Datetime FROM lyrics WHERE Track_Id = ?",
+            [track_id]
+        ).fetchone()
+    if not result:
+        result = con.execute(
+            "SELECT Lyrics, Album_Art, Datetime FROM lyrics WHERE Artist = ? AND Track = ?",
+            [artist_name, track_name]
+        ).fetchone()
+    if result:
+        lyrics, album_art, stored_at = result
+        if not lyrics and stored_at < datetime.now() - timedelta(seconds=NO_LYRICS_TTL):
+            return None
+        album_art = album_art if album_art and album_art.startswith('http') else None
+        return lyrics, album_art
+    return None
+
+
+# Function to queue a track's lyrics for the write-behind queue
+def store_lyrics(artist_name, track_name, track_id, lyrics, album_art):
+    album_art_url = album_art if album_art and album_art.startswith('http') else None
+    write_queue.put("lyrics", {
+        "Datetime": datetime.now(),
+        "Artist": artist_name,
+        "Track": track_name,
+        "Track_Id": track_id,
+        "Lyrics": lyrics,
+        "Album_Art": album_art_url
+    })
+
+
+# Function to record that Genius has no lyrics for a track (a negative entry, see NO_LYRICS_TTL)
+def store_no_lyrics(artist_name, track_name, track_id, album_art=None):
+    store_lyrics(artist_name, track_name, track_id, "", album_art)
+
+
+# Function to check whether an album's token index has been built with the current INDEX_VERSION and
+# tokenizer (and hasn't expired); returns (album_art,) or None
+@timed_stage("duckdb_read")
+def get_album_index(artist_name, album_name):
+    con = get_cursor()
     result = con.execute(
-        "SELECT Count, Album_Art FROM counts WHERE Artist = ? AND Album = ? AND Word = ?",
-        [artist_name, album_name, word]
+        f"SELECT Album_Art FROM indexed_albums WHERE Artist = ? AND Album = ? AND {CURRENT_INDEX}",
+        [artist_name, album_name, *_current_index_params()]
     ).fetchone()
     if result:
-        count, album_art = result
+        album_art = result[0]
         album_art = album_art if album_art and album_art.startswith('http') else None
-        return count, album_art
-    con.close()
+        return (album_art,)
     return None
 
 
-# Function to store results in DuckDB including album art
-def store_in_duckdb(artist_name, album_name, word, count, album_art):
-    con = duckdb.connect(database='./lyrics_cache.db') 
-    # Ensure album_art is a valid URL, otherwise insert NULL
+# Function to store an album's token index; track_term_counts maps (track number, track name) -> {term: count}
+# for every track of the album and track_sections maps (track number, track name) ->
+# [(section_type, performers, normalized_text, {term: count}), ...]. A known release date is kept
+# when re-indexing without one. expires_at is when the index has to be rebuilt (None: never).
+# The album's cached counts were computed from its previous index, so they are dropped.
+def store_album_index(artist_name, album_name, album_id, album_art, track_term_counts, release_date=None, track_sections=None, expires_at=None):
     album_art_url = album_art if album_art and album_art.startswith('http') else None
-    datetime_now = datetime.now()
-    con.execute(
-        "INSERT INTO counts (Datetime, Artist, Album, Word, Count, Album_Art) VALUES (?, ?, ?, ?, ?, ?)",
-        [datetime_now, artist_name, album_name, word, count, album_art_url]
-    )
-    con.close()
-    
-    
\ No newline at end of file
+    album_counts = {}
+    for term_counts in track_term_counts.values():
+        for term, count in term_counts.items():
+            album_counts[term] = album_counts.get(term, 0) + count
+    track_sections = track_sections or {}
+    section_terms = {term for sections in track_sections.values() for *_, term_counts in sections for term in term_counts}
+
+    # Write the album's queued lyrics first so the lyrics table and the index stay consistent
+    write_queue.flush()
+    with write_cursor() as con:
+        album_key = _album_keys(con, [(artist_name, album_name)])[(artist_name, album_name)]
+        _set_album_art(con, {album_key: album_art_url})
+        # Drop the album's previous index; its track keys stay assigned for the re-inserted rows
+        for table in ("track_term_counts", "sections", "section_term_counts"):
+            con.execute(f"DELETE FROM {table} WHERE Track_Key IN (SELECT Track_Key FROM tracks WHERE Album_Key = ?)", [album_key])
+        con.execute("DELETE FROM album_term_counts WHERE Album_Key = ?", [album_key])
+        con.execute("DELETE FROM word_counts WHERE Album_Key = ?", [album_key])
+
+        track_keys = _track_keys(con, [(album_key, *track) for track in [*track_term_counts, *track_sections]])
+        term_ids = _term_ids(con, [*album_counts, *section_terms])
+        _insert_columns(
+            con, "album_term_counts", [("Album_Key", "INTEGER"), ("Term_Id", "INTEGER"), ("Count", "INTEGER")],
+            [(album_key, term_ids[term], count) for term, count in album_counts.items()]
+        )
+        _insert_columns(
+            con, "track_term_counts", [("Track_Key", "INTEGER"), ("Term_Id", "INTEGER"), ("Count", "INTEGER")],
+            [
+                (track_keys[(album_key, *track)], term_ids[term], count)
+                for track, term_counts in track_term_counts.items() for term, count in term_counts.items()
+            ]
+        )
+        _insert_columns(
+            con, "sections",
+            [("Track_Key", "INTEGER"), ("Section_Index", "INTEGER"), ("Section_Type", "VARCHAR"),
+             ("Performers", "VARCHAR[]"), ("Normalized_Text", "VARCHAR")],
+            [
+                (track_keys[(album_key, *track)], idx, section_type, list(performers), normalized_text)
+                for track, sections in track_sections.items()
+                for idx, (section_type, performers, normalized_text, _) in enumerate(sections)
+            ]
+        )
+        _insert_columns(
+            con, "section_term_counts",
+            [("Track_Key", "INTEGER"), ("Section_Index", "INTEGER"), ("Term_Id", "INTEGER"), ("Count", "INTEGER")],
+            [
+                (track_keys[(album_key, *track)], idx, term_ids[term], count)
+                for track, sections in track_sections.items()
+                for idx, (*_, term_counts) in enumerate(sections) for term, count in term_counts.items()
+            ]
+        )
+        if release_date is None:
+            known = con.execute("SELECT Release_Date FROM album_index WHERE Album_Key = ?", [album_key]).fetchone()
+            release_date = known[0] if known else None
+        con.execute("DELETE FROM album_index WHERE Album_Key = ?", [album_key])
+        con.execute(
+            """
+            INSERT INTO album_index (Album_Key, Datetime, Album_Id, Track_Count, Release_Date, Expires_At, Index_Version, Tokenizer_Version)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [album_key, datetime.now(), album_id, len(track_term_counts), release_date, expires_at, INDEX_VERSION, tokenizer_version]
+        )
+    count_cache.delete_where(lambda key: key[:2] == (artist_name, album_name))
+
+
+# Function to record release dates ({album_name: "YYYY[-MM[-DD]]"}) for an artist's indexed albums
+def store_album_release_dates(artist_name, release_dates):
+    if not release_dates:
+        return
+    with write_cursor() as con:
+        con.execute(
+            """
+            UPDATE album_index SET Release_Date = n.Release_Date
+            FROM (SELECT unnest(?::VARCHAR[]) AS Album, unnest(?::VARCHAR[]) AS Release_Date) n, albums al, artists ar
+            WHERE album_index.Album_Key = al.Album_Key AND al.Artist_Key = ar.Artist_Key
+              AND ar.Artist = ? AND al.Album = n.Album
+            """,
+            [list(release_dates), list(release_dates.values()), artist_name]
+        )
+
+
+# Function to look up album-wide counts for terms from the token index
+@timed_stage("duckdb_read")
+def get_album_term_counts(artist_name, album_name, terms):
+    if not terms:
+        return {}
+    con = get_cursor()
+    placeholders = ", ".join("?" for _ in terms)
+    rows = con.execute(
+        f"SELECT Term, Count FROM album_terms WHERE Artist = ? AND Album = ? AND Term IN ({placeholders})",
+        [artist_name, album_name, *terms]
+    ).fetchall()
+    counts = {term: 0 for term in terms}
+    counts.update(dict(rows))
+    return counts
+
+
+# Function to get the normalized lyrics of every indexed track of an album (used for phrase counting).
+# They are rebuilt from the track's indexed sections, so they always come from the tokenizer the
+# album was indexed with (the lyrics table keeps whatever form it was stored in).
+@timed_stage("duckdb_read")
+def get_album_normalized_lyrics(artist_name, album_name):
+    con = get_cursor()
+    rows = con.execute(
+        """
+        SELECT string_agg(Normalized_Text, ' ' ORDER BY Section_Index)
+        FROM track_sections
+        WHERE Artist = ? AND Album = ?
+        GROUP BY Track_Number, Track
+        """,
+        [artist_name, album_name]
+    ).fetchall()
+    return [row[0] for row in rows if row[0]]
+
+
+def _section_filter(section_types, performer):
+    clauses = []
+    params = []
+    if section_types:
+        clauses.append(f"s.Section_Type IN ({', '.join('?' for _ in section_types)})")
+        params.extend(section_types)
+    if performer:
+        clauses.append("list_contains(s.Performers, ?)")
+        params.append(performer)
+    return "".join(f" AND {clause}" for clause in clauses), params
+
+
+# Function to count terms in an album's sections of the given types and/or performer, from the section index
+@timed_stage("duckdb_read")
+def get_album_section_term_counts(artist_name, album_name, terms, section_types=None, performer=None):
+    if not terms:
+        return {}
+    con = get_cursor()
+    section_filter, filter_params = _section_filter(section_types, performer)
+    placeholders = ", ".join("?" for _ in terms)
+    rows = con.execute(
+        f"""
+        SELECT t.Term, SUM(t.Count)
+        FROM section_terms t
+        JOIN track_sections s
+          ON s.Artist = t.Artist AND s.Album = t.Album AND s.Track = t.Track
+         AND s.Track_Number IS NOT DISTINCT FROM t.Track_Number AND s.Section_Index = t.Section_Index
+        WHERE t.Artist = ? AND t.Album = ? AND t.Term IN ({placeholders}){section_filter}
+        GROUP BY t.Term
+        """,
+        [artist_name, album_name, *terms, *filter_params]
+    ).fetchall()
+    counts = {term: 0 for term in terms}
+    counts.update({term: int(count) for term, count in rows})
+    return counts
+
+
+# Function to get the normalized text of an album's sections of the given types and/or performer (for phrases)
+@timed_stage("duckdb_read")
+def get_album_section_texts(artist_name, album_name, section_types=None, performer=None):
+    con = get_cursor()
+    section_filter, filter_params = _section_filter(section_types, performer)
+    rows = con.execute(
+        f"SELECT s.Normalized_Text FROM track_sections s WHERE s.Artist = ? AND s.Album = ?{section_filter}",
+        [artist_name, album_name, *filter_params]
+    ).fetchall()
+    return [row[0] for row in rows if row[0]]
+
+
+# Deletes run by purge_expired(), in order: expired negative entries and counts that can't be served
+# any more first, then dictionary rows nothing refers to any more (tracks before albums before artists)
+PURGE_STATEMENTS = {
+    "expired no-lyrics tracks": "DELETE FROM lyrics WHERE (Lyrics IS NULL OR Lyrics = '') AND (Datetime IS NULL OR Datetime < ?)",
+    # Counts are only served while their album's index is current; re-indexing the album rebuilds them
+    "counts without a current index": f"""
+        DELETE FROM word_counts WHERE Album_Key NOT IN (SELECT Album_Key FROM album_index WHERE {CURRENT_INDEX})
+    """,
+    "unused tracks": """
+        DELETE FROM tracks WHERE Track_Key NOT IN (SELECT Track_Key FROM track_term_counts)
+          AND Track_Key NOT IN (SELECT Track_Key FROM sections)
+    """,
+    "unused albums": """
+        DELETE FROM albums WHERE Album_Key NOT IN (SELECT Album_Key FROM word_counts)
+          AND Album_Key NOT IN (SELECT Album_Key FROM album_index)
+          AND Album_Key NOT IN (SELECT Album_Key FROM album_term_counts)
+          AND Album_Key NOT IN (SELECT Album_Key FROM tracks)
+    """,
+    "unused artists": "DELETE FROM artists WHERE Artist_Key NOT IN (SELECT Artist_Key FROM albums)",
+    "unused terms": """
+        DELETE FROM terms WHERE Term_Id NOT IN (SELECT Term_Id FROM word_counts)
+          AND Term_Id NOT IN (SELECT Term_Id FROM album_term_counts)
+          AND Term_Id NOT IN (SELECT Term_Id FROM track_term_counts)
+          AND Term_Id NOT IN (SELECT Term_Id FROM section_term_counts)
+    """,
+}
+
+
+# Function to delete expired negative entries and unreferenced dictionary rows; returns {what: rows deleted}
+def purge_expired():
+    write_queue.flush()
+    now = datetime.now()
+    cutoffs = {
+        "expired no-lyrics tracks": [now - timedelta(seconds=NO_LYRICS_TTL)],
+        "counts without a current index": _current_index_params(),
+    }
+    deleted = {}
+    with write_cursor() as con:
+        for name, statement in PURGE_STATEMENTS.items():
+            deleted[name] = con.execute(statement, cutoffs.get(name, [])).fetchone()[0]
+    return deleted
+
+
+# Function to rewrite the database file without free blocks, with the tables sorted (see SORTED_TABLES).
+# DuckDB reuses freed blocks but never shrinks its file, so this copies every table into a fresh
+# file and swaps it in. Returns (bytes before, bytes after). Other processes must not have the database open.
+def compact_database():
+    write_queue.flush()
+    with write_cursor() as con:
+        for table, order in SORTED_TABLES.items():
+            con.execute(f"CREATE TEMP TABLE sorted_rows AS SELECT * FROM {table} ORDER BY {order}")
+            con.execute(f"DELETE FROM {table}")
+            con.execute(f"INSERT INTO {table} SELECT * FROM sorted_rows")
+            con.execute("DROP TABLE sorted_rows")
+    con = get_cursor()
+    con.execute("CHECKPOINT")
+    size_before = os.path.getsize(DB_PATH)
+
+    compacted_path = DB_PATH + ".compact"
+    if os.path.exists(compacted_path):
+        os.remove(compacted_path)
+    source = con.execute("SELECT current_database()").fetchone()[0]
+    with _write_lock:
+        con.execute(f"ATTACH '{compacted_path}' AS compacted")
+        try:
+            con.execute(f"COPY FROM DATABASE {source} TO compacted")
+        finally:
+            con.execute("DETACH compacted")
+        close_connection()
+        os.replace(compacted_path, DB_PATH)
+    return size_before, os.path.getsize(DB_PATH)
@@ -0,0 +1,320 @@
+# Request parsing and response building shared by the Flask app (app.py) and the ASGI app
+# (asgi_app.py), so both serve the same endpoints with the same validation, JSON bodies and SSE
+# events. The apps only differ in how they wait for the work in between.
+import json
+import time
+from lyrics_parser import SECTION_TYPES
+from index_utils import parse_words, parse_section_types, build_count_result, throttled_result, SSE_HEARTBEAT_SECONDS
+from index_utils import submit_album_ingest_job, incomplete_result, AlbumIncomplete
+from duckdb_utils import get_album_index
+from jobs import get_job
+from analytics_utils import words_to_terms, STOPWORDS, pyarrow
+from metrics import with_timings
+from rate_limiter import UpstreamThrottled
+
+
+class RequestError(Exception):
+    """A request that can't be served as sent; answered with {"error": message} and the status code."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+# Function to get a request's JSON body (None when there is none)
+def request_data(data):
+    return data if isinstance(data, dict) else {}
+
+
+def parse_artist(data):
+    return request_data(data).get("artist", "").strip().lower()
+
+
+# Function to parse an album count request; returns (artist, album_id, album_name, words).
+# Without require_words an empty word list is accepted (the stream then just ends).
+def parse_album_request(data, require_words=True):
+    data = request_data(data)
+    artist = parse_artist(data)
+    album_id = data.get("albumId")
+    album_name = data.get("albumName")
+    words = data.get("words", [])
+
+    if not isinstance(words, list):
+        raise RequestError("`words` must be a list")
+    if not all([artist, album_id, album_name]):
+        raise RequestError("Missing required parameters")
+    words = parse_words(words)
+    if require_words and not words:
+        raise RequestError("No words provided")
+    return artist, album_id, album_name, words
+
+
+# Function to parse a /count-word-sections request; returns (artist, album_id, album_name, words, section_types, performer)
+def parse_sections_request(data):
+    data = request_data(data)
+    sections = data.get("sections", [])
+    performer = data.get("performer") or ""
+    if not isinstance(data.get("words", []), list) or not isinstance(sections, list) or not isinstance(performer, str):
+        raise RequestError("`words` and `sections` must be lists and `performer` a string")
+    artist, album_id, album_name, words = parse_album_request(data)
+
+    section_types = parse_section_types(sections)
+    performer = performer.strip().lower()
+    if section_types is None:
+        raise RequestError(f"`sections` must be from {', '.join(SECTION_TYPES)}")
+    if not section_types and not performer:
+        raise RequestError("Provide `sections` and/or `performer`")
+    return artist, album_id, album_name, words, section_types, performer
+
+
+# Function to parse a /count-word-artist request; returns (artist, words)
+def parse_artist_words_request(data):
+    data = request_data(data)
+    words = data.get("words", [])
+    if not isinstance(words, list):
+        raise RequestError("`words` must be a list")
+    artist, words = parse_artist(data), parse_words(words)
+    if not artist or not words:
+        raise RequestError("Missing required parameters")
+    return artist, words
+
+
+# Function to parse a /get-lyrics request; returns (artist, track) as given (not lowercased)
+def parse_lyrics_request(data):
+    data = request_data(data)
+    artist = data.get("artist", "").strip()
+    track = data.get("track", "").strip()
+    if not artist or not track:
+        raise RequestError("Missing artist or track")
+    return artist, track
+
+
+# Function to parse a /jobs request; returns (artist, album_id, album_name)
+def parse_job_request(data):
+    data = request_data(data)
+    artist, album_id, album_name = parse_artist(data), data.get("albumId"), data.get("albumName")
+    if not all([artist, album_id, album_name]):
+        raise RequestError("Missing required parameters")
+    return artist, album_id, album_name
+
+
+# Function to check the output format of an analytics request; returns True for Arrow (?format=arrow)
+def parse_analytics_format(args):
+    as_arrow = args.get("format", "json") == "arrow"
+    if as_arrow and pyarrow is None:
+        raise RequestError("Arrow output is not available (pyarrow is not installed)", 406)
+    return as_arrow
+
+
+# Function to parse an /analytics/top-words request; returns top_words_per_album's (artist, n, albums, min_length)
+def parse_top_words_request(data):
+    data = request_data(data)
+    artist = parse_artist(data)
+    albums = data.get("albums")
+    n = data.get("n", 10)
+    min_length = data.get("minLength", 1)
+
+    if not artist:
+        raise RequestError("Missing required parameters")
+    if albums is not None and not isinstance(albums, list):
+        raise RequestError("`albums` must be a list")
+    if not isinstance(n, int) or not isinstance(min_length, int) or n < 1:
+        raise RequestError("`n` and `minLength` must be positive integers")
+    return artist, n, albums, min_length
+
+
+# Function to parse an /analytics/word-timeline request; returns (artist, terms)
+def parse_word_timeline_request(data):
+    data = request_data(data)
+    words = data.get("words", [])
+    if not isinstance(words, list):
+        raise RequestError("`words` must be a list")
+    artist, terms = parse_artist(data), words_to_terms(parse_words(words))
+    if not artist or not terms:
+        raise RequestError("Missing required parameters")
+    return artist, terms
+
+
+# Function to parse an /analytics/compare-artists request; returns (artists, terms)
+def parse_compare_artists_request(data):
+    data = request_data(data)
+    artists = data.get("artists", [])
+    words = data.get("words", [])
+    if not isinstance(artists, list) or not isinstance(words, list):
+        raise RequestError("`artists` and `words` must be lists")
+    artists = parse_words(artists)
+    terms = words_to_terms(parse_words(words))
+    if not artists or not terms:
+        raise RequestError("Missing required parameters")
+    return artists, terms
+
+
+# Function to parse a /word-cloud request; returns top_terms' (artist, album_name, k, stopwords, min_length)
+def parse_word_cloud_request(data):
+    data = request_data(data)
+    artist = parse_artist(data)
+    album_name = data.get("albumName")
+    k = data.get("k", 100)
+    min_length = data.get("minLength", 2)
+    use_stopwords = data.get("stopwords", True)
+    extra_stopwords = data.get("extraStopwords", [])
+
+    if not artist:
+        raise RequestError("Missing required parameters")
+    if not isinstance(k, int) or not isinstance(min_length, int) or k < 1:
+        raise RequestError("`k` and `minLength` must be positive integers")
+    if not isinstance(extra_stopwords, list):
+        raise RequestError("`extraStopwords` must be a list")
+
+    stopwords = (STOPWORDS if use_stopwords else frozenset()) | set(words_to_terms(parse_words(extra_stopwords)))
+    return artist, album_name, k, stopwords, min_length
+
+
+# Function to build the /albums result from an artist's Spotify albums (only albums with art are listed)
+def albums_result(albums):
+    if not albums:
+        raise RequestError("No albums found", 404)
+    return {"albums": [
+        # images is already an array of {url, height, width}
+        {"id": album["id"], "name": album["name"], "images": album["images"]}
+        for album in albums.get("items", []) if album.get("images")
+    ]}
+
+
+# Function to pick the albums of a discography to count: Spotify lists clean/explicit and regional
+# versions separately, so each album name is counted once
+def unique_albums(albums):
+    if not albums or not albums.get("items"):
+        raise RequestError("No albums found", 404)
+    unique = {}
+    for album in albums["items"]:
+        unique.setdefault(album["name"].strip().lower(), album)
+    return list(unique.values())
+
+
+# Function to build an album count result; raises RequestError (404) when the album had no tracks
+def count_result(artist, album_name, result):
+    if result is None:
+        raise RequestError("No tracks found", 404)
+    word_counts, album_art = result
+    return build_count_result(artist, album_name, word_counts, album_art)
+
+
+def sections_count_result(artist, album_name, result, section_types, performer):
+    result = count_result(artist, album_name, result)
+    result["sections"] = section_types
+    result["performer"] = performer or None
+    return result
+
+
+# Function to queue a /jobs ingestion; returns (body, status code). An album that is already
+# indexed needs no job.
+def submit_job_result(artist, album_id, album_name):
+    if get_album_index(artist, album_name):
+        return {"jobId": None, "status": "indexed"}, 200
+    job_id = submit_album_ingest_job(artist, album_id, album_name)
+    if job_id is None:
+        raise RequestError("No tracks found", 404)
+    return get_job(job_id), 202
+
+
+# Function to check that a /word-cloud album is indexed (word clouds are served only from what is
+# already indexed, never from Genius)
+def require_indexed_album(artist, album_name):
+    if album_name and not get_album_index(artist, album_name):
+        raise RequestError("Album not indexed", 404)
+
+
+# Function to format one server-sent event
+def sse(data):
+    return f"data: {json.dumps(data)}\n\n"
+
+
+SSE_KEEP_ALIVE = ": keep-alive\n\n"
+
+
+def progress_event(progress):
+    return sse({"progress": progress})
+
+
+# Function to build the last event of a /count-word-stream from its count result
+def count_stream_final_event(artist, album_name, result):
+    if result is None:
+        return sse({"error": "No tracks found"})
+    word_counts, album_art = result
+    final = build_count_result(artist, album_name, word_counts, album_art)
+    final["completed"] = True
+    return sse(with_timings(final))
+
+
+class ArtistCountStream:
+    """Events of a /count-word-artist stream: one per album as its count finishes (in completion
+    order), then the totals across every album that could be counted."""
+
+    def __init__(self, artist, words, albums):
+        self.artist = artist
+        self.albums = albums
+        self.totals = {word: 0 for word in words}
+        self.albums_done = 0
+
+    # Function to build the event for an album's finished get_album_word_counts call (a concurrent.futures or asyncio future)
+    def album_event(self, album, future):
+        self.albums_done += 1
+        event = {"albumsDone": self.albums_done, "totalAlbums": len(self.albums)}
+        try:
+            result = future.result()
+        except (UpstreamThrottled, AlbumIncomplete) as e:
+            result = e
+        except Exception as e:
+            print(f"Error counting album '{album['name']}': {e}")
+            result = None
+        if isinstance(result, UpstreamThrottled):
+            event["albumResult"] = {"albumId": album["id"], "album": album["name"], **throttled_result(result)}
+        elif isinstance(result, AlbumIncomplete):
+            event["albumResult"] = {"albumId": album["id"], "album": album["name"], **incomplete_result(result)}
+        elif result is None:
+            event["albumResult"] = {"albumId": album["id"], "album": album["name"], "error": "No lyrics found"}
+        else:
+            word_counts, album_art = result
+            for word, count in word_counts.items():
+                self.totals[word] += count
+            album_result = build_count_result(self.artist, album["name"], word_counts, album_art)
+            album_result["albumId"] = album["id"]
+            album_result["releaseDate"] = album.get("release_date")
+            event["albumResult"] = album_result
+        return sse(event)
+
+    def totals_event(self):
+        return sse(with_timings({"artist": self.artist, "totals": self.totals, "totalAlbums": len(self.albums), "completed": True}))
+
+
+class JobStream:
+    """Turns successive polls of a job (as import_album_job returns it) into /jobs/<id>/stream events:
+    progress when more tracks have finished, a keep-alive when nothing changed for SSE_HEARTBEAT_SECONDS,
+    and a last event once the job is imported or failed (done is then set)."""
+
+    def __init__(self):
+        self.last_finished = None
+        self.last_event_at = time.monotonic()
+        self.done = False
+
+    # Function to get the event for a poll of the job, or None when there is nothing to send yet
+    def event(self, job):
+        if job["status"] in ("imported", "failed"):
+            job["completed"] = True
+            self.done = True
+            return sse(job)
+        if job["finishedTracks"] != self.last_finished:
+            self.last_finished = job["finishedTracks"]
+            self.last_event_at = time.monotonic()
+            progress = {
+                "currentSong": job["lastTrack"],
+                "songIndex": job["finishedTracks"],
+                "totalSongs": job["totalTracks"]
+            }
+            return sse({"progress": progress, "status": job["status"]})
+        if time.monotonic() - self.last_event_at >= SSE_HEARTBEAT_SECONDS:
+            self.last_event_at = time.monotonic()
+            return SSE_KEEP_ALIVE
+        return None
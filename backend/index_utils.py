@@ -0,0 +1,428 @@
+import os
+import math
+import time
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from spotify_utils import get_spotify_album_track_items
+from rap_genius_utils import get_song_info_from_genius
+from tokenizer import normalize_text
+from lyrics_parser import analyze_lyrics, SECTION_TYPES
+from duckdb_utils import get_album_index, store_album_index, get_album_term_counts, get_album_normalized_lyrics
+from duckdb_utils import check_duckdb_cache_words, store_counts_in_duckdb, get_cached_lyrics, store_lyrics, store_no_lyrics
+from duckdb_utils import get_album_section_term_counts, get_album_section_texts, NO_LYRICS_TTL
+from singleflight import SingleFlight
+from cache_utils import lyrics_error_cache
+from metrics import timed_stage, propagate_timings
+from rate_limiter import UpstreamThrottled
+from jobs import submit_album_job, get_job, get_job_tracks, list_jobs, set_job_status, requeue_job_tracks, JOB_POLL_INTERVAL
+
+# Max number of tracks fetched from Genius at the same time for one album
+LYRICS_FETCH_WORKERS = int(os.getenv("LYRICS_FETCH_WORKERS", "8"))
+# Number of albums counted at the same time for a whole discography
+ALBUM_FETCH_WORKERS = int(os.getenv("ALBUM_FETCH_WORKERS", "4"))
+# Seconds between SSE keep-alive comments while waiting on slow albums
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "10"))
+
+# Concurrent requests for the same album attach to one running ingestion
+album_flights = SingleFlight("album-ingest")
+# Concurrent requests for the same track share one Genius lookup
+track_flights = SingleFlight("track-lyrics")
+
+
+class LyricsLookupFailed(Exception):
+    """A track's Genius lookup failed moments ago (see lyrics_error_cache); it is tried again once that entry expires."""
+
+
+class AlbumIncomplete(Exception):
+    """Some tracks of an album couldn't be looked up, so the album isn't indexed (it would count them as empty)."""
+
+    def __init__(self, album_name, failed_tracks):
+        super().__init__(f"Lyrics lookup failed for {len(failed_tracks)} track(s) of '{album_name}'")
+        self.album_name = album_name
+        self.failed_tracks = failed_tracks
+
+
+# Function to look up a track's stored lyrics; returns None when they have to be fetched from Genius.
+# A track known to have no lyrics comes back as empty lyrics; one whose lookup failed moments ago
+# raises LyricsLookupFailed.
+def stored_track_lyrics(track_name, artist_name, track_id=None):
+    artist_key = artist_name.strip().lower()
+    cached = get_cached_lyrics(artist_key, track_name, track_id)
+    if cached:
+        return cached
+    found, error = lyrics_error_cache.get((artist_key, track_name))
+    if found:
+        raise LyricsLookupFailed(error)
+    return None
+
+
+# Function to store the outcome of a track's Genius lookup; returns (lyrics, album_art)
+def save_track_lyrics(track_name, artist_name, track_id, lyrics, album_art):
+    artist_key = artist_name.strip().lower()
+    if not lyrics:
+        store_no_lyrics(artist_key, track_name, track_id, album_art)
+        return "", album_art
+    store_lyrics(artist_key, track_name, track_id, lyrics, album_art)
+    return lyrics, album_art
+
+
+# Function to remember that a track's Genius lookup failed, so it isn't retried by every request.
+# A throttled lookup isn't remembered: the track is simply fetched again on the next call.
+def record_lyrics_error(track_name, artist_name, error):
+    if not isinstance(error, (UpstreamThrottled, LyricsLookupFailed)):
+        lyrics_error_cache.set((artist_name.strip().lower(), track_name), str(error))
+
+
+# Function to get a track's lyrics, only going to Genius when they aren't stored yet.
+# A throttled lookup raises UpstreamThrottled and is tried again on the next call.
+def get_track_lyrics(track_name, artist_name, track_id=None):
+    stored = stored_track_lyrics(track_name, artist_name, track_id)
+    if stored:
+        return stored
+    return track_flights.do((artist_name.strip().lower(), track_name), _fetch_track_lyrics, track_name, artist_name, track_id)
+
+
+# Function that does the actual Genius lookup for get_track_lyrics (run once per in-flight track)
+def _fetch_track_lyrics(flight, track_name, artist_name, track_id):
+    try:
+        lyrics, album_art = get_song_info_from_genius(track_name, artist_name)
+    except Exception as e:
+        record_lyrics_error(track_name, artist_name, e)
+        raise
+    return save_track_lyrics(track_name, artist_name, track_id, lyrics, album_art)
+
+
+class AlbumIngest:
+    """Collects an album's track lookups as they finish and stores the album's index once all are in.
+
+    Progress is published to the flight as each track comes back. The thread-pool ingestion here
+    and the asyncio one in asgi_app.py only differ in how they run the lookups. If any track's
+    lookup was throttled or failed the album isn't indexed (that would count the track as empty):
+    UpstreamThrottled or AlbumIncomplete is raised instead. The lyrics that did come back are
+    stored, so the retry only fetches the rest.
+    """
+
+    def __init__(self, flight, artist_name, album_id, album_name, tracks):
+        self.flight = flight
+        self.artist_name = artist_name
+        self.album_id = album_id
+        self.album_name = album_name
+        self.tracks = tracks
+        # By position on the album: two tracks can have the same title
+        self.track_lyrics = [None] * len(tracks)
+        self.track_album_arts = [None] * len(tracks)
+        self.throttled = []
+        self.failed = []
+        self.finished = 0
+
+    # Function to record a finished get_track_lyrics call for the track at a position (a concurrent.futures or asyncio future)
+    def add(self, position, future):
+        track = self.tracks[position]
+        try:
+            lyrics, track_album_art = future.result()
+        except UpstreamThrottled as e:
+            self.throttled.append(e)
+            lyrics, track_album_art = None, None
+        except Exception as e:
+            print(f"Error fetching lyrics for '{track['name']}': {e}")
+            self.failed.append(track["name"])
+            lyrics, track_album_art = None, None
+        self.track_lyrics[position] = lyrics
+        self.track_album_arts[position] = track_album_art
+        self.finished += 1
+        self.flight.publish({
+            "currentSong": track["name"],
+            "songIndex": self.finished,
+            "totalSongs": len(self.tracks)
+        })
+
+    # Function to store the album's index once every track is in; returns it as get_album_index does
+    def finish(self):
+        if self.throttled:
+            print(f"Genius throttled {len(self.throttled)} track(s) of '{self.album_name}' by '{self.artist_name}'; not indexing it yet")
+            raise max(self.throttled, key=lambda e: e.retry_after)
+        if self.failed:
+            print(f"Lyrics lookup failed for {len(self.failed)} track(s) of '{self.album_name}' by '{self.artist_name}'; not indexing it yet")
+            raise AlbumIncomplete(self.album_name, self.failed)
+        album_art = store_album_tracks(
+            self.artist_name, self.album_id, self.album_name, self.tracks, self.track_lyrics, self.track_album_arts
+        )
+        return (album_art,)
+
+
+# Generator that fetches and tokenizes every track of an album once and stores the term index.
+# A progress dict is yielded as each track finishes (in completion order) and the generator's
+# return value is the album's index entry (as get_album_index returns it), or None when the album
+# has no tracks. Identical concurrent requests share one ingestion running in the background and
+# all receive its progress events.
+def iter_album_ingest(artist_name, album_id, album_name):
+    flight = album_flights.run((artist_name, album_name), _ingest_album_tracks, artist_name, album_id, album_name)
+    yield from flight.subscribe()
+    return flight.wait()
+
+
+# Function that does the actual ingestion for iter_album_ingest, fetching tracks concurrently
+def _ingest_album_tracks(flight, artist_name, album_id, album_name, max_workers=LYRICS_FETCH_WORKERS):
+    tracks = get_spotify_album_track_items(album_id)
+    if not tracks:
+        return None
+
+    ingest = AlbumIngest(flight, artist_name, album_id, album_name, tracks)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tracks)))) as executor:
+        futures = {
+            executor.submit(propagate_timings(get_track_lyrics), track["name"], artist_name, track["id"]): position
+            for position, track in enumerate(tracks)
+        }
+        for future in as_completed(futures):
+            ingest.add(futures[future], future)
+    return ingest.finish()
+
+
+# Function to parse each track's lyrics into sections and store the album's term and section index.
+# track_lyrics and track_album_arts are the raw lyrics / art URL of each track, in album order.
+# An album with tracks that have no lyrics is re-ingested after NO_LYRICS_TTL, when Genius may
+# have them. Returns the album art URL.
+def store_album_tracks(artist_name, album_id, album_name, tracks, track_lyrics, track_album_arts):
+    track_term_counts = {}
+    track_sections = {}
+    for number, (track, lyrics) in enumerate(zip(tracks, track_lyrics), 1):
+        key = (number, track["name"])
+        track_term_counts[key], track_sections[key] = analyze_lyrics(lyrics or "", artist_name)
+    # Use the album art of the first track in album order that has one
+    album_art = next((art for art in track_album_arts if art), None)
+    expires_at = datetime.now() + timedelta(seconds=NO_LYRICS_TTL) if not all(track_lyrics) else None
+    store_album_index(artist_name, album_name, album_id, album_art, track_term_counts, track_sections=track_sections, expires_at=expires_at)
+    print(f"Indexed {len(tracks)} tracks for album '{album_name}' by '{artist_name}'")
+    return album_art
+
+
+# Function to build an album's index without progress reporting; returns the index entry
+# (as get_album_index returns it), or None when the album has no tracks
+def ingest_album(artist_name, album_id, album_name):
+    return album_flights.run((artist_name, album_name), _ingest_album_tracks, artist_name, album_id, album_name).wait()
+
+
+# Function to queue an album ingestion for the job workers (see jobs.py); returns the job ID,
+# or None when the album has no tracks. Tracks whose lyrics are already stored are not re-fetched.
+def submit_album_ingest_job(artist_name, album_id, album_name):
+    tracks = get_spotify_album_track_items(album_id)
+    if not tracks:
+        return None
+    cached_positions = [position for position, track in enumerate(tracks) if get_cached_lyrics(artist_name, track["name"], track["id"])]
+    return submit_album_job(artist_name, album_id, album_name, tracks, cached_positions)
+
+
+_job_import_lock = threading.Lock()
+
+
+# Function to load a finished job's checkpointed lyrics into the lyrics store and the album's term index.
+# A job with tracks that weren't fetched is marked failed instead (the index would count them as empty),
+# and one whose cached tracks' stored lyrics have since been purged is queued again for those tracks.
+# Returns the job as get_job reports it afterwards.
+def import_album_job(job_id):
+    with _job_import_lock:
+        job = get_job(job_id)
+        if not job or job["status"] != "done":
+            return job
+        rows = get_job_tracks(job_id)
+        unfetched = [row["Track"] for row in rows if row["Status"] not in ("done", "cached")]
+        if unfetched:
+            set_job_status(job_id, "failed", f"Lyrics lookup failed for {len(unfetched)} track(s)")
+            return get_job(job_id)
+
+        artist_name, album_name = job["artist"], job["album"]
+        cached = {
+            row["Track_Index"]: get_cached_lyrics(artist_name, row["Track"], row["Track_Id"])
+            for row in rows if row["Status"] == "cached"
+        }
+        purged = [idx for idx, stored in cached.items() if not stored]
+        if purged:
+            print(f"Stored lyrics of {len(purged)} track(s) of '{album_name}' by '{artist_name}' are gone; requeueing job {job_id}")
+            requeue_job_tracks(job_id, purged)
+            return get_job(job_id)
+
+        tracks = []
+        track_lyrics = []
+        track_album_arts = []
+        for row in rows:
+            track = {"id": row["Track_Id"], "name": row["Track"]}
+            tracks.append(track)
+            if row["Status"] == "done" and row["Lyrics"]:
+                store_lyrics(artist_name, row["Track"], row["Track_Id"], row["Lyrics"], row["Album_Art"])
+                lyrics, track_album_art = row["Lyrics"], row["Album_Art"]
+            elif row["Status"] == "done":
+                store_no_lyrics(artist_name, row["Track"], row["Track_Id"], row["Album_Art"])
+                lyrics, track_album_art = "", row["Album_Art"]
+            else:
+                lyrics, track_album_art = cached[row["Track_Index"]]
+            track_lyrics.append(lyrics)
+            track_album_arts.append(track_album_art)
+        store_album_tracks(artist_name, job["albumId"], album_name, tracks, track_lyrics, track_album_arts)
+        set_job_status(job_id, "imported")
+        return get_job(job_id)
+
+
+# Function to import every finished job
+def import_finished_jobs():
+    for job_id in list_jobs("done"):
+        try:
+            import_album_job(job_id)
+        except Exception as e:
+            print(f"Error importing job {job_id}: {e}")
+
+
+# Function to start a background thread that imports finished jobs as the workers complete them
+def start_job_importer(interval=JOB_POLL_INTERVAL):
+    def run():
+        while True:
+            import_finished_jobs()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="job-importer", daemon=True)
+    thread.start()
+    return thread
+
+
+# Function to start counting words in an album from what is already stored: cached counts first,
+# then (when some words are missing) the album's index entry. Returns (word_counts, album_art,
+# missing words, index entry or None). This and finish_word_counts are the parts of a count shared
+# by every caller; only the ingestion between them (blocking, streamed or async) differs.
+def start_word_counts(artist_name, album_name, words):
+    cached = check_duckdb_cache_words(artist_name, album_name, words)
+    word_counts = {word: cached[word][0] for word in words if word in cached}
+    album_art = next((art for _, art in cached.values() if art), None)
+    missing = [word for word in words if word not in cached]
+    indexed = get_album_index(artist_name, album_name) if missing else None
+    return word_counts, album_art, missing, indexed
+
+
+# Function to count the missing words from the album's index (once it exists) and store their counts.
+# Returns ({word: count}, album_art), or None when the album has no index because it has no tracks.
+def finish_word_counts(artist_name, album_name, words, word_counts, album_art, missing, indexed):
+    if missing:
+        if not indexed:
+            return None
+        album_art = indexed[0] or album_art
+        new_counts = lookup_word_counts(artist_name, album_name, missing)
+        store_counts_in_duckdb(artist_name, album_name, new_counts, album_art)
+        word_counts = {**word_counts, **new_counts}
+    return {word: word_counts[word] for word in words}, album_art
+
+
+# Function to get an album's counts for words, using cached counts first and the index for the rest,
+# building the index only if the album was never indexed. New counts are stored in the counts cache.
+# Returns ({word: count}, album_art), or None when the album has no tracks.
+def get_album_word_counts(artist_name, album_id, album_name, words):
+    word_counts, album_art, missing, indexed = start_word_counts(artist_name, album_name, words)
+    if missing and not indexed:
+        indexed = ingest_album(artist_name, album_id, album_name)
+    return finish_word_counts(artist_name, album_name, words, word_counts, album_art, missing, indexed)
+
+
+# Function to count words in only some sections of an album (section types such as "verse", and/or
+# one performer's parts), ingesting the album first if it was never indexed or was indexed by an
+# older INDEX_VERSION (before sections were stored). Returns ({word: count}, album_art), or None
+# when the album has no tracks.
+def count_words_in_album_sections(artist_name, album_id, album_name, words, section_types=None, performer=None):
+    indexed = get_album_index(artist_name, album_name) or ingest_album(artist_name, album_id, album_name)
+    if not indexed:
+        return None
+    return lookup_section_word_counts(artist_name, album_name, words, section_types, performer), indexed[0]
+
+
+# Function to look up counts for words and phrases in the matching sections from the section index
+@timed_stage("count")
+def lookup_section_word_counts(artist_name, album_name, words, section_types=None, performer=None):
+    terms = {word: normalize_text(word) for word in words}
+    single_terms = [term for term in set(terms.values()) if term and " " not in term]
+    phrases = [term for term in set(terms.values()) if " " in term]
+
+    counts = get_album_section_term_counts(artist_name, album_name, single_terms, section_types, performer)
+    if phrases:
+        counts.update(count_phrases(get_album_section_texts(artist_name, album_name, section_types, performer), phrases))
+    return {word: counts.get(term, 0) for word, term in terms.items()}
+
+
+# Function to clean up requested section types; returns None for an unknown type
+def parse_section_types(section_types):
+    cleaned = parse_words(section_types)
+    if any(section_type not in SECTION_TYPES for section_type in cleaned):
+        return None
+    return cleaned
+
+
+# Function to look up album-wide counts for words and multi-word phrases from the index.
+# Single words are one indexed lookup; phrases are counted in one pass over the album's tokens.
+@timed_stage("count")
+def lookup_word_counts(artist_name, album_name, words):
+    terms = {word: normalize_text(word) for word in words}
+    single_terms = [term for term in set(terms.values()) if term and " " not in term]
+    phrases = [term for term in set(terms.values()) if " " in term]
+
+    counts = get_album_term_counts(artist_name, album_name, single_terms)
+    if phrases:
+        counts.update(count_phrases(get_album_normalized_lyrics(artist_name, album_name), phrases))
+    return {word: counts.get(term, 0) for word, term in terms.items()}
+
+
+# Function to count phrases in a single pass over each track's tokens (phrases never span tracks)
+def count_phrases(normalized_lyrics_list, phrases):
+    phrases_by_first_token = {}
+    for phrase in phrases:
+        phrase_tokens = phrase.split()
+        phrases_by_first_token.setdefault(phrase_tokens[0], []).append((phrase, phrase_tokens))
+
+    counts = {phrase: 0 for phrase in phrases}
+    for normalized_lyrics in normalized_lyrics_list:
+        tokens = normalized_lyrics.split()
+        for idx, token in enumerate(tokens):
+            for phrase, phrase_tokens in phrases_by_first_token.get(token, ()):
+                if tokens[idx:idx + len(phrase_tokens)] == phrase_tokens:
+                    counts[phrase] += 1
+    return counts
+
+
+# Function to clean up the requested words, keeping their order and dropping duplicates/blanks
+def parse_words(words):
+    cleaned = []
+    for word in words:
+        if not isinstance(word, str):
+            continue
+        word = word.strip().lower()
+        if word and word not in cleaned:
+            cleaned.append(word)
+    return cleaned
+
+
+# Function to build the JSON result for an album; single-word requests keep the old word/count fields
+def build_count_result(artist, album_name, word_counts, album_art):
+    result = {
+        "artist": artist,
+        "album": album_name,
+        "counts": word_counts,
+        "albumArt": album_art
+    }
+    if len(word_counts) == 1:
+        word, count = next(iter(word_counts.items()))
+        result["word"] = word
+        result["count"] = count
+    return result
+
+
+# Function to build the error payload (JSON body or SSE event) for an album some of whose tracks
+# couldn't be looked up
+def incomplete_result(error):
+    return {
+        "error": f"Lyrics lookup failed for {len(error.failed_tracks)} track(s), try again later",
+        "failedTracks": error.failed_tracks
+    }
+
+
+# Function to build the error payload (JSON body or SSE event) for a request an upstream throttled.
+# retryAfter is whole seconds, as in the Retry-After header.
+def throttled_result(error):
+    return {
+        "error": f"Rate limited by {error.upstream}, try again later",
+        "retryAfter": math.ceil(error.retry_after)
+    }
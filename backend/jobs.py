@@ -0,0 +1,382 @@
+# Local job subsystem for album ingestion. Jobs and per-track checkpoints live in a SQLite
+# database (safe to share between processes, unlike the DuckDB cache), and worker processes
+# fetch lyrics from Genius into it. The app imports finished jobs into DuckDB.
+#
+# Run workers with:  python jobs.py --workers 4
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import argparse
+import multiprocessing
+from datetime import datetime
+from rap_genius_utils import get_song_info_from_genius, GENIUS_TIMEOUT
+from metrics import register_collector
+from rate_limiter import UpstreamThrottled, RATE_LIMIT_MAX_WAIT
+from dotenv import load_dotenv
+
+load_dotenv()
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "./jobs.db")
+# Longest one track lookup can take: up to three Genius requests, each of which may wait out the rate
+# limiter before its timeout starts
+JOB_TRACK_MAX_SECONDS = 3 * (GENIUS_TIMEOUT + RATE_LIMIT_MAX_WAIT)
+# A running job whose worker hasn't checked in for this long is considered crashed and is resumed.
+# Workers check in before and after each track, so this has to outlast the slowest lookup.
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", str(max(60, 2 * JOB_TRACK_MAX_SECONDS))))
+# How often idle workers look for new jobs
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+# How many times a track whose lookup fails is tried before its job fails, and the wait before the
+# first retry (doubled for each further one); the job goes back in the queue meanwhile
+JOB_TRACK_MAX_ATTEMPTS = int(os.getenv("JOB_TRACK_MAX_ATTEMPTS", "3"))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "30"))
+
+# Job statuses: queued -> running -> done -> imported (into DuckDB by the app), or failed.
+# Track statuses: pending -> done, or failed once JOB_TRACK_MAX_ATTEMPTS lookups have failed;
+# cached tracks already had lyrics stored when the job was submitted.
+ACTIVE_STATUSES = ("queued", "running")
+
+
+# Function to open the jobs database (autocommit; writers take BEGIN IMMEDIATE themselves)
+def connect_jobs_db():
+    con = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    return con
+
+
+def init_jobs_db():
+    con = connect_jobs_db()
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+        Job_Id TEXT PRIMARY KEY,
+        Kind TEXT,
+        Artist TEXT,
+        Album_Id TEXT,
+        Album TEXT,
+        Status TEXT,
+        Worker TEXT,
+        Error TEXT,
+        Created_At REAL,
+        Updated_At REAL,
+        Heartbeat_At REAL,
+        Retry_At REAL
+    )
+    ''')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS job_tracks (
+        Job_Id TEXT,
+        Track_Index INTEGER,
+        Track_Id TEXT,
+        Track TEXT,
+        Status TEXT,
+        Lyrics TEXT,
+        Album_Art TEXT,
+        Error TEXT,
+        Finished_At REAL,
+        Attempts INTEGER DEFAULT 0,
+        Retry_At REAL,
+        PRIMARY KEY (Job_Id, Track_Index)
+    )
+    ''')
+    # Columns added after the first release
+    for table, column, sql_type in [("jobs", "Retry_At", "REAL"), ("job_tracks", "Attempts", "INTEGER DEFAULT 0"), ("job_tracks", "Retry_At", "REAL")]:
+        if column not in [row["name"] for row in con.execute(f"PRAGMA table_info({table})")]:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {sql_type}")
+    # Normalized lyrics aren't checkpointed any more (albums are tokenized when they are indexed)
+    if "Normalized_Lyrics" in [row["name"] for row in con.execute("PRAGMA table_info(job_tracks)")]:
+        con.execute("ALTER TABLE job_tracks DROP COLUMN Normalized_Lyrics")
+    con.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (Status)")
+    con.close()
+
+
+init_jobs_db()
+
+
+@register_collector
+def job_metrics():
+    con = connect_jobs_db()
+    try:
+        rows = con.execute("SELECT Status, COUNT(*) FROM jobs GROUP BY Status").fetchall()
+    finally:
+        con.close()
+    counts = {status: 0 for status in ("queued", "running", "done", "imported", "failed")}
+    counts.update({status: count for status, count in rows})
+    return [("lyrics_jobs", "gauge", "Ingestion jobs by status (queued and running are in flight)",
+             [({"status": status}, count) for status, count in counts.items()])]
+
+
+# Function to submit an album ingestion job. tracks is a list of {"id", "name"} in album order; tracks
+# whose lyrics are already stored (cached_positions, indexes into tracks) are checkpointed as "cached"
+# so workers skip them.
+# An identical job that is still queued or running is reused instead of creating a new one.
+def submit_album_job(artist_name, album_id, album_name, tracks, cached_positions=()):
+    con = connect_jobs_db()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        existing = con.execute(
+            f"SELECT Job_Id FROM jobs WHERE Artist = ? AND Album = ? AND Status IN ({', '.join('?' for _ in ACTIVE_STATUSES)})",
+            [artist_name, album_name, *ACTIVE_STATUSES]
+        ).fetchone()
+        if existing:
+            con.execute("COMMIT")
+            return existing["Job_Id"]
+
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        con.execute(
+            "INSERT INTO jobs (Job_Id, Kind, Artist, Album_Id, Album, Status, Created_At, Updated_At) VALUES (?, 'album_ingest', ?, ?, ?, 'queued', ?, ?)",
+            [job_id, artist_name, album_id, album_name, now, now]
+        )
+        cached_positions = set(cached_positions)
+        con.executemany(
+            "INSERT INTO job_tracks (Job_Id, Track_Index, Track_Id, Track, Status, Finished_At) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                [job_id, idx, track.get("id"), track["name"],
+                 "cached" if idx in cached_positions else "pending",
+                 now if idx in cached_positions else None]
+                for idx, track in enumerate(tracks)
+            ]
+        )
+        con.execute("COMMIT")
+        return job_id
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+
+
+# Function to get a job with its progress; returns None for unknown job IDs
+def get_job(job_id):
+    con = connect_jobs_db()
+    try:
+        job = con.execute("SELECT * FROM jobs WHERE Job_Id = ?", [job_id]).fetchone()
+        if not job:
+            return None
+        progress = con.execute(
+            "SELECT COUNT(*) AS Total, SUM(Status IN ('done', 'cached')) AS Finished, SUM(Status = 'failed') AS Failed FROM job_tracks WHERE Job_Id = ?",
+            [job_id]
+        ).fetchone()
+        last_track = con.execute(
+            "SELECT Track FROM job_tracks WHERE Job_Id = ? AND Finished_At IS NOT NULL ORDER BY Finished_At DESC LIMIT 1",
+            [job_id]
+        ).fetchone()
+    finally:
+        con.close()
+    return {
+        "jobId": job["Job_Id"],
+        "artist": job["Artist"],
+        "albumId": job["Album_Id"],
+        "album": job["Album"],
+        "status": job["Status"],
+        "error": job["Error"],
+        "totalTracks": progress["Total"],
+        "finishedTracks": progress["Finished"] or 0,
+        "failedTracks": progress["Failed"] or 0,
+        "lastTrack": last_track["Track"] if last_track else None,
+        "createdAt": job["Created_At"],
+        "updatedAt": job["Updated_At"]
+    }
+
+
+# Function to get a job's tracks and their checkpointed lyrics
+def get_job_tracks(job_id):
+    con = connect_jobs_db()
+    try:
+        rows = con.execute("SELECT * FROM job_tracks WHERE Job_Id = ? ORDER BY Track_Index", [job_id]).fetchall()
+    finally:
+        con.close()
+    return [dict(row) for row in rows]
+
+
+# Function to list job IDs with a given status (oldest first)
+def list_jobs(status):
+    con = connect_jobs_db()
+    try:
+        rows = con.execute("SELECT Job_Id FROM jobs WHERE Status = ? ORDER BY Created_At", [status]).fetchall()
+    finally:
+        con.close()
+    return [row["Job_Id"] for row in rows]
+
+
+# Function to set a job's status; with worker_id, only while that worker still holds the job
+def set_job_status(job_id, status, error=None, worker_id=None):
+    con = connect_jobs_db()
+    try:
+        con.execute(
+            f"UPDATE jobs SET Status = ?, Error = ?, Updated_At = ? WHERE Job_Id = ?{' AND Worker = ?' if worker_id else ''}",
+            [status, error, time.time(), job_id, *([worker_id] if worker_id else [])]
+        )
+    finally:
+        con.close()
+
+
+# Function to send tracks of a job (by Track_Index) back to the workers, e.g. cached tracks whose
+# stored lyrics are gone by the time the job is imported; the job is queued again
+def requeue_job_tracks(job_id, track_indexes):
+    con = connect_jobs_db()
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        con.executemany(
+            """
+            UPDATE job_tracks SET Status = 'pending', Lyrics = NULL, Album_Art = NULL,
+                Error = NULL, Finished_At = NULL, Attempts = 0, Retry_At = NULL
+            WHERE Job_Id = ? AND Track_Index = ?
+            """,
+            [[job_id, idx] for idx in track_indexes]
+        )
+        con.execute(
+            "UPDATE jobs SET Status = 'queued', Error = NULL, Retry_At = NULL, Worker = NULL, Updated_At = ? WHERE Job_Id = ?",
+            [time.time(), job_id]
+        )
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+
+
+# Function for a worker to check in on a job it is running (in the transaction it was called in);
+# returns False when the job was taken over by another worker (after going stale) or requeued
+def _heartbeat(con, job_id, worker_id):
+    now = time.time()
+    return con.execute(
+        "UPDATE jobs SET Heartbeat_At = ?, Updated_At = ? WHERE Job_Id = ? AND Worker = ? AND Status = 'running'",
+        [now, now, job_id, worker_id]
+    ).rowcount > 0
+
+
+# Function for a worker to take the oldest queued job (once its retry time has come), or resume a
+# running job whose worker went stale
+def claim_job(con, worker_id):
+    now = time.time()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        job = con.execute(
+            """
+            SELECT * FROM jobs
+            WHERE (Status = 'queued' AND (Retry_At IS NULL OR Retry_At <= ?)) OR (Status = 'running' AND Heartbeat_At < ?)
+            ORDER BY Created_At LIMIT 1
+            """,
+            [now, now - JOB_STALE_SECONDS]
+        ).fetchone()
+        if job:
+            if job["Status"] == "running":
+                print(f"Resuming job {job['Job_Id']} abandoned by {job['Worker']}")
+            con.execute(
+                "UPDATE jobs SET Status = 'running', Worker = ?, Heartbeat_At = ?, Updated_At = ? WHERE Job_Id = ?",
+                [worker_id, now, now, job["Job_Id"]]
+            )
+        con.execute("COMMIT")
+        return job
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+
+
+# Function to fetch a claimed job's remaining tracks, checkpointing each one as it finishes.
+# A throttled track stays pending and UpstreamThrottled is raised, so the job can be retried later.
+# A track whose lookup fails stays pending until its retry time (see JOB_RETRY_DELAY) and the job
+# goes back in the queue; after JOB_TRACK_MAX_ATTEMPTS failures the track, and so the job, fails.
+# A job is only done when every track has lyrics (or is known to have none). The worker checks in
+# before and after each track; if another worker has taken the job over, it stops without writing.
+def process_job(con, job, worker_id):
+    pending = con.execute(
+        """
+        SELECT Track_Index, Track, Attempts FROM job_tracks
+        WHERE Job_Id = ? AND Status = 'pending' AND (Retry_At IS NULL OR Retry_At <= ?)
+        ORDER BY Track_Index
+        """,
+        [job["Job_Id"], time.time()]
+    ).fetchall()
+    for track in pending:
+        if not _heartbeat(con, job["Job_Id"], worker_id):
+            print(f"Job {job['Job_Id']} was taken over by another worker; {worker_id} stops")
+            return
+        attempts = (track["Attempts"] or 0) + 1
+        try:
+            lyrics, album_art = get_song_info_from_genius(track["Track"], job["Artist"])
+            row = ["done", lyrics, album_art, None, time.time(), None]
+        except UpstreamThrottled:
+            raise
+        except Exception as e:
+            if attempts < JOB_TRACK_MAX_ATTEMPTS:
+                row = ["pending", None, None, str(e), None, time.time() + JOB_RETRY_DELAY * 2 ** (attempts - 1)]
+            else:
+                row = ["failed", None, None, str(e), time.time(), None]
+        # The checkpoint is only written while this worker still holds the job
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            held = _heartbeat(con, job["Job_Id"], worker_id)
+            if held:
+                con.execute(
+                    "UPDATE job_tracks SET Status = ?, Lyrics = ?, Album_Art = ?, Error = ?, Finished_At = ?, Retry_At = ?, Attempts = ? WHERE Job_Id = ? AND Track_Index = ?",
+                    [*row, attempts, job["Job_Id"], track["Track_Index"]]
+                )
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        if not held:
+            print(f"Job {job['Job_Id']} was taken over by another worker; {worker_id} stops")
+            return
+
+    remaining = con.execute(
+        "SELECT SUM(Status = 'pending') AS Pending, SUM(Status = 'failed') AS Failed, MIN(Retry_At) AS Retry_At FROM job_tracks WHERE Job_Id = ?",
+        [job["Job_Id"]]
+    ).fetchone()
+    if remaining["Pending"]:
+        status, error, retry_at = "queued", None, remaining["Retry_At"]
+    elif remaining["Failed"]:
+        status, error, retry_at = "failed", f"Lyrics lookup failed for {remaining['Failed']} track(s)", None
+    else:
+        status, error, retry_at = "done", None, None
+    con.execute(
+        "UPDATE jobs SET Status = ?, Error = ?, Retry_At = ?, Updated_At = ? WHERE Job_Id = ? AND Worker = ? AND Status = 'running'",
+        [status, error, retry_at, time.time(), job["Job_Id"], worker_id]
+    )
+
+
+# Worker loop: claim jobs one at a time until stopped
+def run_worker(worker_id=None):
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    con = connect_jobs_db()
+    print(f"Job worker {worker_id} started")
+    while True:
+        job = claim_job(con, worker_id)
+        if not job:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        print(f"[{datetime.now():%H:%M:%S}] {worker_id} ingesting '{job['Album']}' by '{job['Artist']}' ({job['Job_Id']})")
+        try:
+            process_job(con, job, worker_id)
+        except UpstreamThrottled as e:
+            # Back in the queue with its checkpoints; every worker shares the limiter, so wait out the block
+            print(f"Job {job['Job_Id']} throttled by {e.upstream}, requeued; retrying in {e.retry_after:.1f}s")
+            set_job_status(job["Job_Id"], "queued", worker_id=worker_id)
+            time.sleep(e.retry_after)
+        except Exception as e:
+            print(f"Job {job['Job_Id']} failed: {e}")
+            set_job_status(job["Job_Id"], "failed", str(e), worker_id=worker_id)
+
+
+# Function to start worker processes; returns the Process objects
+def start_workers(count):
+    processes = []
+    for _ in range(count):
+        process = multiprocessing.Process(target=run_worker, daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run album ingestion job workers")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("JOB_WORKERS", "2")), help="number of worker processes")
+    args = parser.parse_args()
+    workers = start_workers(args.workers)
+    for worker in workers:
+        worker.join()
@@ -0,0 +1,90 @@
+# Parser for Genius lyrics: strips the page furniture that comes with them (the
+# "ContributorsLyrics" preamble, "You might also like", trailing "Embed") and splits songs into
+# sections by their [Type N: Performer] headers, so headers are never counted as lyrics and
+# counts can be limited to verses, choruses or one performer's parts.
+import re
+from collections import Counter, namedtuple
+from tokenizer import tokenize
+from metrics import timed_stage
+
+# "123 ContributorsTranslationsSong Title Lyrics" (first line), optionally followed by a "... Read More" blurb
+PREAMBLE_RE = re.compile(r"^[^\n\[]*?Lyrics(?=\[|\n|$)(?:[^\[]*?Read More\s*)?")
+EMBED_RE = re.compile(r"\d*\s*Embed\s*$")
+JUNK_RE = re.compile(r"You might also like|See [^\n\[]*? LiveGet tickets as low as \$\d+")
+HEADER_RE = re.compile(r"^[ \t]*\[([^\]\n]+)\][ \t]*$", re.MULTILINE)
+PERFORMER_SPLIT_RE = re.compile(r"\s*(?:&|,|\+|/|\(|\)|\band\b|\bwith\b|\bfeat\.?|\bft\.?)\s*", re.IGNORECASE)
+
+SECTION_TYPES = (
+    "intro", "verse", "pre-chorus", "chorus", "post-chorus", "refrain", "bridge",
+    "interlude", "breakdown", "skit", "outro", "other"
+)
+# Header words mapped to a section type; checked in order so "pre-chorus" wins over "chorus"
+SECTION_ALIASES = (
+    ("pre-chorus", "pre-chorus"), ("prechorus", "pre-chorus"), ("post-chorus", "post-chorus"),
+    ("postchorus", "post-chorus"), ("chorus", "chorus"), ("hook", "chorus"), ("refrain", "refrain"),
+    ("verse", "verse"), ("bridge", "bridge"), ("intro", "intro"), ("outro", "outro"),
+    ("interlude", "interlude"), ("break", "breakdown"), ("skit", "skit"),
+)
+
+# type is one of SECTION_TYPES; performers is a tuple of lowercase names (empty when the header names nobody)
+Section = namedtuple("Section", ["type", "label", "performers", "text"])
+
+
+# Function to remove the Genius page furniture around and inside lyrics
+def clean_lyrics(lyrics):
+    if not lyrics:
+        return ""
+    lyrics = PREAMBLE_RE.sub("", lyrics, count=1)
+    lyrics = EMBED_RE.sub("", lyrics)
+    lyrics = JUNK_RE.sub("\n", lyrics)
+    return lyrics.strip()
+
+
+def section_type(label):
+    label = label.strip().lower()
+    for alias, name in SECTION_ALIASES:
+        if alias in label:
+            return name
+    return "other"
+
+
+def parse_performers(names):
+    return tuple(name.strip().lower() for name in PERFORMER_SPLIT_RE.split(names) if name.strip())
+
+
+# Function to split lyrics into sections by their headers; text before the first header is an "other" section
+def parse_sections(lyrics):
+    lyrics = clean_lyrics(lyrics)
+    sections = []
+    current = ("other", "", ())
+    start = 0
+    for match in HEADER_RE.finditer(lyrics):
+        text = lyrics[start:match.start()].strip()
+        if text:
+            sections.append(Section(*current, text))
+        label, _, names = match.group(1).partition(":")
+        current = (section_type(label), label.strip(), parse_performers(names))
+        start = match.end()
+    text = lyrics[start:].strip()
+    if text:
+        sections.append(Section(*current, text))
+    return sections
+
+
+# Function to parse and tokenize a track once. Sections without named performers are credited to
+# the track's artist. Repeated sections (e.g. every chorus) are only tokenized the first time, and
+# each section's tokens are counted as they come out of the tokenizer (not re-split from its text).
+# Returns (track term counts, [(type, performers, normalized_text, term_counts), ...]).
+@timed_stage("normalize")
+def analyze_lyrics(lyrics, artist_name):
+    tokenized = {}
+    track_counts = Counter()
+    sections = []
+    for section in parse_sections(lyrics):
+        if section.text not in tokenized:
+            tokens = tokenize(section.text)
+            tokenized[section.text] = (" ".join(tokens), Counter(tokens))
+        normalized, term_counts = tokenized[section.text]
+        track_counts.update(term_counts)
+        sections.append((section.type, section.performers or (artist_name,), normalized, term_counts))
+    return track_counts, sections
@@ -0,0 +1,267 @@
+# Process-wide metrics for the hot path, exposed in the Prometheus text format on /metrics.
+#
+# Stages (Spotify calls, Genius searches, normalization, counting, DuckDB reads/writes) are timed
+# with `timed(stage)` / `@timed_stage(stage)` into one histogram. While a request collects its own
+# timings (?timings=1), the same measurements are also added to its RequestTimings so the response
+# can include a per-stage breakdown. Stages can run concurrently (tracks are fetched in parallel)
+# and "count" includes the DuckDB reads it makes, so a request's stage times may add up to more
+# than its total.
+#
+# Gauges that are cheap to read at scrape time (cache sizes, in-flight jobs, pending writes) are
+# registered as collectors by the modules that own the data.
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Histogram buckets in seconds, from a cached DuckDB read to a slow Genius scrape
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Every metric and collector registers itself here, in exposition order
+METRICS = {}
+COLLECTORS = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, one value per combination of label values."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS[name] = self
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, labelvalues)))} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    """Value that can go up and down (e.g. requests in flight)."""
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def expose(self):
+        lines = super().expose()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram of observations (seconds), one series per combination of label values."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        METRICS[name] = self
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * len(self.buckets) + [0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labelvalues, series in sorted(self._series.items()):
+                labels = dict(zip(self.labelnames, labelvalues))
+                for bound, count in zip(self.buckets + (float("inf"),), series[:-2] + [series[-1]]):
+                    lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le=_format_value(float(bound))))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+
+# Register fn() -> [(name, type, documentation, [(labels dict, value), ...]), ...], called on every scrape
+def register_collector(fn):
+    COLLECTORS.append(fn)
+    return fn
+
+
+# Function to render every metric and collector in the Prometheus text exposition format
+def render_metrics():
+    lines = []
+    for metric in list(METRICS.values()):
+        lines.extend(metric.expose())
+    for collector in COLLECTORS:
+        try:
+            families = collector()
+        except Exception as e:
+            print(f"Error collecting metrics from {collector.__name__}: {e}")
+            continue
+        for name, metric_type, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in samples)
+    return "\n".join(lines) + "\n"
+
+
+stage_seconds = Histogram("lyrics_stage_seconds", "Time spent in each hot-path stage", ["stage"])
+upstream_requests = Counter(
+    "lyrics_upstream_requests_total", "Upstream API calls by outcome (ok, not_found, throttled, error)", ["upstream", "outcome"]
+)
+http_request_seconds = Histogram(
+    "lyrics_http_request_seconds", "Time to produce each endpoint's response (streams: until the first byte)", ["endpoint"]
+)
+http_requests = Counter("lyrics_http_requests_total", "Requests by endpoint and status code", ["endpoint", "status"])
+http_requests_in_flight = Gauge("lyrics_http_requests_in_flight", "Requests currently being handled")
+
+
+class RequestTimings:
+    """Per-stage call counts and seconds collected for one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            calls, total = self._stages.get(stage, (0, 0.0))
+            self._stages[stage] = (calls + 1, total + seconds)
+
+    def as_dict(self):
+        with self._lock:
+            stages = {
+                stage: {"calls": calls, "ms": round(total * 1000, 3)}
+                for stage, (calls, total) in sorted(self._stages.items())
+            }
+        return {"totalMs": round((time.perf_counter() - self.started) * 1000, 3), "stages": stages}
+
+
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+# Function to make timings (a RequestTimings, or None to stop collecting) the current request's
+def use_timings(timings):
+    _request_timings.set(timings)
+    return timings
+
+
+def current_timings():
+    return _request_timings.get()
+
+
+# Function to check a request's ?timings= flag
+def wants_timings(value):
+    return (value or "").strip().lower() in ("1", "true", "yes")
+
+
+# Function to add the current request's timing breakdown to a result dict (when it is collecting one)
+def with_timings(result):
+    timings = _request_timings.get()
+    if timings is not None:
+        result["timings"] = timings.as_dict()
+    return result
+
+
+# Function to wrap fn so it records into the caller's RequestTimings when run on another thread
+def propagate_timings(fn):
+    timings = _request_timings.get()
+    if timings is None:
+        return fn
+
+    @wraps(fn)
+    def run(*args, **kwargs):
+        token = _request_timings.set(timings)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _request_timings.reset(token)
+    return run
+
+
+def record_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+# Decorator that times every call of a function as a stage
+def timed_stage(stage):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Function to get the HTTP status behind an upstream failure (requests/httpx errors, lyricsgenius HTTPError,
+# rate_limiter.UpstreamThrottled)
+def error_status(error):
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", getattr(error, "status_code", None))
+    if status is None and error.args and isinstance(error.args[0], int):
+        status = error.args[0]
+    return status
+
+
+# Function to classify an upstream HTTP status code as an outcome label
+def status_outcome(status):
+    if status == 429:
+        return "throttled"
+    if status == 404:
+        return "not_found"
+    if status is None or status >= 400:
+        return "error"
+    return "ok"
+
+
+def record_upstream(upstream, status=None, error=None):
+    if error is not None:
+        status = error_status(error)
+    upstream_requests.inc(upstream, status_outcome(status))
@@ -1,70 +1,138 @@
 import os
-import lyricsgenius
-from spotify_utils import get_spotify_album_tracks
 import re
+import requests
+import lyricsgenius
+from lyricsgenius.utils import clean_str
+from bs4 import BeautifulSoup, NavigableString
+from lyrics_parser import clean_lyrics
+from metrics import timed_stage, record_upstream
+from rate_limiter import AdaptiveRateLimiter, RateLimitedAdapter
+from upstream_steps import run_steps
 from dotenv import load_dotenv
 
+try:
+    # Reads the lyrics embedded in a song page's state (lyricsgenius >= 3.12); used when the page has no lyrics containers
+    from lyricsgenius.genius import _preloaded_lyrics_html
+except ImportError:
+    _preloaded_lyrics_html = None
+
 load_dotenv()
 
-# Replace with your Genius API token 
+# Replace with your Genius API token
 GENIUS_ACCESS_TOKEN = os.getenv("GENIUS_ACCESS_TOKEN")
-genius = lyricsgenius.Genius(GENIUS_ACCESS_TOKEN)
+# Per-request timeout (seconds) for Genius calls so one slow track can't stall an album
+GENIUS_TIMEOUT = int(os.getenv("GENIUS_TIMEOUT", "10"))
+# Genius API root and web root (song pages are scraped from the web root); point both at a local
+# stand-in such as bench_stubs.py to run without the real service
+GENIUS_API_URL = os.getenv("GENIUS_API_URL", "https://api.genius.com")
+GENIUS_WEB_URL = os.getenv("GENIUS_WEB_URL", "https://genius.com")
+# Requests per second to Genius (each song lookup is two or three: search, maybe a second search,
+# lyrics page) and how many can go out at once; shared by every process on the host, 0 turns pacing off
+GENIUS_RATE_LIMIT = float(os.getenv("GENIUS_RATE_LIMIT", "10"))
+GENIUS_BURST = float(os.getenv("GENIUS_BURST", "20"))
+genius_limiter = AdaptiveRateLimiter("genius", GENIUS_RATE_LIMIT, GENIUS_BURST)
+
+# Search results are matched with lyricsgenius's own rules; the requests are ours (see song_page_steps)
+genius = lyricsgenius.Genius(GENIUS_ACCESS_TOKEN, timeout=GENIUS_TIMEOUT, sleep_time=0)
+
+# Keep-alive session for the blocking lookups. genius_limiter paces its requests and backs off on
+# 429s, which raise UpstreamThrottled (instead of the error page being read as "no lyrics").
+genius_session = requests.Session()
+genius_session.mount("https://", RateLimitedAdapter(genius_limiter))
+genius_session.mount("http://", RateLimitedAdapter(genius_limiter))
+
+
+# Function to pick the song from the hits of the API's /search the way lyricsgenius does:
+# an exact title and artist match, else the first song by the artist
+def _pick_search_hit(hits, song_name, artist_name):
+    results = [hit["result"] for hit in hits]
+    for result in results:
+        if genius._result_is_match(result, song_name, artist_name):
+            return result
+    for result in results:
+        if "primary_artist" in result and "url" in result:
+            if artist_name and clean_str(result["primary_artist"]["name"]) != clean_str(artist_name):
+                continue
+            return result
+    return None
+
+
+# Steps (see upstream_steps.py) of a song lookup, following lyricsgenius's search_song: search/multi,
+# then the API's /search when that finds nothing, then the song page. Each request is (url, params, headers).
+# Returns (page HTML, album art URL), or (None, None) when Genius has no lyrics for the song.
+def song_page_steps(song_name, artist_name):
+    search_term = f"{song_name} {artist_name}".strip()
+    response = yield (f"{GENIUS_WEB_URL}/api/search/multi", {"q": search_term}, {})
+    response.raise_for_status()
+    song = genius._get_item_from_search_response(
+        response.json()["response"], song_name, type_="song", result_type="title", artist=artist_name
+    )
+    if song is None:
+        response = yield (f"{GENIUS_API_URL}/search", {"q": search_term}, {"Authorization": f"Bearer {GENIUS_ACCESS_TOKEN}"})
+        response.raise_for_status()
+        song = _pick_search_hit(response.json()["response"]["hits"], song_name, artist_name)
 
+    # Not a song (track lists, liner notes, ...) or one without lyrics (instrumentals, unreleased songs)
+    if song is None or not genius._result_is_lyrics(song):
+        return None, None
 
+    # Song URLs always name genius.com; fetch them from the configured web root
+    page = yield (song["url"].replace("https://genius.com", GENIUS_WEB_URL, 1), None, {})
+    if page.status_code == 404:
+        return None, None
+    page.raise_for_status()
+    return page.text, song.get("song_art_image_url")
 
-def normalize_text(text):
-    # Lowercase everything
-    text = text.lower()
-    
-    # Remove punctuation/special characters
-    text = re.sub(r'[^a-z0-9\s]', '', text)
 
-    # Replace multiple spaces with one
-    text = re.sub(r'\s+', ' ', text).strip()
-    
-    return text
+# Function to pull the lyrics text out of a Genius song page (the same containers lyricsgenius reads)
+def extract_lyrics_from_html(page):
+    soup = BeautifulSoup(page, "html.parser")
+    for header in soup.find_all("div", class_=re.compile("LyricsHeader")):
+        header.decompose()
+    containers = soup.find_all("div", attrs={"data-lyrics-container": "true"})
+    if not containers:
+        html = _preloaded_lyrics_html(page) if _preloaded_lyrics_html else None
+        if not html:
+            return ""
+        fragment = BeautifulSoup(html.replace("\n", ""), "html.parser")
+        for br in fragment.find_all("br"):
+            br.replace_with(NavigableString("\n"))
+        return clean_lyrics(fragment.get_text())
+    for br in soup.find_all("br"):
+        br.replace_with(NavigableString("\n"))
+    lyrics = ""
+    for container in containers:
+        for element in container.contents:
+            if isinstance(element, NavigableString):
+                lyrics += str(element)
+            elif element.get("data-exclude-from-selection") != "true":
+                lyrics += element.get_text()
+        lyrics += "\n"
+    return clean_lyrics(lyrics)
 
-# Function to search for lyrics on Genius using song names and get album art
+
+# Function to turn a looked-up song page into (lyrics, album art URL); ("", None) when it has no lyrics
+def read_song_page(page, album_art):
+    lyrics = extract_lyrics_from_html(page) if page else ""
+    if not lyrics:
+        return "", None
+    return lyrics, album_art
+
+
+def _send(request):
+    url, params, headers = request
+    return genius_session.get(url, params=params, headers=headers, timeout=GENIUS_TIMEOUT)
+
+
+# Function to search for lyrics on Genius using song names and get album art.
+# Returns ("", None) when Genius has no such song; a failed or throttled lookup raises instead
+# (UpstreamThrottled when rate limited), so it isn't mistaken for a track without lyrics.
+@timed_stage("genius")
 def get_song_info_from_genius(song_name, artist_name):
     try:
-        song = genius.search_song(song_name, artist_name)
-        if song:
-            lyrics = song.lyrics
-            album_art_url = song.song_art_image_url
-            return lyrics, album_art_url
-        else:
-            return "", None
+        lyrics, album_art = read_song_page(*run_steps(song_page_steps(song_name, artist_name), _send))
     except Exception as e:
-        print(f"Error fetching song from Genius: {e}")
-        return "", None
-
-# Function to count occurrences of a word in an album's lyrics and get album art
-def count_word_occurrences(album_id, artist_name, word, progress_callback=None):
-    tracks = get_spotify_album_tracks(album_id)
-    if not tracks:
-        return 0, None
-
-    word_count = 0
-    album_art = None
-    total_tracks = len(tracks)
-    for idx, track_name in enumerate(tracks, 1):
-        if progress_callback:
-            try:
-                progress_callback(track_name, idx, total_tracks)
-            except:
-                pass  # Ignore generator issues
-                
-        lyrics, track_album_art = get_song_info_from_genius(track_name, artist_name)
-        if lyrics:
-            # Normalize both the lyrics and the word for comparison
-            normalized_lyrics = normalize_text(lyrics)
-            normalized_word = normalize_text(word)
-            # Split lyrics into words and count occurrences
-            lyrics_words = normalized_lyrics.split()
-            word_count += lyrics_words.count(normalized_word)
-            print(f"Track: {track_name}, Word '{word}' found {lyrics_words.count(normalized_word)} times")
-        if track_album_art and not album_art:  # Get album art from the first track
-            album_art = track_album_art
-    
-    print(f"Total count for '{word}' in album: {word_count}")
-    return word_count, album_art
+        record_upstream("genius", error=e)
+        raise
+    record_upstream("genius", 200 if lyrics else 404)
+    return lyrics, album_art
@@ -0,0 +1,227 @@
+# Adaptive token-bucket rate limits for the upstream APIs (Genius, Spotify). Bucket state lives in
+# a small SQLite file, so every thread and process on the host (the app, job workers, warm_cache.py)
+# draws from one budget per upstream.
+#
+# A bucket refills at the upstream's current rate up to `burst` tokens and each request takes one,
+# waiting when the bucket is empty. A 429 halves the rate (down to min_rate) and blocks the upstream
+# until its Retry-After has passed; every later success adds back a step of the configured rate.
+# When the wait would be longer than max_wait, UpstreamThrottled is raised instead of sleeping, so
+# the caller can give up on the fetch and retry it later instead of recording a result.
+import os
+import time
+import sqlite3
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from metrics import timed, register_collector
+
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", "./rate_limits.db")
+# Longest a request waits for its upstream before UpstreamThrottled is raised instead
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+# On a 429 the rate is multiplied by BACKOFF_FACTOR; each success adds RECOVERY_STEP of the configured rate
+BACKOFF_FACTOR = 0.5
+RECOVERY_STEP = 0.05
+# Block after a 429 that came without a Retry-After header
+DEFAULT_RETRY_AFTER = 1.0
+
+
+class UpstreamThrottled(Exception):
+    """An upstream is rate limiting us; retry_after is the number of seconds until it may be called again."""
+
+    # Reported like the 429 it stands for (see metrics.error_status)
+    status_code = 429
+
+    def __init__(self, upstream, retry_after, response=None):
+        super().__init__(f"{upstream} is rate limiting requests, retry in {retry_after:.1f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+        self.response = response  # the 429 response, or None when the limiter refused to wait
+
+
+_local = threading.local()
+
+
+# Function to get this thread's connection to the rate limit database (reopened in forked processes)
+def connect_rate_limit_db():
+    if getattr(_local, "pid", None) != os.getpid():
+        con = sqlite3.connect(RATE_LIMIT_DB_PATH, timeout=30, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL")
+        # Losing the last bucket update in a crash is harmless, so don't wait on fsync
+        con.execute("PRAGMA synchronous=NORMAL")
+        _local.con, _local.pid = con, os.getpid()
+    return _local.con
+
+
+def init_rate_limit_db():
+    # Tokens is the bucket level at Tokens_At; a Tokens_At in the future means the upstream is blocked until then
+    connect_rate_limit_db().execute('''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+        Upstream TEXT PRIMARY KEY,
+        Rate REAL,
+        Tokens REAL,
+        Tokens_At REAL
+    )
+    ''')
+
+
+init_rate_limit_db()
+
+
+# Function to read a Retry-After header (seconds, or an HTTP date); returns seconds or None
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """Token bucket for one upstream, shared through RATE_LIMIT_DB_PATH.
+
+    rate is requests per second when nothing is being throttled (<= 0 means no pacing, though
+    Retry-After blocks still apply) and burst the number of requests that can go out at once.
+    """
+
+    def __init__(self, upstream, rate, burst=None, min_rate=None, max_wait=RATE_LIMIT_MAX_WAIT):
+        self.upstream = upstream
+        self.max_wait = max_wait
+        self.set_rate(rate, burst, min_rate)
+
+    # Function to change the configured rate and burst (e.g. from a command line option). A lower
+    # rate applies from the next request; a higher one is reached by recovering after successes.
+    def set_rate(self, rate, burst=None, min_rate=None):
+        self.max_rate = max(0.0, rate)
+        self.burst = burst or max(1.0, self.max_rate)
+        self.min_rate = min_rate if min_rate is not None else self.max_rate / 20
+        # Rate seen by this process's last reservation; saves a write per success at full speed
+        self._rate = self.max_rate
+
+    # Runs fn(rate, tokens, tokens_at, now) -> (rate, tokens, tokens_at, result) on the bucket in one transaction
+    def _update(self, fn):
+        con = connect_rate_limit_db()
+        now = time.time()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            row = con.execute("SELECT Rate, Tokens, Tokens_At FROM rate_limits WHERE Upstream = ?", [self.upstream]).fetchone()
+            rate, tokens, tokens_at = row if row else (self.max_rate, self.burst, now)
+            rate, tokens, tokens_at, result = fn(min(rate, self.max_rate), tokens, tokens_at, now)
+            con.execute(
+                "INSERT OR REPLACE INTO rate_limits (Upstream, Rate, Tokens, Tokens_At) VALUES (?, ?, ?, ?)",
+                [self.upstream, rate, tokens, tokens_at]
+            )
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        self._rate = rate
+        return result
+
+    # Function to take a token; returns how many seconds to wait before sending the request.
+    # Raises UpstreamThrottled (without taking a token) when that would be longer than max_wait.
+    def reserve(self):
+        def take(rate, tokens, tokens_at, now):
+            if now > tokens_at:
+                tokens = min(self.burst, tokens + (now - tokens_at) * rate) if rate > 0 else self.burst
+                tokens_at = now
+            wait = tokens_at - now
+            if rate > 0 and tokens < 1:
+                wait += (1 - tokens) / rate
+            if wait > self.max_wait:
+                raise UpstreamThrottled(self.upstream, wait)
+            return rate, tokens - 1 if rate > 0 else tokens, tokens_at, wait
+        return self._update(take)
+
+    # Function to wait for a token before a request
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            with timed("rate_limit"):
+                time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = await asyncio.to_thread(self.reserve)
+        if wait > 0:
+            with timed("rate_limit"):
+                await asyncio.sleep(wait)
+
+    # Function to record a 429: block the upstream for retry_after seconds and back off the rate
+    # (once per throttling episode, not once per request that was in flight). Returns the seconds blocked.
+    def throttled(self, retry_after=None):
+        def back_off(rate, tokens, tokens_at, now):
+            if tokens_at <= now and rate > 0:
+                rate = max(self.min_rate, rate * BACKOFF_FACTOR)
+            if retry_after is None:
+                delay = max(DEFAULT_RETRY_AFTER, 1 / rate if rate > 0 else 0)
+            else:
+                delay = retry_after
+            tokens_at = max(tokens_at, now + delay)
+            return rate, min(tokens, 0.0), tokens_at, tokens_at - now
+        blocked_for = self._update(back_off)
+        print(f"{self.upstream} rate limited us; blocked for {blocked_for:.1f}s at {self._rate:.2f} req/s")
+        return blocked_for
+
+    # Function to record a request that wasn't throttled, stepping the rate back up towards max_rate
+    def succeeded(self):
+        if self._rate >= self.max_rate:
+            return
+        self._update(lambda rate, tokens, tokens_at, now: (
+            min(self.max_rate, rate + self.max_rate * RECOVERY_STEP), tokens, tokens_at, None
+        ))
+
+    # Function to report an upstream response (requests or httpx); a 429 raises UpstreamThrottled
+    def observe(self, response):
+        if response.status_code == 429:
+            blocked_for = self.throttled(parse_retry_after(response.headers.get("Retry-After")))
+            raise UpstreamThrottled(self.upstream, blocked_for, response)
+        self.succeeded()
+
+    # httpx event hooks that pace an httpx.AsyncClient's requests through this limiter
+    def async_event_hooks(self):
+        async def before_request(request):
+            await self.acquire_async()
+
+        # observe writes to the SQLite bucket, so it runs off the event loop
+        async def after_response(response):
+            await asyncio.to_thread(self.observe, response)
+
+        return {"request": [before_request], "response": [after_response]}
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """requests adapter that takes a token from a limiter before every request sent through it
+    and raises UpstreamThrottled on a 429 (after reporting it to the limiter)."""
+
+    def __init__(self, limiter, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire()
+        response = super().send(request, **kwargs)
+        try:
+            self.limiter.observe(response)
+        except UpstreamThrottled:
+            # The caller never sees this response, so hand its connection back to the pool now
+            # (httpx closes the response itself when an event hook raises)
+            response.close()
+            raise
+        return response
+
+
+@register_collector
+def rate_limit_metrics():
+    now = time.time()
+    rows = connect_rate_limit_db().execute("SELECT Upstream, Rate, Tokens_At FROM rate_limits ORDER BY Upstream").fetchall()
+    return [
+        ("lyrics_upstream_rate_limit", "gauge", "Requests per second currently allowed to each upstream (0 = unpaced)",
+         [({"upstream": upstream}, rate) for upstream, rate, _ in rows]),
+        ("lyrics_upstream_blocked_seconds", "gauge", "Seconds until a throttled upstream may be called again",
+         [({"upstream": upstream}, max(0.0, tokens_at - now)) for upstream, _, tokens_at in rows]),
+    ]
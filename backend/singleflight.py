@@ -0,0 +1,177 @@
+import asyncio
+import threading
+from metrics import register_collector, propagate_timings
+
+# Every SingleFlight registers itself here so in-flight work can be reported
+FLIGHTS = {}
+
+
+class Flight:
+    """One in-flight job. Every event it publishes is kept, so a subscriber that
+    attaches late still replays the earlier events before following new ones."""
+
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self._cond = threading.Condition()
+
+    def publish(self, event):
+        with self._cond:
+            self.events.append(event)
+            self._cond.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self._cond:
+            self.result = result
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    # Generator over the job's events (replayed, then live) until it finishes
+    def subscribe(self):
+        idx = 0
+        while True:
+            with self._cond:
+                while idx >= len(self.events) and not self.done:
+                    self._cond.wait()
+                new_events = self.events[idx:]
+                done = self.done
+            for event in new_events:
+                yield event
+            idx += len(new_events)
+            if done and idx >= len(self.events):
+                return
+
+    # Block until the job finishes; returns its result or re-raises its error
+    def wait(self):
+        with self._cond:
+            while not self.done:
+                self._cond.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """Deduplicates identical concurrent jobs: callers with the same key attach to the one running job."""
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+        FLIGHTS[name] = self
+        self._lock = threading.Lock()
+        self.started = 0
+        self.joined = 0
+
+    def _attach(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.joined += 1
+                return flight, False
+            flight = Flight()
+            self._flights[key] = flight
+            self.started += 1
+            return flight, True
+
+    def _run(self, key, flight, fn, args):
+        try:
+            flight.finish(result=fn(flight, *args))
+        except Exception as e:
+            flight.finish(error=e)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    # Run fn(flight, *args) inline in the first caller; identical concurrent callers wait for its result
+    def do(self, key, fn, *args):
+        flight, leader = self._attach(key)
+        if leader:
+            self._run(key, flight, fn, args)
+        return flight.wait()
+
+    # Start fn(flight, *args) in a background thread (or attach to the running one) and return the Flight.
+    # The job keeps running if a subscriber goes away, so other subscribers still get the result.
+    def run(self, key, fn, *args):
+        flight, leader = self._attach(key)
+        if leader:
+            threading.Thread(target=propagate_timings(self._run), args=(key, flight, fn, args), name=f"{self.name}-flight", daemon=True).start()
+        return flight
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+
+class AsyncFlight:
+    """asyncio counterpart of Flight, for the ASGI app."""
+
+    def __init__(self):
+        self.events = []
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        self._changed.set()
+
+    async def subscribe(self):
+        idx = 0
+        while True:
+            while idx < len(self.events):
+                yield self.events[idx]
+                idx += 1
+            if self.task.done():
+                return
+            self._changed.clear()
+            waiter = asyncio.ensure_future(self._changed.wait())
+            await asyncio.wait([waiter, self.task], return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+
+    async def wait(self):
+        # shield: a cancelled subscriber must not cancel the shared job
+        return await asyncio.shield(self.task)
+
+
+class AsyncSingleFlight:
+    """asyncio counterpart of SingleFlight; jobs run as tasks shared by every caller with the same key."""
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+        FLIGHTS[name] = self
+        self.started = 0
+        self.joined = 0
+
+    def run(self, key, coro_fn, *args):
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.joined += 1
+            return flight
+        flight = AsyncFlight()
+        self._flights[key] = flight
+        self.started += 1
+        flight.task = asyncio.ensure_future(coro_fn(flight, *args))
+        flight.task.add_done_callback(lambda _: self._flights.pop(key, None))
+        return flight
+
+    async def do(self, key, coro_fn, *args):
+        return await self.run(key, coro_fn, *args).wait()
+
+    def in_flight(self):
+        return len(self._flights)
+
+
+@register_collector
+def flight_metrics():
+    flights = list(FLIGHTS.values())
+    return [
+        ("lyrics_singleflight_in_flight", "gauge", "Deduplicated jobs (album ingestions, track lookups) running now",
+         [({"flight": flight.name}, flight.in_flight()) for flight in flights]),
+        ("lyrics_singleflight_started_total", "counter", "Jobs started",
+         [({"flight": flight.name}, flight.started) for flight in flights]),
+        ("lyrics_singleflight_joined_total", "counter", "Callers that attached to an already running job",
+         [({"flight": flight.name}, flight.joined) for flight in flights]),
+    ]
@@ -1,69 +1,172 @@
 import os
+import time
+import threading
 import requests
 from io import BytesIO
 import base64
-import re
 from dotenv import load_dotenv
+from cache_utils import artist_id_cache, album_list_cache, track_list_cache
+from upstream_steps import run_steps, cached_steps
+from metrics import timed, record_upstream
+from rate_limiter import AdaptiveRateLimiter, RateLimitedAdapter, UpstreamThrottled
 
 load_dotenv()
 
-def get_spotify_api_token():
-    #spotify client ID and secret
-    CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
-    CLIENT_SECRET = os.getenv("Spotify_Client_Secret")
-    
-    # Spotify API token URL
-    TOKEN_URL = 'https://accounts.spotify.com/api/token'
-    
-    # Encode Client ID and Secret in Base64
-    auth_str = f"{CLIENT_ID}:{CLIENT_SECRET}"
-    b64_auth_str = base64.b64encode(auth_str.encode()).decode()
-    
-    # Prepare headers and data for the token request
-    headers = {
-        'Authorization': f'Basic {b64_auth_str}',
-    }
-    data = {
-        'grant_type': 'client_credentials',
-    }
-    
-    # Request access token
-    response = requests.post(TOKEN_URL, headers=headers, data=data)
-    if response.status_code == 200:
-        token_response = response.json()
-        access_token = token_response['access_token']
+# Spotify API token URL and API root
+SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", 'https://accounts.spotify.com/api/token')
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", 'https://api.spotify.com/v1')
+# Requests per second to Spotify and how many can go out at once; shared by every process on the host,
+# 0 turns pacing off
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))
+SPOTIFY_BURST = float(os.getenv("SPOTIFY_BURST", "20"))
+spotify_limiter = AdaptiveRateLimiter("spotify", SPOTIFY_RATE_LIMIT, SPOTIFY_BURST)
+# Release groups (include_groups) listed for an artist: their own albums and singles. Compilations
+# and appears_on releases are mostly other artists' tracks.
+ARTIST_RELEASE_GROUPS = "album,single"
+# Release groups counted for a whole discography: singles repeat tracks that are on the albums
+DISCOGRAPHY_GROUPS = "album"
+
+
+class SpotifyClient:
+    """Spotify Web API client with a shared keep-alive session and managed token.
+
+    The client-credentials token is fetched lazily on the first request and
+    refreshed shortly before it expires. Requests are paced by the shared rate
+    limiter; a 429 is retried once the limiter's Retry-After block has passed,
+    other transient failures with exponential backoff. UpstreamThrottled is raised
+    when Spotify keeps us waiting longer than the limiter's max_wait.
+    """
+
+    def __init__(self, client_id, client_secret, max_retries=3, refresh_margin=60, timeout=10, pool_size=32, limiter=spotify_limiter):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.max_retries = max_retries
+        self.refresh_margin = refresh_margin
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = RateLimitedAdapter(limiter, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+
+    # Function to get a valid access token, requesting a new one when missing or about to expire
+    def get_token(self, force_refresh=False):
+        with self._token_lock:
+            if force_refresh or not self._token or time.monotonic() >= self._token_expires_at - self.refresh_margin:
+                self._refresh_token()
+            return self._token
+
+    def _refresh_token(self):
+        # Encode Client ID and Secret in Base64
+        auth_str = f"{self.client_id}:{self.client_secret}"
+        b64_auth_str = base64.b64encode(auth_str.encode()).decode()
         headers = {
-        'Authorization': f'Bearer {access_token}'
+            'Authorization': f'Basic {b64_auth_str}',
         }
-        response = requests.get('https://api.spotify.com/v1/artists/{artist_id}/albums', headers=headers)
-        return access_token
+        data = {
+            'grant_type': 'client_credentials',
+        }
+        response = self.session.post(SPOTIFY_TOKEN_URL, headers=headers, data=data, timeout=self.timeout)
+        if response.status_code != 200:
+            print(f"Failed to get token. Status code: {response.status_code}")
+            self._token = None
+            self._token_expires_at = 0.0
+            return
+        token_response = response.json()
+        self._token = token_response['access_token']
+        self._token_expires_at = time.monotonic() + token_response.get('expires_in', 3600)
 
-        print(f"Access Token: {access_token}")
-    else:
-        print(f"Failed to get token. Status code: {response.status_code}") 
+    # Function to GET an API path (or full URL), retrying on 401/429/5xx; returns the last response
+    # (raises UpstreamThrottled if still throttled)
+    def get(self, path, params=None):
+        url = path if path.startswith("http") else f"{SPOTIFY_API_URL}{path}"
+        response = None
+        for attempt in range(self.max_retries + 1):
+            token = self.get_token(force_refresh=response is not None and response.status_code == 401)
+            headers = {
+                'Authorization': f'Bearer {token}'
+            }
+            try:
+                with timed("spotify"):
+                    response = self.session.get(url, headers=headers, params=params, timeout=self.timeout)
+            except UpstreamThrottled as e:
+                record_upstream("spotify", error=e)
+                # Without a response the limiter refused to wait that long; don't spin on it
+                if attempt == self.max_retries or e.response is None:
+                    raise
+                print(f"Spotify rate limited, retrying in {e.retry_after:.1f}s")
+                continue
+            except requests.RequestException as e:
+                record_upstream("spotify", error=e)
+                print(f"Spotify request failed: {e}")
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(2 ** attempt * 0.5)
+                continue
 
+            record_upstream("spotify", response.status_code)
+            if response.status_code >= 500:
+                time.sleep(2 ** attempt * 0.5)
+            elif response.status_code != 401:
+                return response
+        return response
 
-#Replace with your api token
-SPOTIFY_API_TOKEN = get_spotify_api_token()
+    # Function to run a steps generator (see upstream_steps.py) whose requests are (path or URL, params)
+    def run(self, steps):
+        return run_steps(steps, lambda request: self.get(*request))
 
 
+# Largest page sizes Spotify allows for these endpoints
+SPOTIFY_PAGE_LIMIT = 50
+SPOTIFY_ALBUMS_BATCH_SIZE = 20
 
-# Function to normalize text (remove special characters and make it lowercase)
-def normalize_text(text):
-    text = text.lower()
-    text = re.sub(r'[^a-z0-9\s]', '', text)
-    return text
+#spotify client ID and secret
+spotify = SpotifyClient(os.getenv("SPOTIFY_CLIENT_ID"), os.getenv("Spotify_Client_Secret"))
 
 
+# Function to get the current Spotify API token (requested lazily and refreshed before expiry)
+def get_spotify_api_token():
+    return spotify.get_token()
+
+
+# The lookups below are steps generators (see upstream_steps.py) yielding (path or URL, params)
+# GET requests, so the blocking client here and the async one in async_clients.py share them.
+
+# Steps to read every page of a paging object, starting at an API path; returns None on failure
+def all_items_steps(path, params=None):
+    response = yield (path, params)
+    if response.status_code != 200:
+        return None
+    page = response.json()
+    remaining = yield from remaining_items_steps(page)
+    if remaining is None:
+        return None
+    return list(page.get("items", [])) + remaining
+
+
+# Steps to follow a paging object's `next` links; returns the items of the remaining pages, or None
+# when any page fails (a partial list would be cached and indexed as the whole album or discography)
+def remaining_items_steps(page):
+    items = []
+    next_url = page.get("next")
+    while next_url:
+        response = yield (next_url, None)
+        if response.status_code != 200:
+            print(f"Failed to fetch page {next_url}. Status code: {response.status_code}")
+            return None
+        page = response.json()
+        items.extend(page.get("items", []))
+        next_url = page.get("next")
+    return items
+
+
+# Steps to search for an artist and get their ID on Spotify
+@cached_steps(artist_id_cache)
+def artist_id_steps(artist_name):
+    response = yield ("/search", {"q": artist_name, "type": "artist"})
 
-# Function to search for an artist and get their ID on Spotify
-def get_spotify_artist_id(artist_name):
-    headers = {
-        'Authorization': f'Bearer {SPOTIFY_API_TOKEN}'
-    }
-    search_url = f"https://api.spotify.com/v1/search?q={artist_name}&type=artist"
-    response = requests.get(search_url, headers=headers)
-    
     if response.status_code == 200:
         artists = response.json()["artists"]["items"]
         if artists:
@@ -71,30 +174,97 @@ def get_spotify_artist_id(artist_name):
             return artist_id
     return None
 
-# Function to get albums by artist ID on Spotify
-def get_spotify_albums(artist_id):
-    headers = {
-        'Authorization': f'Bearer {SPOTIFY_API_TOKEN}'
-    }
-    albums_url = f"https://api.spotify.com/v1/artists/{artist_id}/albums"
-    response = requests.get(albums_url, headers=headers)
 
-    if response.status_code == 200:
-        albums = response.json()
-        return albums
-    return None
+# Steps to get albums by artist ID on Spotify, of the given release groups (comma-separated)
+@cached_steps(album_list_cache)
+def albums_steps(artist_id, include_groups=ARTIST_RELEASE_GROUPS):
+    items = yield from all_items_steps(f"/artists/{artist_id}/albums", {"limit": SPOTIFY_PAGE_LIMIT, "include_groups": include_groups})
+    if items is None:
+        return None
+    return {"items": items, "total": len(items)}
+
+
+# Steps to get tracks (ID and name) from an album on Spotify
+@cached_steps(track_list_cache)
+def album_track_items_steps(album_id):
+    tracks = yield from all_items_steps(f"/albums/{album_id}/tracks", {"limit": SPOTIFY_PAGE_LIMIT})
+    if tracks is None:
+        return None
+    return [{"id": track.get("id"), "name": track["name"]} for track in tracks]
+
+
+# Function to reduce a full album object to its track items (ID and name)
+def album_track_items(album):
+    return [{"id": track.get("id"), "name": track["name"]} for track in album["tracks"]["items"]]
+
+
+# Steps to get full album objects for many albums, SPOTIFY_ALBUMS_BATCH_SIZE per request.
+# Each album's track list is completed past its first page and primed into the track list cache;
+# albums whose later track pages fail are left out.
+def several_albums_steps(album_ids):
+    albums = []
+    for start in range(0, len(album_ids), SPOTIFY_ALBUMS_BATCH_SIZE):
+        batch = album_ids[start:start + SPOTIFY_ALBUMS_BATCH_SIZE]
+        response = yield ("/albums", {"ids": ",".join(batch)})
+        if response.status_code != 200:
+            print(f"Failed to fetch albums {batch}. Status code: {response.status_code}")
+            continue
+        for album in response.json().get("albums", []):
+            if not album:
+                continue
+            track_page = album.setdefault("tracks", {})
+            remaining = yield from remaining_items_steps(track_page)
+            if remaining is None:
+                continue  # left out; the album loads its track list on its own
+            track_page["items"] = list(track_page.get("items", [])) + remaining
+            track_list_cache.set((album["id"],), album_track_items(album))
+            albums.append(album)
+    return albums
+
+
+# Steps to get the track lists of many albums in a handful of requests; returns {album_id: [track, ...]}
+def albums_tracks_steps(album_ids):
+    album_tracks = {}
+    missing = []
+    for album_id in album_ids:
+        found, tracks = track_list_cache.get((album_id,))
+        if found:
+            album_tracks[album_id] = tracks
+        else:
+            missing.append(album_id)
+    for album in (yield from several_albums_steps(missing)):
+        album_tracks[album["id"]] = album_track_items(album)
+    return album_tracks
+
+
+# Function to search for an artist and get their ID on Spotify
+def get_spotify_artist_id(artist_name):
+    return spotify.run(artist_id_steps(artist_name))
+
+
+# Function to get albums by artist ID on Spotify (see albums_steps)
+def get_spotify_albums(artist_id, include_groups=ARTIST_RELEASE_GROUPS):
+    return spotify.run(albums_steps(artist_id, include_groups))
+
+
+# Function to get tracks (ID and name) from an album on Spotify
+def get_spotify_album_track_items(album_id):
+    return spotify.run(album_track_items_steps(album_id))
 
 
 # Function to get tracks from an album on Spotify
 def get_spotify_album_tracks(album_id):
-    headers = {
-        'Authorization': f'Bearer {SPOTIFY_API_TOKEN}'
-    }
-    tracks_url = f"https://api.spotify.com/v1/albums/{album_id}/tracks"
-    response = requests.get(tracks_url, headers=headers)
-    
-    if response.status_code == 200:
-        tracks = response.json()["items"]
-        track_names = [track["name"] for track in tracks]
-        return track_names
-    return None
+    tracks = get_spotify_album_track_items(album_id)
+    if tracks is None:
+        return None
+    return [track["name"] for track in tracks]
+
+
+# Function to get full album objects for many albums (see several_albums_steps)
+def get_spotify_several_albums(album_ids):
+    return spotify.run(several_albums_steps(album_ids))
+
+
+# Function to get the track lists of many albums in a handful of requests; returns {album_id: [track, ...]}
+def get_spotify_albums_tracks(album_ids):
+    return spotify.run(albums_tracks_steps(album_ids))
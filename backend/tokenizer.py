@@ -0,0 +1,105 @@
+# The one tokenizer used for lyrics, requested words and stopwords alike, so that what is indexed
+# and what is looked up always match. Tokens are Unicode words (accented and non-Latin letters
+# included, with their combining marks), NFC-normalized and case-folded, and streamed from a generator.
+#
+# Contraction and hyphen handling is configurable:
+#   contractions: "join"  don't -> dont        (default, matches existing indexes)
+#                 "keep"  don't -> don't       (curly apostrophes become ')
+#                 "split" don't -> don, t
+#   hyphens:      "join"  well-known -> wellknown   (default)
+#                 "keep"  well-known -> well-known
+#                 "split" well-known -> well, known
+# Albums record the tokenizer version they were indexed with (see duckdb_utils.get_album_index);
+# after the rules change, each album is re-indexed from its stored lyrics when next requested.
+import os
+import re
+import unicodedata
+
+TOKENIZER_CONTRACTIONS = os.getenv("TOKENIZER_CONTRACTIONS", "join")
+TOKENIZER_HYPHENS = os.getenv("TOKENIZER_HYPHENS", "join")
+
+# Bump whenever tokens come out differently for the same rules
+#   2: NFC normalization, combining marks kept inside words (Devanagari, decomposed accents)
+TOKENIZER_VERSION = 2
+
+APOSTROPHES = "'’‘ʼ"
+HYPHENS = "-‐‑"
+RULES = ("join", "keep", "split")
+
+
+
+# Function to build a regex character class body of the combining marks (categories Mn, Mc, Me).
+# Python's \w leaves them out, which would split words such as "नमस्ते" at every vowel sign or virama.
+# Marks only occur in planes 0, 1 and 14, so the rest of the code space isn't scanned.
+def _combining_marks():
+    ranges = []
+    for code in [*range(0x20000), *range(0xE0000, 0xE1000)]:
+        if unicodedata.category(chr(code)).startswith("M"):
+            if ranges and ranges[-1][1] == code - 1:
+                ranges[-1][1] = code
+            else:
+                ranges.append([code, code])
+    return "".join(chr(start) if start == end else f"{chr(start)}-{chr(end)}" for start, end in ranges)
+
+
+# A word is a letter/digit followed by letters, digits and combining marks (underscores are turned
+# into word breaks first); kept apostrophes/hyphens may join runs into one token
+WORD = rf"\w[\w{_combining_marks()}]*"
+_TOKEN_RES = {
+    (True, True): re.compile(rf"{WORD}(?:['-]{WORD})*"),
+    (True, False): re.compile(rf"{WORD}(?:'{WORD})*"),
+    (False, True): re.compile(rf"{WORD}(?:-{WORD})*"),
+    (False, False): re.compile(WORD),
+}
+
+
+class Tokenizer:
+    """Streams normalized tokens out of text according to the contraction and hyphen rules.
+
+    The text is NFC-normalized (so precomposed and decomposed accents tokenize alike), case-folded
+    and its apostrophes/hyphens rewritten with precompiled patterns, after which a single
+    precompiled pattern picks out the tokens.
+    """
+
+    def __init__(self, contractions=TOKENIZER_CONTRACTIONS, hyphens=TOKENIZER_HYPHENS):
+        if contractions not in RULES or hyphens not in RULES:
+            raise ValueError(f"contractions and hyphens must be one of {RULES}")
+        self.contractions = contractions
+        self.hyphens = hyphens
+        # Identifies the tokens this tokenizer produces, e.g. "1:join:join"
+        self.version = f"{TOKENIZER_VERSION}:{contractions}:{hyphens}"
+        # join drops the separator, keep normalizes it to ASCII, split turns it into a word break
+        rewrites = {" ": "_"}
+        for chars, rule, ascii_char in ((APOSTROPHES, contractions, "'"), (HYPHENS, hyphens, "-")):
+            replacement = {"join": "", "keep": ascii_char, "split": " "}[rule]
+            rewrites[replacement] = rewrites.get(replacement, "") + chars
+        self._rewrites = [(re.compile(f"[{re.escape(chars)}]"), replacement) for replacement, chars in rewrites.items()]
+        self._token_re = _TOKEN_RES[(contractions == "keep", hyphens == "keep")]
+
+    def _prepare(self, text):
+        # ASCII text (most lyrics) is already in NFC
+        if not text.isascii():
+            text = unicodedata.normalize("NFC", text)
+        text = text.casefold()
+        for pattern, replacement in self._rewrites:
+            text = pattern.sub(replacement, text)
+        return text
+
+    # Generator over the tokens of text
+    def iter_tokens(self, text):
+        for match in self._token_re.finditer(self._prepare(text)):
+            yield match.group()
+
+    def tokenize(self, text):
+        return self._token_re.findall(self._prepare(text))
+
+    # Function to normalize text to its tokens joined by single spaces (the stored lyric form)
+    def normalize(self, text):
+        return " ".join(self.tokenize(text))
+
+
+tokenizer = Tokenizer()
+iter_tokens = tokenizer.iter_tokens
+tokenize = tokenizer.tokenize
+normalize_text = tokenizer.normalize
+tokenizer_version = tokenizer.version
@@ -0,0 +1,62 @@
+# Upstream lookups (Spotify searches and paging, the Genius song search) are written once, as
+# generators of "steps": each step yields the request it needs and is sent back the response.
+# The blocking clients (requests, used by app.py, the job workers and warm_cache.py) and the
+# non-blocking ones (httpx, used by asgi_app.py) only differ in how they send a request, so every
+# rule about what to ask for and how to read the answer is shared.
+#
+#   def artist_id_steps(artist_name):
+#       response = yield ("/search", {"q": artist_name, "type": "artist"})
+#       return response.json()["artists"]["items"][0]["id"]
+#
+#   spotify.run(artist_id_steps("kendrick lamar"))              # blocking
+#   await spotify_async.run(artist_id_steps("kendrick lamar"))  # asyncio
+from functools import wraps
+
+
+# Function to run a steps generator, sending each request it yields with send(request); returns its result.
+# An exception raised by send is thrown into the generator at the step that asked for the request.
+def run_steps(steps, send):
+    try:
+        request = next(steps)
+        while True:
+            try:
+                response = send(request)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(response)
+    except StopIteration as done:
+        return done.value
+
+
+# Function to run a steps generator with a coroutine send(request)
+async def run_steps_async(steps, send):
+    try:
+        request = next(steps)
+        while True:
+            try:
+                response = await send(request)
+            except Exception as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(response)
+    except StopIteration as done:
+        return done.value
+
+
+# Decorator that caches a steps generator's result by its arguments, like cache_utils.cached.
+# A cached result comes back without any request; None results (failures) are not cached.
+def cached_steps(cache):
+    def decorator(steps_fn):
+        @wraps(steps_fn)
+        def wrapper(*args):
+            found, value = cache.get(args)
+            if found:
+                return value
+            value = yield from steps_fn(*args)
+            if value is not None:
+                cache.set(args, value)
+            return value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
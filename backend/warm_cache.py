@@ -0,0 +1,193 @@
+# Bulk warm-cache CLI: ingests the lyrics and token indexes of whole catalogs into lyrics_cache.db
+# ahead of time, so the first user request for them is already a cache hit.
+#
+# Input (file or stdin) is one target per line, either an artist or an artist and album
+# separated by a tab; blank lines and lines starting with # are skipped:
+#
+#   kendrick lamar
+#   kendrick lamar<TAB>DAMN.
+#
+# Targets that failed are written back out in the same format, so they can be retried with:
+#   python warm_cache.py -i failed.txt
+import math
+import sys
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from spotify_utils import get_spotify_artist_id, get_spotify_albums, get_spotify_albums_tracks, ARTIST_RELEASE_GROUPS, DISCOGRAPHY_GROUPS
+from index_utils import get_track_lyrics, store_album_tracks, LYRICS_FETCH_WORKERS
+from duckdb_utils import get_album_index, get_cached_lyrics, write_queue
+from rap_genius_utils import genius_limiter
+from rate_limiter import UpstreamThrottled
+
+
+# Function to parse input lines into (artist, album or None) targets
+def parse_targets(lines):
+    targets = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        artist, _, album = line.partition("\t")
+        targets.append((artist.strip().lower(), album.strip() or None))
+    return targets
+
+
+def format_target(artist, album=None):
+    return f"{artist}\t{album}" if album else artist
+
+
+# Function to describe a throttled upstream call as a target's failure
+def throttled_error(error):
+    return f"Rate limited by {error.upstream}, retry in {math.ceil(error.retry_after)}s"
+
+
+# Function to resolve targets to the albums to ingest; returns ([album, ...], [(target, error), ...])
+def resolve_albums(targets, force=False):
+    albums = {}
+    failures = []
+    for artist, album_name in targets:
+        # A throttled Spotify lookup fails this target only; it is written to --failures for a retry
+        try:
+            artist_id = get_spotify_artist_id(artist)
+            if not artist_id:
+                failures.append(((artist, album_name), "Artist not found"))
+                continue
+            # A named album may be any of the artist's releases; a whole artist is their albums only, as for /count-word-artist
+            artist_albums = get_spotify_albums(artist_id, ARTIST_RELEASE_GROUPS if album_name else DISCOGRAPHY_GROUPS)
+        except UpstreamThrottled as e:
+            failures.append(((artist, album_name), throttled_error(e)))
+            continue
+        if not artist_albums or not artist_albums.get("items"):
+            failures.append(((artist, album_name), "No albums found"))
+            continue
+
+        # Spotify lists clean/explicit and regional versions separately; ingest each album name once
+        unique_albums = {}
+        for album in artist_albums["items"]:
+            unique_albums.setdefault(album["name"].strip().lower(), album)
+        if album_name:
+            album = unique_albums.get(album_name.strip().lower())
+            if not album:
+                failures.append(((artist, album_name), "Album not found"))
+                continue
+            selected = [album]
+        else:
+            selected = list(unique_albums.values())
+
+        for album in selected:
+            if not force and get_album_index(artist, album["name"]):
+                continue
+            albums.setdefault((artist, album["name"]), {"artist": artist, "id": album["id"], "name": album["name"]})
+    return list(albums.values()), failures
+
+
+# Function to ingest albums with every track fetch sharing one pool. Genius requests are paced by
+# genius_limiter, shared with the app and job workers; rate (requests per second) replaces its
+# GENIUS_RATE_LIMIT when given. An album's index is stored once all of its tracks are in; albums
+# with a failed track are reported instead, and their fetched lyrics are kept so a retry only
+# fetches what is missing.
+def warm_albums(albums, workers=LYRICS_FETCH_WORKERS, rate=None, log=print):
+    if rate is not None:
+        genius_limiter.set_rate(rate)
+    stats = Counter()
+    failures = []
+    try:
+        album_tracks = get_spotify_albums_tracks([album["id"] for album in albums])
+    except UpstreamThrottled as e:
+        # No track lists, so nothing can be fetched; every album is reported for a retry
+        failures.extend(((album["artist"], album["name"]), throttled_error(e)) for album in albums)
+        return stats, failures
+
+    # Returns (was_cached, get_track_lyrics result)
+    def fetch(album, track):
+        was_cached = bool(get_cached_lyrics(album["artist"], track["name"], track["id"]))
+        return was_cached, get_track_lyrics(track["name"], album["artist"], track["id"])
+
+    pending = {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {}
+        for album in albums:
+            tracks = album_tracks.get(album["id"])
+            if not tracks:
+                failures.append(((album["artist"], album["name"]), "No tracks found"))
+                continue
+            pending[album["id"]] = len(tracks)
+            results[album["id"]] = {}
+            for position, track in enumerate(tracks):
+                futures[executor.submit(fetch, album, track)] = (album, position, track)
+
+        for future in as_completed(futures):
+            album, position, track = futures[future]
+            try:
+                was_cached, (lyrics, track_album_art) = future.result()
+                stats["cached" if was_cached else "fetched"] += 1
+                if not lyrics:
+                    stats["no_lyrics"] += 1
+            except Exception as e:
+                log(f"Error fetching lyrics for '{track['name']}' ({album['artist']}): {e}")
+                lyrics, track_album_art = None, None
+                stats["failed_tracks"] += 1
+            stats["tracks"] += 1
+            results[album["id"]][position] = (lyrics, track_album_art)
+
+            pending[album["id"]] -= 1
+            if pending[album["id"]]:
+                continue
+            tracks = album_tracks[album["id"]]
+            album_results = results.pop(album["id"])
+            failed = [position for position, (lyrics, _) in album_results.items() if lyrics is None]
+            if failed:
+                failures.append(((album["artist"], album["name"]), f"{len(failed)} track(s) failed"))
+                continue
+            track_lyrics = [album_results[position][0] for position in range(len(tracks))]
+            track_album_arts = [album_results[position][1] for position in range(len(tracks))]
+            store_album_tracks(album["artist"], album["id"], album["name"], tracks, track_lyrics, track_album_arts)
+            stats["albums"] += 1
+
+    write_queue.flush()
+    return stats, failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Warm lyrics_cache.db with the lyrics and token indexes of artists or albums")
+    parser.add_argument("-i", "--input", default="-", help="file with one 'artist' or 'artist<TAB>album' per line (default: stdin)")
+    parser.add_argument("-w", "--workers", type=int, default=LYRICS_FETCH_WORKERS, help="tracks fetched from Genius at the same time")
+    parser.add_argument("-r", "--rate", type=float, help="max Genius requests per second, shared with the app and job workers (default: GENIUS_RATE_LIMIT, 0 = unlimited)")
+    parser.add_argument("-f", "--failures", help="write failed targets to this file, in the input format")
+    parser.add_argument("--force", action="store_true", help="re-index albums that are already indexed")
+    args = parser.parse_args(argv)
+
+    if args.input == "-":
+        targets = parse_targets(sys.stdin)
+    else:
+        with open(args.input) as f:
+            targets = parse_targets(f)
+
+    start = time.monotonic()
+    albums, failures = resolve_albums(targets, force=args.force)
+    print(f"Warming {len(albums)} album(s) from {len(targets)} target(s)")
+    stats, album_failures = warm_albums(albums, workers=args.workers, rate=args.rate)
+    failures += album_failures
+    elapsed = time.monotonic() - start
+
+    print(
+        f"Indexed {stats['albums']} album(s), {stats['tracks']} track(s) in {elapsed:.1f}s "
+        f"({stats['tracks'] / elapsed if elapsed else 0:.1f} tracks/sec); "
+        f"{stats['fetched']} fetched, {stats['cached']} already stored, {stats['no_lyrics']} without lyrics"
+    )
+    if failures:
+        print(f"{len(failures)} target(s) failed:", file=sys.stderr)
+        for (artist, album), error in failures:
+            print(f"  {format_target(artist, album)!r}: {error}", file=sys.stderr)
+        if args.failures:
+            with open(args.failures, "w") as f:
+                f.writelines(format_target(artist, album) + "\n" for (artist, album), _ in failures)
+            print(f"Retry with: python warm_cache.py -i {args.failures}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
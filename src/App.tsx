@@ -198,76 +198,86 @@ function App() {
       setCountLoading(album.id);
       
       try {
-        // Process each word for this album using the backend
-        for (const word of words) {
-          setSearchProgress({ 
-            word: word.text, 
-            album: album.name,
-            currentSong: 'Fetching track list...',
-            songIndex: 0,
-            totalSongs: 0
-          });
-          
-          // Use the streaming endpoint for real-time updates
-          const response = await fetch('http://localhost:5000/count-word-stream', {
-            method: 'POST',
-            headers: {
-              'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-              artist: artist,
-              albumId: album.id,
-              albumName: album.name,
-              words: [word.text]
-            }),
-          });
-          
-          if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
-          }
-          
-          // Handle streaming response
-          const reader = response.body?.getReader();
-          const decoder = new TextDecoder();
-          
-          if (reader) {
-            while (true) {
-              const { done, value } = await reader.read();
-              if (done) break;
-              
-              const chunk = decoder.decode(value);
-              const lines = chunk.split('\n');
-              
-              for (const line of lines) {
-                if (line.startsWith('data: ')) {
-                  try {
-                    const data = JSON.parse(line.slice(6));
-                    
-                    if (data.progress) {
-                      // Update progress
-                      setSearchProgress({
+        // Count every word for this album in a single request
+        const wordList = words.map(w => w.text);
+        const wordLabel = wordList.join(', ');
+        setSearchProgress({ 
+          word: wordLabel, 
+          album: album.name,
+          currentSong: 'Fetching track list...',
+          songIndex: 0,
+          totalSongs: 0
+        });
+        
+        // Use the streaming endpoint for real-time updates
+        const response = await fetch('http://localhost:5000/count-word-stream', {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify({
+            artist: artist,
+            albumId: album.id,
+            albumName: album.name,
+            words: wordList
+          }),
+        });
+        
+        if (!response.ok) {
+          throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        
+        // Handle streaming response
+        const reader = response.body?.getReader();
+        const decoder = new TextDecoder();
+        
+        if (reader) {
+          while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            
+            const chunk = decoder.decode(value);
+            const lines = chunk.split('\n');
+            
+            for (const line of lines) {
+              if (line.startsWith('data: ')) {
+                try {
+                  const data = JSON.parse(line.slice(6));
+                  
+                  if (data.progress) {
+                    // Update progress
+                    setSearchProgress({
+                      word: wordLabel,
+                      album: album.name,
+                      currentSong: data.progress.currentSong,
+                      songIndex: data.progress.songIndex,
+                      totalSongs: data.progress.totalSongs
+                    });
+                  } else if (data.completed) {
+                    // Final result: one count per requested word
+                    const counts: Record<string, number> = data.counts || {};
+                    setWordCounts(prev => {
+                      const filtered = prev.filter(wc => !(wc.album === album.name && wordList.includes(wc.word)));
+                      return [...filtered, ...words.map(word => ({
+                        artist: data.artist,
+                        album: data.album,
                         word: word.text,
-                        album: album.name,
-                        currentSong: data.progress.currentSong,
-                        songIndex: data.progress.songIndex,
-                        totalSongs: data.progress.totalSongs
-                      });
-                    } else if (data.completed) {
-                      // Final result
-                      setWordCounts(prev => {
-                        const filtered = prev.filter(wc => !(wc.album === album.name && wc.word === word.text));
-                        return [...filtered, {
-                          artist: data.artist,
-                          album: data.album,
-                          word: data.word,
-                          count: data.count,
-                          albumArt: data.albumArt || album.images[0]?.url
-                        }];
-                      });
+                        count: counts[word.text.trim().toLowerCase()] ?? 0,
+                        albumArt: data.albumArt || album.images[0]?.url
+                      }))];
+                    });
+                  } else if (data.error) {
+                    // Throttled upstream or some tracks failed: the album has no counts yet
+                    if (data.retryAfter) {
+                      setError(`${album.name}: ${data.error} (retry in ${data.retryAfter}s)`);
+                    } else if (data.failedTracks) {
+                      setError(`${album.name}: lyrics lookup failed for ${data.failedTracks.length} track(s), try again later`);
+                    } else {
+                      setError(`${album.name}: ${data.error}`);
                     }
-                  } catch (e) {
-                    console.error('Error parsing progress data:', e);
                   }
+                } catch (e) {
+                  console.error('Error parsing progress data:', e);
                 }
               }
             }